@@ -0,0 +1,165 @@
+"""Texture atlases: small images packed into shared pages, addressed by UV transforms
+"""
+
+import math
+import numpy
+from pyglet import gl
+from hypyr.textures import TextureLoader
+
+class SkylinePacker(object):
+	# Bottom-left skyline rectangle packer. The skyline is a list of
+	# [x, y, width] segments covering the page width, each the height of the
+	# packed area above that span; a rectangle goes where its top would be
+	# lowest (then leftmost).
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.skyline = [[0, 0, width]]
+
+	def getFit(self, i, w, h):
+		# y at which a w x h rectangle fits starting at segment i, or None
+		x = self.skyline[i][0]
+		if x + w > self.width:
+			return None
+		y = 0
+		remaining = w
+		while remaining > 0:
+			if i >= len(self.skyline):
+				return None
+			y = max(y, self.skyline[i][1])
+			if y + h > self.height:
+				return None
+			remaining -= self.skyline[i][2]
+			i += 1
+		return y
+
+	def insert(self, w, h):
+		# Returns (x, y) of the placed rectangle, or None if it does not fit
+		best = None
+		for i in range(len(self.skyline)):
+			y = self.getFit(i, w, h)
+			if y is not None and (best is None or (y + h, self.skyline[i][0]) < best[0]):
+				best = ((y + h, self.skyline[i][0]), i, y)
+		if best is None:
+			return None
+		_, i, y = best
+		x = self.skyline[i][0]
+		self.skyline.insert(i, [x, y + h, w])
+		# Trim or drop the segments now under the new one
+		j = i + 1
+		while j < len(self.skyline):
+			seg = self.skyline[j]
+			overlap = x + w - seg[0]
+			if overlap <= 0:
+				break
+			if overlap < seg[2]:
+				seg[0] += overlap
+				seg[2] -= overlap
+				break
+			del self.skyline[j]
+		# Merge neighbours of equal height
+		j = 0
+		while j < len(self.skyline) - 1:
+			if self.skyline[j][1] == self.skyline[j + 1][1]:
+				self.skyline[j][2] += self.skyline[j + 1][2]
+				del self.skyline[j + 1]
+			else:
+				j += 1
+		return x, y
+
+class AtlasPage(object):
+	# One RGBA page and the GL texture made from it; usable wherever a
+	# Material expects a texture (id and target)
+	target = gl.GL_TEXTURE_2D
+
+	def __init__(self, size):
+		self.size = size
+		self.pixels = numpy.zeros((size, size, 4), dtype=numpy.uint8)
+		self.packer = SkylinePacker(size, size)
+		self.id = 0
+		self.isDirty = True
+
+	def upload(self, nLevels):
+		# (Re)creates the texture with the first nLevels of its mip chain
+		if self.id:
+			gl.glDeleteTextures(1, (gl.GLuint * 1)(self.id))
+		self.id = TextureLoader.upload(TextureLoader.buildMips(self.pixels)[:nLevels], gl.GL_RGBA)
+		self.isDirty = False
+
+	def delete(self):
+		if self.id:
+			gl.glDeleteTextures(1, (gl.GLuint * 1)(self.id))
+			self.id = 0
+
+class AtlasRegion(object):
+	# Where one image landed: its page, pixel rectangle and the UV transform
+	# (scaleU, scaleV, offsetU, offsetV) mapping [0, 1] texture coordinates
+	# onto that rectangle
+	def __init__(self, page, x, y, w, h):
+		self.page = page
+		self.rect = (x, y, w, h)
+		n = float(page.size)
+		self.uvTransform = (w / n, h / n, x / n, y / n)
+
+class Atlas(object):
+	# Packs images into pages of pageSize x pageSize. Each image is framed by
+	# padding pixels copied from its edges, so filtering and the first mip
+	# levels do not bleed between neighbours; only log2(padding) + 1 mip
+	# levels are kept for that reason. Images larger than a page are
+	# rejected. Call upload() with a context current after adding images.
+	def __init__(self, pageSize=1024, padding=2):
+		self.pageSize = pageSize
+		self.padding = padding
+		self.pages = []
+		self.regions = {}
+
+	def add(self, key, rgba):
+		# Packs an [H x W x 4] uint8 image (rows bottom-up) under key
+		if key in self.regions:
+			return self.regions[key]
+		h, w = rgba.shape[:2]
+		p = self.padding
+		if w + 2 * p > self.pageSize or h + 2 * p > self.pageSize:
+			raise ValueError("%s (%ux%u) does not fit an atlas page of %u" % (key, w, h, self.pageSize))
+		for page in self.pages:
+			xy = page.packer.insert(w + 2 * p, h + 2 * p)
+			if xy is not None:
+				break
+		else:
+			page = AtlasPage(self.pageSize)
+			self.pages.append(page)
+			xy = page.packer.insert(w + 2 * p, h + 2 * p)
+		x, y = xy
+		page.pixels[y:y + h + 2 * p, x:x + w + 2 * p] = numpy.pad(rgba, ((p, p), (p, p), (0, 0)), mode='edge')
+		page.isDirty = True
+		region = AtlasRegion(page, x + p, y + p, w, h)
+		self.regions[key] = region
+		return region
+
+	def addFiles(self, imgPaths):
+		# Packs image files tallest first, which packs tighter than arrival
+		# order; returns their regions in the order given
+		images = dict((p, TextureLoader.decode(p)) for p in imgPaths)
+		for p in sorted(images.keys(), key=lambda p: -images[p].shape[0]):
+			self.add(p, images[p])
+		return [self.regions[p] for p in imgPaths]
+
+	def getRegion(self, key):
+		return self.regions[key]
+
+	def getNumLevels(self):
+		return int(math.log(max(self.padding, 1), 2)) + 1
+
+	def upload(self):
+		for page in self.pages:
+			if page.isDirty:
+				page.upload(self.getNumLevels())
+
+	def getOccupancy(self):
+		# Fraction of page area covered by packed images (padding excluded)
+		used = sum(r.rect[2] * r.rect[3] for r in self.regions.values())
+		return used / float(max(len(self.pages), 1) * self.pageSize**2)
+
+	def delete(self):
+		for page in self.pages:
+			page.delete()
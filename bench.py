@@ -0,0 +1,603 @@
+"""Benchmark harness for hot paths; run with "python -m hypyr.bench --help".
+Needs no display: GL is replaced by MockGL, which counts calls. Compare
+with "--baseline data/bench_baseline.json"; call and allocation counts
+carry over between machines, times only roughly.
+"""
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+import platform
+import timeit
+import tracemalloc
+import collections
+import multiprocessing
+import numpy
+from math import sin, cos
+import pyglet
+# MockGL stands in for a context, so none is created on import
+pyglet.options['shadow_window'] = False
+from pyglet import gl
+from hypyr import linal, scene, dynamics, shader, particles, render, stellar, solids, spatial, textures, snapshot, data
+from hypyr.profiler import profiler
+
+class CountAllocations(object):
+	# Counts Vec3/Mat3 constructions while active by wrapping __init__
+	def __init__(self, *classes):
+		self.classes = classes or (linal.Vec3, linal.Mat3)
+		self.count = 0
+		self.originals = {}
+
+	def __enter__(self):
+		for c in self.classes:
+			original = c.__init__
+			self.originals[c] = original
+			def counted(obj, *args, _original=original, **kwargs):
+				self.count += 1
+				_original(obj, *args, **kwargs)
+			c.__init__ = counted
+		return self
+
+	def __exit__(self, *exc):
+		for c, original in self.originals.items():
+			c.__init__ = original
+
+class MockGL(object):
+	# Stands in for pyglet.gl without a context. Every gl* call is counted and
+	# returns 1, and any byref() int argument is set to 1, so that handle
+	# creation and status queries succeed; constants and types are the real ones.
+	drawCalls = ('glBegin', 'glDrawArrays', 'glDrawElements', 'glDrawArraysInstanced', 'glDrawElementsInstanced', 'glMultiDrawArrays')
+
+	def __init__(self):
+		self.calls = collections.Counter()
+
+	def __getattr__(self, name):
+		real = getattr(gl, name)
+		if not name.startswith('gl'):
+			return real
+		calls = self.calls
+		def call(*args):
+			calls[name] += 1
+			for a in args:
+				obj = getattr(a, '_obj', None)
+				if hasattr(obj, 'value') and isinstance(obj.value, int):
+					obj.value = 1
+			return 1
+		return call
+
+	def nDrawCalls(self):
+		return sum(self.calls[name] for name in MockGL.drawCalls)
+
+	def reset(self):
+		self.calls.clear()
+
+	def __enter__(self):
+		# Patches the modules that talk to GL: "gl" attributes and the names
+		# shader.py pulls in with "from pyglet.gl import *"
+		self.patched = []
+		for module in (scene, particles, render, stellar, textures):
+			self.patched.append((module, 'gl', module.gl))
+			module.gl = self
+		self.patched.append((solids, 'graphics', solids.graphics))
+		solids.graphics = MockGraphics(self)
+		for name in dir(shader):
+			if name.startswith('gl'):
+				self.patched.append((shader, name, getattr(shader, name)))
+				setattr(shader, name, getattr(self, name))
+		# Dispatch tables hold GL functions directly, so swap those entries too
+		for name in ('uniformfFunctions', 'uniformiFunctions', 'uniformTypes'):
+			table = getattr(shader, name)
+			self.patched.append((shader, name, table))
+			mocked = {}
+			for k, v in table.items():
+				if isinstance(v, tuple):
+					mocked[k] = (getattr(self, v[0].__name__),) + v[1:]
+				else:
+					mocked[k] = getattr(self, v.__name__)
+			setattr(shader, name, mocked)
+		return self
+
+	def __exit__(self, *exc):
+		for module, name, value in reversed(self.patched):
+			setattr(module, name, value)
+
+class MockGraphics(object):
+	# Replaces pyglet.graphics for MockGL; vertex data is accepted and dropped
+	# and each Batch.draw counts as one glDrawElements
+	def __init__(self, mock):
+		self.mock = mock
+
+	def Batch(self):
+		return MockGraphics.MockBatch(self.mock)
+
+	class MockBatch(object):
+		def __init__(self, mock):
+			self.mock = mock
+
+		def add_indexed(self, count, mode, group, indices, *data):
+			return MockGraphics.MockVertexList()
+
+		def draw(self):
+			self.mock.calls['glDrawElements'] += 1
+
+	class MockVertexList(object):
+		def delete(self):
+			pass
+
+def measure(fn, n=10000):
+	# Returns (Vec3/Mat3 constructions per op, peak traced bytes per op, us per op)
+	with CountAllocations() as ca:
+		fn()
+	tracemalloc.start()
+	fn()
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	t_s = timeit.timeit(fn, number=n)
+	return ca.count, peak, 1e6 * t_s / n
+
+def inplaceOps():
+	# Each entry pairs the operator form ("before") with the in-place form ("after")
+	Vec3, Mat3, Rot = linal.Vec3, linal.Mat3, linal.Rot
+	a, b = Vec3(1., 2., 3.), Vec3(0.1, 0.2, 0.3)
+	m, n = Rot.x(0.1) * Rot.y(0.2), Rot.z(0.3)
+	c, p = Vec3(), Mat3()
+	return [
+		("vec add", lambda: a + b, lambda: a.iadd(b)),
+		("vec sub", lambda: a - b, lambda: a.isub(b)),
+		("vec scale", lambda: a * 1.0, lambda: a.imul(1.0)),
+		("vec cross", lambda: a ** b, lambda: a.cross_into(b, c)),
+		("vec normalize", lambda: a.normalize(), lambda: c.assign(a).normalize_inplace()),
+		("mat * mat", lambda: m * n, lambda: m.matmul_into(n, p)),
+		("mat * vec", lambda: m * a, lambda: m.matmul_into(a, c)),
+	]
+
+def benchInplace():
+	print("%-16s %14s %14s %12s %12s" % ("op", "allocs before", "allocs after", "us before", "us after"))
+	for name, before, after in inplaceOps():
+		nb, _, tb = measure(before)
+		na, _, ta = measure(after)
+		print("%-16s %14u %14u %12.3f %12.3f" % (name, nb, na, tb, ta))
+
+def benchThingUpdate(nThings=1000, useQuat=False):
+	root = scene.Thing()
+	for i in range(nThings):
+		t = scene.Thing()
+		t.linVel = linal.Vec3(1., 0., 0.)
+		t.angVel = linal.Vec3(0., 0.1, 1.)
+		t.useQuat(useQuat)
+		root.children.append(t)
+	allocs, peak, us = measure(lambda: root.update(1e-3), 100)
+	print("Thing.update x%u (%s): %u allocs, %u peak bytes, %.1f us" % (nThings, "Quat" if useQuat else "Mat3", allocs, peak, us))
+
+def benchBatchIntegrator(nThings=10000):
+	root = scene.Thing()
+	for i in range(nThings):
+		t = scene.Thing()
+		t.linVel = linal.Vec3(1., 0., 0.)
+		t.angVel = linal.Vec3(0., 0.1, 1.)
+		root.children.append(t)
+	integrator = dynamics.BatchIntegrator(root)
+	recursive_s = timeit.timeit(lambda: root.update(1e-3), number=10) / 10
+	step_s = timeit.timeit(lambda: integrator.step(1e-3), number=10) / 10
+	update_s = timeit.timeit(lambda: integrator.update(1e-3), number=10) / 10
+	print("x%u: Thing.update %.2f ms, BatchIntegrator.step %.2f ms, .update (with write-back) %.2f ms" % (nThings, 1e3 * recursive_s, 1e3 * step_s, 1e3 * update_s))
+
+def benchParallel(nSubtrees=1000, nPerSubtree=100, workerCounts=(1, 2, 4, 8, 16)):
+	# BatchIntegrator.step vs. ParallelIntegrator.step across worker counts,
+	# for a root with nSubtrees independent subtrees
+	root = scene.Thing()
+	for i in range(nSubtrees):
+		s = scene.Thing()
+		root.children.append(s)
+		for j in range(nPerSubtree):
+			t = scene.Thing()
+			t.linVel = linal.Vec3(1., 0., 0.)
+			t.angVel = linal.Vec3(0., 0.1, 1.)
+			s.children.append(t)
+	n = 1 + nSubtrees * (1 + nPerSubtree)
+	serial = dynamics.BatchIntegrator(root)
+	serial_s = timeit.timeit(lambda: serial.step(1e-3), number=10) / 10
+	print("x%u on %u cores: BatchIntegrator.step %.1f ms" % (n, multiprocessing.cpu_count(), 1e3 * serial_s))
+	for nWorkers in workerCounts:
+		parallel = dynamics.ParallelIntegrator(root, nWorkers)
+		parallel.step(1e-3)
+		step_s = timeit.timeit(lambda: parallel.step(1e-3), number=10) / 10
+		parallel.delete()
+		print("  %2u workers: ParallelIntegrator.step %.1f ms (%.2fx)" % (nWorkers, 1e3 * step_s, serial_s / step_s))
+
+def benchSimulation(nThings=1000, duration_s=10.):
+	# Headless fixed-step throughput, and per-frame cost of interpolation
+	root = scene.Thing()
+	for i in range(nThings):
+		t = scene.Thing()
+		t.linVel = linal.Vec3(1., 0., 0.)
+		t.angVel = linal.Vec3(0., 0.1, 1.)
+		root.children.append(t)
+	sim = dynamics.Simulation(root)
+	sim.useBatchIntegrator()
+	run_s = timeit.timeit(lambda: sim.run(duration_s), number=1)
+	sim.advance(1.5 * sim.scheduler.dt_s)
+	blend_s = timeit.timeit(lambda: (sim.blend(), sim.restore()), number=10) / 10
+	print("x%u: %u fixed steps headless in %.2f s (%.0f steps/s), blend+restore %.2f ms" % (nThings, sim.scheduler.nSteps - 1, run_s, (sim.scheduler.nSteps - 1) / run_s, 1e3 * blend_s))
+
+def benchTransforms(nThings=10000):
+	# Cost of refreshing cached world matrices for a static vs. a moving tree
+	root = scene.Thing()
+	for i in range(nThings):
+		t = scene.Thing()
+		t.position = linal.Vec3(1., 0., 0.)
+		root.children.append(t)
+	root.updateTransforms()
+	static_s = timeit.timeit(lambda: root.updateTransforms(), number=10) / 10
+	def moving():
+		root.markDirty()
+		for c in root.children:
+			c.markDirty()
+		root.updateTransforms()
+	moving_s = timeit.timeit(moving, number=10) / 10
+	print("x%u: updateTransforms static %.2f ms, all dirty %.2f ms" % (nThings, 1e3 * static_s, 1e3 * moving_s))
+
+def benchSprites(counts=(16, 256, 4096)):
+	# GL calls per frame for N individually chained Sprites vs. one SpriteBatch
+	print("%8s %14s %14s %14s %14s" % ("sprites", "draws chained", "draws batch", "calls chained", "calls batch"))
+	with MockGL() as mock:
+		for n in counts:
+			chained = scene.Thing()
+			batch = particles.SpriteBatch()
+			for i in range(n):
+				s = particles.Sprite()
+				s.position = linal.Vec3(0.01 * i, 0., 0.)
+				chained.children.append(s)
+				batch.add(s)
+			mock.reset()
+			chained.chain()
+			nChainedDraws, nChainedCalls = mock.nDrawCalls(), sum(mock.calls.values())
+			batch.chain()
+			mock.reset()
+			batch.chain()
+			print("%8u %14u %14u %14u %14u" % (n, nChainedDraws, mock.nDrawCalls(), nChainedCalls, sum(mock.calls.values())))
+
+def benchEmitter(nLive=100000, nFrames=60):
+	# Frame time of Emitter.update + render at a steady ~nLive particles
+	with MockGL():
+		e = particles.Emitter(2 * nLive)
+		e.particleLifetime_s = 1.
+		e.rate_hz = nLive / e.particleLifetime_s
+		e.acceleration = linal.Vec3(0., 0., -9.8)
+		for i in range(nFrames):
+			e.update(1. / nFrames)
+		t_s = timeit.timeit(lambda: (e.update(1. / nFrames), e.chain()), number=nFrames) / nFrames
+	print("Emitter with %u live particles: %.2f ms/frame" % (e.count, 1e3 * t_s))
+
+def benchRenderQueue(n=1000, nColors=4):
+	# GL calls per frame for Thing.chain vs. a state-sorted RenderQueue over
+	# Sprites that share one program and texture and nColors materials
+	with MockGL() as mock:
+		root = scene.Thing()
+		for i in range(n):
+			s = particles.Sprite()
+			s.material.ambient_rgb = linal.Vec3(float(i % nColors), 0., 0.)
+			root.children.append(s)
+		mock.reset()
+		root.chain()
+		nChained = sum(mock.calls.values())
+		queue = render.RenderQueue()
+		mock.reset()
+		queue.collect(root)
+		queue.draw()
+		nQueued = sum(mock.calls.values())
+	stats = queue.stats()
+	print("x%u: GL calls chained %u, queued %u; state changes issued %u, avoided %u" % (n, nChained, nQueued, sum(stats['issued'].values()), sum(stats['avoided'].values())))
+
+def benchCulling(n=10000):
+	# Draw calls and time for an unculled vs. a frustum-culled chain() over
+	# Sprites scattered around a camera that sees a fraction of them
+	camera = scene.Camera()
+	camera.eye = linal.Vec3(0., 0., 0.)
+	camera.tgt = linal.Vec3(1., 0., 0.)
+	camera.zFar = 20.
+	with MockGL() as mock:
+		root = scene.Thing()
+		for i in range(n):
+			s = particles.Sprite()
+			s.position = linal.Vec3(10. * cos(i), 10. * sin(i), 0.01 * (i % 100) - 0.5)
+			root.children.append(s)
+		stats = scene.CullStats()
+		all_s = timeit.timeit(root.chain, number=3) / 3
+		mock.reset()
+		root.chain()
+		nAll = mock.nDrawCalls()
+		culled_s = timeit.timeit(lambda: root.chainVisible(camera), number=3) / 3
+		mock.reset()
+		root.chainVisible(camera, stats)
+		nCulled = mock.nDrawCalls()
+	print("x%u: chain %u draws %.1f ms, chainVisible %u draws %.1f ms (%u drawn, %u culled)" % (n, nAll, 1e3 * all_s, nCulled, 1e3 * culled_s, stats.nDrawn, stats.nCulled))
+	
+def benchSphereMesh(counts=(32, 128, 512)):
+	# Sphere tessellation time; Spheres with the same (r, slices) reuse the
+	# result through solids.geometry, so this is paid once per distinct shape
+	for slices in counts:
+		t_s = timeit.timeit(lambda: solids.SphereGeometry.tessellate(1., slices), number=10) / 10
+		print("Sphere tessellation, %u slices (%u vertices): %.2f ms" % (slices, slices**2, 1e3 * t_s))
+		
+def benchSpatial(counts=(1000, 10000, 100000)):
+	# HashGrid build, refile after a small move, broad-phase pairs and
+	# queries for N spheres at constant density; brute-force pairs for scale
+	rng = numpy.random.default_rng(0)
+	print("%8s %10s %10s %10s %8s %10s %10s %10s %12s" % ("bodies", "build ms", "update ms", "pairs ms", "pairs", "range us", "knn us", "ray us", "brute ms"))
+	for n in counts:
+		side = n**(1. / 3)
+		positions = rng.uniform(0., 2. * side, (n, 3))
+		radii = rng.uniform(0.1, 0.5, n)
+		build_s = timeit.timeit(lambda: spatial.HashGrid(positions, radii), number=3) / 3
+		grid = spatial.HashGrid(positions, radii)
+		moved = positions + rng.normal(scale=0.05, size=positions.shape)
+		update_s = timeit.timeit(lambda: (grid.update(moved), grid.update(positions)), number=3) / 6
+		pairs_s = timeit.timeit(grid.pairs, number=3) / 3
+		center = positions[0]
+		range_s = timeit.timeit(lambda: grid.queryRange(center, 2.), number=100) / 100
+		knn_s = timeit.timeit(lambda: grid.nearest(center, 8), number=100) / 100
+		ray_s = timeit.timeit(lambda: grid.raycast((-1., side, side), (1., 0.01, 0.02)), number=100) / 100
+		if n <= 10000:
+			def brute():
+				for i in range(n):
+					d = positions[i + 1:] - positions[i]
+					numpy.flatnonzero(numpy.einsum('ij,ij->i', d, d) <= (radii[i + 1:] + radii[i])**2)
+			brute = "%12.1f" % (1e3 * timeit.timeit(brute, number=1))
+		else:
+			brute = "%12s" % "-"
+		print("%8u %10.2f %10.2f %10.2f %8u %10.1f %10.1f %10.1f %s" % (n, 1e3 * build_s, 1e3 * update_s, 1e3 * pairs_s, len(grid.pairs()), 1e6 * range_s, 1e6 * knn_s, 1e6 * ray_s, brute))
+		
+def benchProfiler(n=1000):
+	# Cost of chain() over n Sprites with the profiler disabled and enabled
+	with MockGL():
+		root = scene.Thing()
+		for i in range(n):
+			root.children.append(particles.Sprite())
+		off_s = timeit.timeit(root.chain, number=5) / 5
+		profiler.enable()
+		profiler.beginFrame()
+		on_s = timeit.timeit(root.chain, number=5) / 5
+		profiler.endFrame()
+		profiler.enable(False)
+		profiler.reset()
+	print("x%u: chain %.2f ms profiler disabled, %.2f ms enabled" % (n, 1e3 * off_s, 1e3 * on_s))
+	
+def benchStars():
+	# Per-frame GL calls and time for Star.renderCatalog vs. a StarField
+	cat = stellar.Star.getCatalog(data.get_path('sao_vm7.csv'))
+	with MockGL() as mock:
+		t_s = timeit.timeit(lambda: stellar.Star.renderCatalog(cat, 9.), number=1)
+		nCalls = sum(mock.calls.values())
+		field = stellar.StarField(cat, 9.)
+		field.render()
+		mock.reset()
+		tField_s = timeit.timeit(field.render, number=10) / 10
+		nFieldCalls = sum(mock.calls.values()) // 10
+	print("%u stars: renderCatalog %u calls %.1f ms, StarField %u calls %.3f ms" % (len(cat), nCalls, 1e3 * t_s, nFieldCalls, 1e3 * tField_s))
+
+def benchCatalog():
+	# Catalog load paths: CSV parse, cached binary sidecar, Star objects
+	name = data.get_path('sao_vm7.csv')
+	parse_s = timeit.timeit(lambda: stellar.Catalog.load(name, useCache=False), number=3) / 3
+	stellar.Catalog.load(name)
+	cached_s = timeit.timeit(lambda: stellar.Catalog.load(name), number=3) / 3
+	stars_s = timeit.timeit(lambda: stellar.Star.getCatalog(name), number=3) / 3
+	print("catalog: parse %.1f ms, cached %.2f ms, getCatalog (Star objects) %.1f ms" % (1e3 * parse_s, 1e3 * cached_s, 1e3 * stars_s))
+
+def bestTime_us(fn, number=1000, repeat=5):
+	# Best-of-repeat microseconds per call, which is steadier than a mean
+	return 1e6 * min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+def buildTree(nThings, fanout, cls=None):
+	# Tree of nThings (root included) where each node has up to fanout children
+	cls = cls or scene.Thing
+	nodes = [cls()]
+	for k in range(1, nThings):
+		t = cls()
+		t.linVel = linal.Vec3(1., 0., 0.)
+		t.angVel = linal.Vec3(0., 0.1, 1.)
+		nodes[(k - 1) // fanout].children.append(t)
+		nodes.append(t)
+	return nodes[0]
+
+def caseLinal():
+	# Vec3/Mat3 operator and in-place throughput, allocations, inv/det
+	r = {}
+	for name, before, after in inplaceOps():
+		key = name.replace(' * ', '_x_').replace(' ', '_')
+		r[key + '_us'] = bestTime_us(before)
+		r[key + '_inplace_us'] = bestTime_us(after)
+		with CountAllocations() as ca:
+			after()
+		r[key + '_inplace_allocs'] = ca.count
+	m = linal.Rot.x(0.1) * linal.Rot.y(0.2) * linal.Rot.z(0.3)
+	r['mat_inv_us'] = bestTime_us(m.inv)
+	r['mat_det_us'] = bestTime_us(m.det)
+	ms = linal.Mat3Array.fromMats([m] * 10000)
+	r['mat3array_inv_10k_us'] = bestTime_us(ms.inv, number=10)
+	return r
+
+def caseThingUpdate(sizes=(100, 1000, 10000), fanouts=(2, 16, 1000)):
+	# Recursive Thing.update per tree size and fan-out
+	r = {}
+	for n in sizes:
+		for fanout in fanouts:
+			root = buildTree(n, fanout)
+			r['update_%u_fan%u_us' % (n, fanout)] = bestTime_us(lambda: root.update(1e-3), number=max(1, 10000 // n), repeat=3)
+	return r
+
+def caseChain(sizes=(100, 1000)):
+	# GL calls, draws and time for chain()
+	r = {}
+	with MockGL() as mock:
+		for n in sizes:
+			root = buildTree(n, 16)
+			mock.reset()
+			root.chain()
+			r['chain_%u_calls' % n] = sum(mock.calls.values())
+			r['chain_%u_draws' % n] = mock.nDrawCalls()
+			r['chain_%u_us' % n] = bestTime_us(root.chain, number=3, repeat=3)
+	return r
+
+def caseSphere():
+	# Sphere construction without and with a cached geometry
+	r = {}
+	with MockGL():
+		r['tessellate_32_us'] = bestTime_us(lambda: solids.SphereGeometry.tessellate(1., 32), number=10)
+		r['tessellate_128_us'] = bestTime_us(lambda: solids.SphereGeometry.tessellate(1., 128), number=3)
+		def uncached():
+			solids.Sphere(1., 32).delete()
+		r['sphere_uncached_us'] = bestTime_us(uncached, number=10)
+		keep = solids.Sphere(1., 32)
+		r['sphere_cached_us'] = bestTime_us(lambda: solids.Sphere(1., 32), number=100)
+		keep.delete()
+		solids.geometry.geometries.clear()
+	return r
+
+def caseStars():
+	# Star.getCatalog and renderCatalog against a StarField, for the bundled
+	# catalog, and StarField epoch changes; the binary sidecar is built
+	# first, so loads are warm
+	r = {}
+	name = data.get_path('sao_vm7.csv')
+	stellar.Catalog.load(name)
+	r['catalog_load_us'] = bestTime_us(lambda: stellar.Catalog.load(name), number=3, repeat=3)
+	r['get_catalog_us'] = bestTime_us(lambda: stellar.Star.getCatalog(name), number=1, repeat=3)
+	cat = stellar.Star.getCatalog(name)
+	with MockGL() as mock:
+		mock.reset()
+		stellar.Star.renderCatalog(cat, 9.)
+		r['render_catalog_calls'] = sum(mock.calls.values())
+		r['render_catalog_us'] = bestTime_us(lambda: stellar.Star.renderCatalog(cat, 9.), number=1, repeat=3)
+		field = stellar.StarField(cat, 9.)
+		field.render()
+		mock.reset()
+		field.render()
+		r['star_field_calls'] = sum(mock.calls.values())
+		r['star_field_us'] = bestTime_us(field.render, number=10, repeat=3)
+		# Moving the whole field to a new epoch, and back to a cached one
+		def newEpoch():
+			if field.coordinates is not None:
+				field.coordinates.cache.clear()
+			field.setEpoch(field.epoch_jyr + 1.)
+		r['set_epoch_us'] = bestTime_us(newEpoch, number=10, repeat=3)
+		field.setEpoch(2000.)
+		r['set_epoch_cached_us'] = bestTime_us(lambda: field.setEpoch(2001. if field.epoch_jyr == 2000. else 2000.), number=100, repeat=3)
+	return r
+
+def caseSnapshot(n=100000):
+	# Saving a tree of n Things, opening the snapshot (memory-mapped) and
+	# building its Things, against building the same tree in code
+	r = {}
+	root = buildTree(n, 16)
+	k = n // 1000
+	path = os.path.join(tempfile.mkdtemp(), 'bench.snap')
+	try:
+		r['build_%uk_us' % k] = bestTime_us(lambda: buildTree(n, 16), number=1, repeat=2)
+		r['save_%uk_us' % k] = bestTime_us(lambda: snapshot.save(root, path), number=1, repeat=2)
+		r['open_%uk_us' % k] = bestTime_us(lambda: snapshot.Snapshot(path).getState(), number=10, repeat=3)
+		r['hydrate_%uk_us' % k] = bestTime_us(lambda: snapshot.Snapshot(path).getThing(0), number=1, repeat=2)
+	finally:
+		os.remove(path)
+		os.rmdir(os.path.dirname(path))
+	return r
+
+# Harness cases by name; each returns {metric: value}. Metric names end in
+# their unit: "_us" for times, "_calls"/"_draws"/"_allocs" for counts.
+cases = collections.OrderedDict([
+	('linal', caseLinal),
+	('scene.update', caseThingUpdate),
+	('scene.chain', caseChain),
+	('solids.sphere', caseSphere),
+	('stellar', caseStars),
+	('snapshot', caseSnapshot),
+])
+
+def runCases(pattern=None):
+	results = collections.OrderedDict()
+	for name, case in cases.items():
+		if pattern is None or pattern in name:
+			results[name] = case()
+	return results
+
+def isCount(metric):
+	return metric.endswith(('_calls', '_draws', '_allocs'))
+
+def compare(results, baseline, tolerance=0.5):
+	# Rows of (case, metric, baseline, current, ratio, isRegression). Times
+	# regress when slower by more than tolerance; counts on any increase.
+	rows = []
+	for name, metrics in results.items():
+		old = baseline.get(name, {})
+		for metric, value in metrics.items():
+			if metric not in old:
+				continue
+			base = old[metric]
+			ratio = value / base if base else (1. if value == base else float('inf'))
+			if isCount(metric):
+				isRegression = value > base
+			else:
+				isRegression = ratio > 1. + tolerance
+			rows.append((name, metric, base, value, ratio, isRegression))
+	return rows
+
+def writeResults(path, results):
+	meta = {'python': platform.python_version(), 'numpy': numpy.__version__, 'machine': platform.machine(), 'system': platform.system()}
+	with open(path, 'w') as f:
+		json.dump({'meta': meta, 'results': results}, f, indent=1)
+
+def readResults(path):
+	with open(path) as f:
+		return json.load(f)['results']
+
+def report():
+	# The descriptive benchmarks, printed as tables
+	benchInplace()
+	benchThingUpdate()
+	benchThingUpdate(useQuat=True)
+	benchBatchIntegrator()
+	benchParallel()
+	benchParallel(nSubtrees=1, nPerSubtree=100000)
+	benchSimulation()
+	benchTransforms()
+	benchSprites()
+	benchEmitter()
+	benchRenderQueue()
+	benchCulling()
+	benchSphereMesh()
+	benchProfiler()
+	benchSpatial()
+	benchStars()
+	benchCatalog()
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="hypyr benchmark harness")
+	parser.add_argument('--filter', help="only run cases whose name contains this")
+	parser.add_argument('--json', help="write results to this file")
+	parser.add_argument('--baseline', help="compare against results from --json; exits 1 on regression")
+	parser.add_argument('--tolerance', type=float, default=0.5, help="allowed fractional slowdown for times")
+	parser.add_argument('--report', action='store_true', help="run the descriptive benchmarks instead")
+	args = parser.parse_args(argv)
+	if args.report:
+		report()
+		return 0
+	results = runCases(args.filter)
+	if args.json:
+		writeResults(args.json, results)
+	if not args.baseline:
+		for name, metrics in results.items():
+			for metric, value in metrics.items():
+				print("%-14s %-32s %14.3f" % (name, metric, value))
+		return 0
+	nRegressions = 0
+	for name, metric, base, value, ratio, isRegression in compare(results, readResults(args.baseline), args.tolerance):
+		nRegressions += isRegression
+		print("%-14s %-32s %14.3f %14.3f %7.2fx %s" % (name, metric, base, value, ratio, "REGRESSION" if isRegression else ""))
+	print("%u regression(s)" % nRegressions)
+	return 1 if nRegressions else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
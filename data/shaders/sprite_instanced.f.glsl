@@ -0,0 +1,7 @@
+uniform sampler2D tex[1];
+varying vec4 color;
+
+void main() {
+	float tex = texture2D(tex[0], gl_TexCoord[0].st).r;
+	gl_FragColor = vec4(color.rgb, color.a * tex);
+}
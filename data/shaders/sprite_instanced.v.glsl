@@ -0,0 +1,16 @@
+attribute vec2 corner;
+attribute vec3 instPosition;
+attribute float instSize;
+attribute vec4 instColor;
+attribute vec4 instUv;
+varying vec4 color;
+
+void main() {
+	// Corners are offset in eye space so that every instance faces the camera
+	vec4 eye = gl_ModelViewMatrix * vec4(instPosition, 1.0);
+	eye.xy += corner * instSize;
+	gl_Position = gl_ProjectionMatrix * eye;
+	// instUv maps the unit quad onto this instance's part of the texture
+	gl_TexCoord[0] = vec4((0.5 * corner + 0.5) * instUv.xy + instUv.zw, 0.0, 1.0);
+	color = instColor;
+}
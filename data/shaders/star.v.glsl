@@ -0,0 +1,10 @@
+attribute vec3 starPosition;
+attribute vec3 starColor;
+attribute float starSize;
+varying vec3 color;
+
+void main() {
+	gl_Position = gl_ModelViewProjectionMatrix * vec4(starPosition, 1.0);
+	gl_PointSize = starSize;
+	color = starColor;
+}
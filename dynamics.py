@@ -0,0 +1,305 @@
+"""Batched rigid-body integration for large scene graphs
+"""
+
+import multiprocessing
+import numpy
+from multiprocessing import shared_memory, resource_tracker
+from hypyr import linal
+
+def flatten(root):
+	# Depth-first list of every Thing under (and including) root, with the
+	# index of each node's parent (-1 for root)
+	things = []
+	parents = []
+	stack = [(root, -1)]
+	while stack:
+		t, parent = stack.pop()
+		ndx = len(things)
+		things.append(t)
+		parents.append(parent)
+		for c in reversed(t.children):
+			stack.append((c, ndx))
+	return things, numpy.array(parents, dtype=numpy.int64)
+
+def gatherPoses(things, position, quat):
+	# Copies local positions and orientations (as quaternions) into [N x 3]
+	# and [N x 4] arrays
+	position[:] = [t.position.values for t in things]
+	quat[:] = linal.Mat3Array.fromMats([t.rotation for t in things]).toQuats()
+	for ndx, t in enumerate(things):
+		if t.quat is not None:
+			quat[ndx] = t.quat.values
+
+def scatterPoses(things, position, quat, ndxs):
+	# Writes pose rows back in place to things[ndxs], marking them dirty
+	positions = position.tolist()
+	quats = quat.tolist()
+	rotations = linal.Mat3Array.fromQuats(quat).values.tolist()
+	for ndx, p, q, r in zip(ndxs.tolist(), positions, quats, rotations):
+		t = things[ndx]
+		t.position.values[:] = p
+		t.markDirty()
+		if t.quat is not None:
+			t.quat.assign(q)
+			continue
+		r0, r1, r2 = t.rotation.values
+		r0.values[:] = r[0]
+		r1.values[:] = r[1]
+		r2.values[:] = r[2]
+
+def integrate(position, linVel, angVel, quat, dt_s):
+	# One rigid-body step over [N x 3] and [N x 4] arrays, in place
+	position += dt_s * linVel
+	w_rad_s = numpy.sqrt(numpy.einsum('ij,ij->i', angVel, angVel))
+	spinning = numpy.flatnonzero(w_rad_s * dt_s > 0)
+	if len(spinning) == 0:
+		return
+	w_rad_s = w_rad_s[spinning]
+	ang_rad = w_rad_s * dt_s
+	s = numpy.sin(0.5 * ang_rad) / w_rad_s
+	dq = numpy.empty((len(spinning), 4))
+	dq[:, 0] = numpy.cos(0.5 * ang_rad)
+	dq[:, 1:] = s[:, None] * angVel[spinning]
+	# Renormalize so that rounding does not accumulate into scale/shear
+	quat[spinning] = linal.Quat.normalizeArray(linal.Quat.productArray(dq, quat[spinning]))
+
+class BatchIntegrator(object):
+	# Struct-of-arrays alternative to Thing.update for a whole tree. State is
+	# gathered from the Things once, advanced with one NumPy step per update,
+	# and written back so that Thing.chain renders the result. Call gather()
+	# after changing a Thing's state directly, and rebuild() after changing
+	# the tree itself.
+	def __init__(self, root):
+		self.root = root
+		self.rebuild()
+
+	def rebuild(self):
+		self.things, self.parents = flatten(self.root)
+		self.allocate(len(self.things))
+		self.gather()
+
+	def allocate(self, n):
+		self.position = numpy.zeros((n, 3))
+		self.linVel = numpy.zeros((n, 3))
+		self.angVel = numpy.zeros((n, 3))
+		self.quat = numpy.zeros((n, 4))
+
+	def gather(self):
+		things = self.things
+		gatherPoses(things, self.position, self.quat)
+		self.linVel[:] = [t.linVel.values for t in things]
+		self.angVel[:] = [t.angVel.values for t in things]
+		# Only nodes with non-zero velocity need writing back after a step
+		self.moving = numpy.flatnonzero(numpy.any(self.linVel != 0., axis=1) | numpy.any(self.angVel != 0., axis=1))
+
+	def step(self, dt_s):
+		integrate(self.position, self.linVel, self.angVel, self.quat, dt_s)
+
+	def scatter(self):
+		moving = self.moving
+		scatterPoses(self.things, self.position[moving], self.quat[moving], moving)
+
+	def update(self, dt_s):
+		self.step(dt_s)
+		self.scatter()
+
+# Columns of the [N x 13] state block shared with worker processes
+stateColumns = 13
+workerBlocks = {}
+
+def attachBlock(name, n):
+	# Worker side: maps the parent's state block once per process; workers
+	# share the parent's resource tracker, which unlinks it with the parent
+	block = workerBlocks.get(name)
+	if block is None:
+		for shm, _ in workerBlocks.values():
+			shm.close()
+		workerBlocks.clear()
+		shm = shared_memory.SharedMemory(name=name)
+		block = (shm, numpy.ndarray((n, stateColumns), buffer=shm.buf))
+		workerBlocks[name] = block
+	return block[1]
+
+def integrateRange(name, n, start, end, dt_s):
+	state = attachBlock(name, n)[start:end]
+	integrate(state[:, 0:3], state[:, 3:6], state[:, 6:9], state[:, 9:13], dt_s)
+
+class ParallelIntegrator(BatchIntegrator):
+	# BatchIntegrator whose step is split across a pool of worker processes.
+	# State lives in one shared-memory block that the workers update in
+	# place, so only (range, dt) is sent per task and nothing is pickled back;
+	# results are written to the Things by scatter() as before. Each node's
+	# step only reads its own row, so the rows are cut into nWorkers equal
+	# contiguous ranges whatever the tree's shape. Call delete() to stop the
+	# pool and free the block.
+	def __init__(self, root, nWorkers=None):
+		self.nWorkers = nWorkers or multiprocessing.cpu_count()
+		self.shm = None
+		# Started first so that workers share it rather than each starting
+		# their own, which would unlink the block when the worker exits
+		resource_tracker.ensure_running()
+		self.pool = multiprocessing.Pool(self.nWorkers)
+		super(ParallelIntegrator, self).__init__(root)
+
+	def allocate(self, n):
+		self.freeBlock()
+		self.shm = shared_memory.SharedMemory(create=True, size=max(n, 1) * stateColumns * 8)
+		state = numpy.ndarray((n, stateColumns), buffer=self.shm.buf)
+		state[:] = 0.
+		self.position = state[:, 0:3]
+		self.linVel = state[:, 3:6]
+		self.angVel = state[:, 6:9]
+		self.quat = state[:, 9:13]
+		self.partitions = self.getPartitions()
+
+	def getPartitions(self):
+		# [(start, end)] row ranges, one per worker (fewer if n < nWorkers)
+		n = len(self.things)
+		bounds = numpy.linspace(0, n, self.nWorkers + 1).astype(int).tolist()
+		return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+	def step(self, dt_s):
+		n = len(self.things)
+		self.pool.starmap(integrateRange, [(self.shm.name, n, a, b, dt_s) for a, b in self.partitions])
+
+	def freeBlock(self):
+		if self.shm is not None:
+			self.position = self.linVel = self.angVel = self.quat = None
+			self.shm.close()
+			self.shm.unlink()
+			self.shm = None
+
+	def delete(self):
+		self.pool.terminate()
+		self.pool.join()
+		self.freeBlock()
+
+class FixedStepScheduler(object):
+	# Turns variable frame times into whole steps of dt_s. Leftover time is
+	# carried in an accumulator; at most maxSteps run per advance() so that a
+	# long stall cannot snowball, and any whole steps beyond that are dropped
+	# (counted in nDropped). alpha is the fraction of a step left over, for
+	# interpolating between the last two states.
+	def __init__(self, step, dt_s=1. / 120, maxSteps=8):
+		self.step = step
+		self.dt_s = dt_s
+		self.maxSteps = maxSteps
+		self.accumulator_s = 0.
+		self.time_s = 0.
+		self.nSteps = 0
+		self.nDropped = 0
+
+	def getStepCount(self, frame_s):
+		# Adds frame_s and takes out the steps now due, applying the limit;
+		# the caller runs that many runStep()s
+		self.accumulator_s += frame_s
+		n = int(self.accumulator_s // self.dt_s)
+		self.accumulator_s -= n * self.dt_s
+		if n > self.maxSteps:
+			self.nDropped += n - self.maxSteps
+			n = self.maxSteps
+		return n
+
+	def advance(self, frame_s):
+		n = self.getStepCount(frame_s)
+		for i in range(n):
+			self.runStep()
+		return n
+
+	def runStep(self):
+		self.step(self.dt_s)
+		self.time_s += self.dt_s
+		self.nSteps += 1
+
+	@property
+	def alpha(self):
+		return min(max(self.accumulator_s / self.dt_s, 0.), 1.)
+
+class Simulation(object):
+	# Fixed-timestep driver for a scene graph that needs no window or GL, so
+	# it can also run headless at full speed (see run). With interpolate set,
+	# the poses before and after the last step are kept; blend() writes the
+	# in-between pose for the current alpha before drawing and restore()
+	# puts the simulated pose back afterwards.
+	def __init__(self, root, dt_s=1. / 120, maxSteps=8, interpolate=True):
+		self.root = root
+		self.integrator = None
+		self.interpolate = interpolate
+		self.scheduler = FixedStepScheduler(self.step, dt_s, maxSteps)
+		self.rebuild()
+
+	def rebuild(self):
+		# Call after adding or removing Things
+		self.things, _ = flatten(self.root)
+		n = len(self.things)
+		self.previous = (numpy.zeros((n, 3)), numpy.zeros((n, 4)))
+		self.current = (numpy.zeros((n, 3)), numpy.zeros((n, 4)))
+		self.all = numpy.arange(n)
+		self.changed = self.all[:0]
+		gatherPoses(self.things, *self.current)
+		self.previous[0][:] = self.current[0]
+		self.previous[1][:] = self.current[1]
+		if self.integrator is not None:
+			self.integrator.rebuild()
+
+	def useBatchIntegrator(self):
+		self.integrator = BatchIntegrator(self.root)
+
+	def step(self, dt_s):
+		if self.integrator is None:
+			self.root.update(dt_s)
+		else:
+			self.integrator.update(dt_s)
+
+	def gather(self, position, quat):
+		# The integrator already holds every pose in the same (flatten) order,
+		# so its arrays are copied rather than walking the Things again
+		if self.integrator is None:
+			gatherPoses(self.things, position, quat)
+		else:
+			position[:] = self.integrator.position
+			quat[:] = self.integrator.quat
+
+	def advance(self, frame_s):
+		# Runs the steps due after frame_s seconds; returns how many ran
+		s = self.scheduler
+		n = s.getStepCount(frame_s)
+		for i in range(n):
+			if self.interpolate and i == n - 1:
+				self.gather(*self.previous)
+			s.runStep()
+		if self.interpolate and n > 0:
+			self.gather(*self.current)
+			# Only Things that moved in the last step need blending
+			p, q = self.previous, self.current
+			self.changed = numpy.flatnonzero(numpy.any(p[0] != q[0], axis=1) | numpy.any(p[1] != q[1], axis=1))
+		return n
+
+	def run(self, duration_s):
+		# Headless: steps through duration_s of simulated time at full speed
+		s = self.scheduler
+		n = int(round(duration_s / s.dt_s))
+		for i in range(n):
+			s.runStep()
+		if self.interpolate:
+			self.gather(*self.current)
+			self.previous[0][:] = self.current[0]
+			self.previous[1][:] = self.current[1]
+			self.changed = self.all[:0]
+		return n
+
+	def blend(self):
+		if not self.interpolate:
+			return
+		a = self.scheduler.alpha
+		ndxs = self.changed
+		p, q = self.previous, self.current
+		position = (1. - a) * p[0][ndxs] + a * q[0][ndxs]
+		quat = linal.Quat.slerpArray(p[1][ndxs], q[1][ndxs], a)
+		scatterPoses(self.things, position, quat, ndxs)
+
+	def restore(self):
+		if not self.interpolate:
+			return
+		ndxs = self.changed
+		scatterPoses(self.things, self.current[0][ndxs], self.current[1][ndxs], ndxs)
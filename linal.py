@@ -1,10 +1,16 @@
 """Basic linear algebra library streamlined for dynamics applications
 """
 
+import numbers
 import warnings
 from math import sqrt, acos, sin, cos
+import numpy
 from pyglet import gl
 
+# What Vec3/Mat3 operators take as scalars; the builtins come first since
+# checking the numbers.Real ABC is comparatively slow
+scalarTypes = (float, int, numbers.Real)
+
 def raw(*args):
 	return (gl.GLfloat * len(args))(*args)
 	
@@ -22,11 +28,17 @@ def getMachEps():
 	return 7./3 - 4./3 - 1.
 
 class Vec3:
+	# Fixed three-element storage; in-place methods (iadd, isub, imul,
+	# cross_into, normalize_inplace) mutate and return that storage rather than
+	# allocating a new Vec3
+	__slots__ = ('values',)
+
 	def __init__(self, x=None, y=None, z=None):
 		if x is None:
 			self.values = [0,0,0]
 		elif y is None:
-			self.values = x
+			# Copied, so that no two Vec3s share storage
+			self.values = [x[0], x[1], x[2]]
 		else:
 			self.values = [x,y,z]
 			
@@ -43,36 +55,53 @@ class Vec3:
 		self.values[index] = value
 		
 	def __add__(self, rhs):
+		a = self.values
 		if isinstance(rhs, Vec3):
-			return Vec3(self.values[0] + rhs.values[0], self.values[1] + rhs.values[1], self.values[2] + rhs.values[2])
-		else:
-			return Vec3(self.values[0] + rhs, self.values[1] + rhs, self.values[2] + rhs)
+			b = rhs.values
+			return Vec3(a[0] + b[0], a[1] + b[1], a[2] + b[2])
+		elif isinstance(rhs, scalarTypes):
+			return Vec3(a[0] + rhs, a[1] + rhs, a[2] + rhs)
+		# e.g. a Vec3Array, which handles this in __radd__
+		return NotImplemented
 
 	def __radd__(self, lhs):
 		return self + lhs
 		
 	def __sub__(self, rhs):
-		return self + (rhs * -1)
+		a = self.values
+		if isinstance(rhs, Vec3):
+			b = rhs.values
+			return Vec3(a[0] - b[0], a[1] - b[1], a[2] - b[2])
+		elif isinstance(rhs, scalarTypes):
+			return Vec3(a[0] - rhs, a[1] - rhs, a[2] - rhs)
+		return NotImplemented
 		
 	def __rsub__(self, lhs):
-		return -1 * self + lhs
+		if not isinstance(lhs, scalarTypes):
+			return NotImplemented
+		a = self.values
+		return Vec3(lhs - a[0], lhs - a[1], lhs - a[2])
+		
+	def __neg__(self):
+		a = self.values
+		return Vec3(-a[0], -a[1], -a[2])
 		
 	def __mul__(self, rhs):
 		# Scalar or dot product
+		a = self.values
 		if isinstance(rhs, Vec3):
-			return self[0] * rhs[0] + self[1] * rhs[1] + self[2] * rhs[2]
-		else:
-			return Vec3(rhs * self[0], rhs * self[1], rhs * self[2])
+			b = rhs.values
+			return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+		elif isinstance(rhs, scalarTypes):
+			return Vec3(rhs * a[0], rhs * a[1], rhs * a[2])
+		return NotImplemented
 		
 	def __rmul__(self, lhs):
 		return self * lhs
 		
 	def __pow__(self, rhs):
 		# Cross product
-		x = self[1] * rhs[2] - rhs[1] * self[2]
-		y = self[2] * rhs[0] - rhs[2] * self[0]
-		z = self[0] * rhs[1] - rhs[0] * self[1]
-		return Vec3(x,y,z)
+		return self.cross_into(rhs, Vec3())
 		
 	def __div__(self, rhs):
 		return self * (1.0 / rhs)
@@ -80,13 +109,76 @@ class Vec3:
 	def __truediv__(self, rhs):
 		return self.__div__(rhs)
 		
+	def __iadd__(self, rhs):
+		return self.iadd(rhs)
+		
+	def __isub__(self, rhs):
+		return self.isub(rhs)
+		
+	def __imul__(self, rhs):
+		if isinstance(rhs, Vec3):
+			# Dot product does not produce a Vec3, so it cannot be in-place
+			return NotImplemented
+		return self.imul(rhs)
+		
+	def __itruediv__(self, rhs):
+		return self.imul(1.0 / rhs)
+		
+	def assign(self, x, y=None, z=None):
+		# Overwrites components from another vector or from three scalars
+		a = self.values
+		if y is None:
+			a[0], a[1], a[2] = x[0], x[1], x[2]
+		else:
+			a[0], a[1], a[2] = x, y, z
+		return self
+		
+	def iadd(self, rhs, scale=1.):
+		# self += scale * rhs, where rhs may be a Vec3 or a scalar
+		a = self.values
+		if isinstance(rhs, Vec3):
+			b = rhs.values
+			a[0] += scale * b[0]
+			a[1] += scale * b[1]
+			a[2] += scale * b[2]
+		else:
+			a[0] += scale * rhs
+			a[1] += scale * rhs
+			a[2] += scale * rhs
+		return self
+		
+	def isub(self, rhs):
+		return self.iadd(rhs, -1.)
+		
+	def imul(self, rhs):
+		a = self.values
+		a[0] *= rhs
+		a[1] *= rhs
+		a[2] *= rhs
+		return self
+		
+	def cross_into(self, rhs, out):
+		# out = self x rhs; out may be self or rhs
+		a = self.values
+		b = rhs.values if isinstance(rhs, Vec3) else rhs
+		x = a[1] * b[2] - b[1] * a[2]
+		y = a[2] * b[0] - b[2] * a[0]
+		z = a[0] * b[1] - b[0] * a[1]
+		o = out.values
+		o[0], o[1], o[2] = x, y, z
+		return out
+		
 	def norm(self):
-		return sqrt(self * self)
+		a = self.values
+		return sqrt(a[0] * a[0] + a[1] * a[1] + a[2] * a[2])
 		
 	def normalize(self):
 		m = self.norm()
 		return self / m
 		
+	def normalize_inplace(self):
+		return self.imul(1.0 / self.norm())
+		
 	def dot(self, rhs):
 		return self * rhs
 		
@@ -104,19 +196,30 @@ class Vec3:
 	def ones():
 		return Vec3(1.,1.,1.)
 
-# [row][col]		
+	@staticmethod
+	def fromLists(lists):
+		# Vec3s around the given [x, y, z] lists (kept, not copied), e.g. from
+		# an [N x 3] array's tolist(); cheaper than Vec3(*xyz) for many at once
+		vecs = [Vec3.__new__(Vec3) for i in range(len(lists))]
+		for v, values in zip(vecs, lists):
+			v.values = values
+		return vecs
+
+# [row][col]; values holds three row Vec3s that live as long as the Mat3
 class Mat3:
+	__slots__ = ('values',)
+
 	def __init__(self, v00=None, v10=None, v20=None, v01=None, v11=None, v21=None, v02=None, v12=None, v22=None):
 		# Default to identity
-		self.values = [[1,0,0],[0,1,0],[0,0,1]]
+		self.values = [Vec3(1.,0.,0.), Vec3(0.,1.,0.), Vec3(0.,0.,1.)]
 		if v00 is not None:
 			if v10 is None:
 				# Single-argument constructor supports Mat3 and [[],[],[]] (the
 				# latter being a list of row vectors)
 				if isinstance(v00, Mat3):
-					self.set_row(0, v00.get_row(0))
-					self.set_row(1, v00.get_row(1))
-					self.set_row(2, v00.get_row(2))
+					self.set_row(0, v00.values[0])
+					self.set_row(1, v00.values[1])
+					self.set_row(2, v00.values[2])
 				else:
 					self.set_row(0, v00[0])
 					self.set_row(1, v00[1])
@@ -144,7 +247,8 @@ class Mat3:
 		return r1 + r2 + r3
 		
 	def __getitem__(self, row_ndx):
-		return self.get_row(row_ndx)
+		# Returns the stored row itself, so m[i][j] = x writes through
+		return self.values[row_ndx]
 		
 	def __setitem__(self, row_ndx, row_vec):
 		self.set_row(row_ndx, row_vec)
@@ -153,10 +257,10 @@ class Mat3:
 		return Vec3(self.values[ndx])
 		
 	def set_row(self, ndx, vec):
-		if isinstance(vec, Vec3):
-			self.values[ndx] = vec
-		else:
-			self.values[ndx] = Vec3(vec)
+		row = self.values[ndx].values
+		row[0] = vec[0]
+		row[1] = vec[1]
+		row[2] = vec[2]
 		
 	def get_col(self, ndx):
 		return Vec3(self.values[0][ndx], self.values[1][ndx], self.values[2][ndx])
@@ -166,28 +270,34 @@ class Mat3:
 		self.values[1][ndx] = vec[1]
 		self.values[2][ndx] = vec[2]
 		
+	def _rows(self):
+		# Flattened row-major copy of all nine values
+		a, b, c = self.values
+		return a.values + b.values + c.values
+		
 	def __add__(self, rhs):
-		return Mat3(self[0] + rhs[0], self[1] + rhs[1], self[2] + rhs[2])
+		a = self._rows()
+		b = rhs._rows()
+		return Mat3(a[0] + b[0], a[3] + b[3], a[6] + b[6], a[1] + b[1], a[4] + b[4], a[7] + b[7], a[2] + b[2], a[5] + b[5], a[8] + b[8])
 		
 	def __sub__(self, rhs):
-		return self + (rhs * -1)
+		a = self._rows()
+		b = rhs._rows()
+		return Mat3(a[0] - b[0], a[3] - b[3], a[6] - b[6], a[1] - b[1], a[4] - b[4], a[7] - b[7], a[2] - b[2], a[5] - b[5], a[8] - b[8])
 		
 	def __mul__(self, rhs):
 		if isinstance(rhs, Mat3):
 			# Matrix product
-			r0 = self.get_row(0)
-			r1 = self.get_row(1)
-			r2 = self.get_row(2)
-			c0 = rhs.get_col(0)
-			c1 = rhs.get_col(1)
-			c2 = rhs.get_col(2)
-			return Mat3(r0 * c0, r1 * c0, r2 * c0, r0 * c1, r1 * c1, r2 * c1, r0 * c2, r1 * c2, r2 * c2)
+			return self.matmul_into(rhs, Mat3())
 		elif isinstance(rhs, Vec3):
 			# Vector product
-			return Vec3(self.get_row(0) * rhs, self.get_row(1) * rhs, self.get_row(2) * rhs)
-		else:
+			return self.matmul_into(rhs, Vec3())
+		elif isinstance(rhs, scalarTypes):
 			# Scalar product
-			return Mat3(self.get_row(0) * rhs, self.get_row(1) * rhs, self.get_row(2) * rhs)
+			a = self._rows()
+			return Mat3(rhs * a[0], rhs * a[3], rhs * a[6], rhs * a[1], rhs * a[4], rhs * a[7], rhs * a[2], rhs * a[5], rhs * a[8])
+		# e.g. a Mat3Array or Vec3Array, which handle this in __rmul__
+		return NotImplemented
 		
 	def __rmul__(self, lhs):
 		if isinstance(lhs, Mat3):
@@ -197,6 +307,39 @@ class Mat3:
 		else:
 			return self * lhs
 		
+	def matmul_into(self, rhs, out):
+		# out = self * rhs for a Mat3 or Vec3 rhs (out of the same type); out
+		# may be self or rhs, as all operands are read before any are written
+		r0, r1, r2 = self.values
+		a00, a01, a02 = r0.values
+		a10, a11, a12 = r1.values
+		a20, a21, a22 = r2.values
+		if isinstance(rhs, Vec3):
+			x, y, z = rhs.values
+			o = out.values
+			o[0] = a00 * x + a01 * y + a02 * z
+			o[1] = a10 * x + a11 * y + a12 * z
+			o[2] = a20 * x + a21 * y + a22 * z
+			return out
+		b0, b1, b2 = rhs.values
+		b00, b01, b02 = b0.values
+		b10, b11, b12 = b1.values
+		b20, b21, b22 = b2.values
+		o0, o1, o2 = out.values
+		o = o0.values
+		o[0] = a00 * b00 + a01 * b10 + a02 * b20
+		o[1] = a00 * b01 + a01 * b11 + a02 * b21
+		o[2] = a00 * b02 + a01 * b12 + a02 * b22
+		o = o1.values
+		o[0] = a10 * b00 + a11 * b10 + a12 * b20
+		o[1] = a10 * b01 + a11 * b11 + a12 * b21
+		o[2] = a10 * b02 + a11 * b12 + a12 * b22
+		o = o2.values
+		o[0] = a20 * b00 + a21 * b10 + a22 * b20
+		o[1] = a20 * b01 + a21 * b11 + a22 * b21
+		o[2] = a20 * b02 + a21 * b12 + a22 * b22
+		return out
+		
 	def __pow__(self, rhs):
 		if type(rhs) == type(0):
 			lhs = Mat3(self.values)
@@ -206,7 +349,7 @@ class Mat3:
 			res = Mat3()
 			n = 0
 			while n < rhs:
-				res = res * lhs
+				res.matmul_into(lhs, res)
 				n = n + 1
 			return res
 		else:
@@ -227,7 +370,7 @@ class Mat3:
 		return self.__div__(rhs)
 		
 	def trans(self):
-		return Mat3(self.get_row(0), self.get_row(1), self.get_row(2))
+		return Mat3(self.values[0], self.values[1], self.values[2])
 		
 	def inv(self):
 		d = self.det()
@@ -240,7 +383,8 @@ class Mat3:
 		G = self[0][1] * self[1][2] - self[0][2] * self[1][1]
 		H = self[0][2] * self[1][0] - self[0][0] * self[1][2]
 		I = self[0][0] * self[1][1] - self[0][1] * self[1][0]
-		return Mat3(A, B, C, D, E, F, G, H, I).trans() / d
+		# Nine-argument order is column-major, so this is already the adjugate
+		return Mat3(A, B, C, D, E, F, G, H, I) / d
 		
 	def trace(self):
 		return self[0][0] + self[1][1] + self[2][2]
@@ -252,8 +396,8 @@ class Mat3:
 		return a - b + c
 		
 	@staticmethod
-	def fromQuat(q):
-		m = Mat3()
+	def fromQuat(q, out=None):
+		m = Mat3() if out is None else out
 		qr, qi, qj, qk = q
 		m[0][0] = 1 - 2 * qj**2 - 2 * qk**2
 		m[0][1] = 2 * (qi * qj - qk * qr)
@@ -266,6 +410,14 @@ class Mat3:
 		m[2][2] = 1 - 2 * qi**2 - 2 * qj**2
 		return m
 
+	@staticmethod
+	def fromRows(r0, r1, r2):
+		# Around three row Vec3s, kept rather than copied, without first
+		# building the identity
+		m = Mat3.__new__(Mat3)
+		m.values = [r0, r1, r2]
+		return m
+
 class Rot:
 	# Lower-case applies a rotation to a vector
 	# Upper-case is a frame transformation A => B (A + rotation = B, column vectors = unit vectors of A as evaluated in B)
@@ -297,3 +449,379 @@ class Rot:
 	def q(ang_rad, axis):
 		s = sin(0.5 * ang_rad)
 		return [cos(0.5 * ang_rad), s * axis[0], s * axis[1], s * axis[2]]
+
+
+# (r, i, j, k) unit quaternion; composes like the Mat3 it represents, so
+# Mat3.fromQuat(a * b) == Mat3.fromQuat(a) * Mat3.fromQuat(b)
+class Quat:
+	# The Mat3 and column-major 4x4 forms are computed on request and reused
+	# until the quaternion changes through one of its own methods
+	__slots__ = ('values', '_mat3', '_mat4', '_isMat3Stale', '_isMat4Stale')
+
+	def __init__(self, r=1., i=0., j=0., k=0.):
+		if isinstance(r, (int, float)):
+			self.values = [r, i, j, k]
+		else:
+			self.values = [r[0], r[1], r[2], r[3]]
+		self._mat3 = None
+		self._mat4 = None
+		self._isMat3Stale = True
+		self._isMat4Stale = True
+
+	def __len__(self):
+		return 4
+
+	def __str__(self):
+		return "(%f; %f, %f, %f)" % (self.values[0], self.values[1], self.values[2], self.values[3])
+
+	def __getitem__(self, index):
+		return self.values[index]
+
+	def __setitem__(self, index, value):
+		self.values[index] = value
+		self.touch()
+
+	def touch(self):
+		# Marks cached matrices stale; needed only after writing values directly
+		self._isMat3Stale = True
+		self._isMat4Stale = True
+
+	def assign(self, r, i=None, j=None, k=None):
+		q = self.values
+		if i is None:
+			q[0], q[1], q[2], q[3] = r[0], r[1], r[2], r[3]
+		else:
+			q[0], q[1], q[2], q[3] = r, i, j, k
+		self.touch()
+		return self
+
+	@staticmethod
+	def fromAxisAng(ang_rad, axis):
+		# Axis need not be normalized
+		s = sin(0.5 * ang_rad) / sqrt(axis[0]**2 + axis[1]**2 + axis[2]**2)
+		return Quat(cos(0.5 * ang_rad), s * axis[0], s * axis[1], s * axis[2])
+
+	@staticmethod
+	def fromMat3(m):
+		return Quat(Mat3Array.fromMats([m]).toQuats()[0].tolist())
+
+	def __mul__(self, rhs):
+		if isinstance(rhs, Quat):
+			# Composition; rhs is applied first
+			return self.mul_into(rhs, Quat())
+		elif isinstance(rhs, Vec3):
+			return self.toMat3() * rhs
+		else:
+			raise Exception("Quaternions compose only with Quat or rotate Vec3")
+
+	def mul_into(self, rhs, out):
+		# out = self * rhs; out may be self or rhs
+		ar, ai, aj, ak = self.values
+		br, bi, bj, bk = rhs.values
+		o = out.values
+		o[0] = ar * br - ai * bi - aj * bj - ak * bk
+		o[1] = ar * bi + ai * br + aj * bk - ak * bj
+		o[2] = ar * bj - ai * bk + aj * br + ak * bi
+		o[3] = ar * bk + ai * bj - aj * bi + ak * br
+		out.touch()
+		return out
+
+	def conj(self):
+		q = self.values
+		return Quat(q[0], -q[1], -q[2], -q[3])
+
+	def norm(self):
+		q = self.values
+		return sqrt(q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3])
+
+	def normalize(self):
+		return Quat(self.values).normalize_inplace()
+
+	def normalize_inplace(self):
+		q = self.values
+		m = 1.0 / sqrt(q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3])
+		q[0] *= m
+		q[1] *= m
+		q[2] *= m
+		q[3] *= m
+		self.touch()
+		return self
+
+	def slerp(self, rhs, t):
+		# Shortest-path spherical interpolation from self (t=0) to rhs (t=1)
+		a = self.values
+		b = rhs.values
+		d = a[0] * b[0] + a[1] * b[1] + a[2] * b[2] + a[3] * b[3]
+		sign = 1.
+		if d < 0:
+			sign, d = -1., -d
+		if d > 1 - 1e-6:
+			# Nearly parallel; lerp avoids dividing by sin(~0)
+			wa, wb = 1 - t, t
+		else:
+			th = acos(d)
+			wa = sin((1 - t) * th) / sin(th)
+			wb = sin(t * th) / sin(th)
+		wb *= sign
+		return Quat(wa * a[0] + wb * b[0], wa * a[1] + wb * b[1], wa * a[2] + wb * b[2], wa * a[3] + wb * b[3]).normalize_inplace()
+
+	def toMat3(self):
+		# The returned Mat3 is owned by this Quat and is updated in place
+		if self._mat3 is None:
+			self._mat3 = Mat3()
+		if self._isMat3Stale:
+			Mat3.fromQuat(self.values, self._mat3)
+			self._isMat3Stale = False
+		return self._mat3
+
+	def toMat4(self):
+		# 16 floats, column-major (as passed to glMultMatrixf), no translation
+		if self._mat4 is None:
+			self._mat4 = [0.] * 16
+			self._mat4[15] = 1.
+		if self._isMat4Stale:
+			r = self.toMat3()
+			m = self._mat4
+			m[0], m[1], m[2] = r[0][0], r[1][0], r[2][0]
+			m[4], m[5], m[6] = r[0][1], r[1][1], r[2][1]
+			m[8], m[9], m[10] = r[0][2], r[1][2], r[2][2]
+			self._isMat4Stale = False
+		return self._mat4
+
+	@staticmethod
+	def productArray(a, b):
+		# Row-wise composition a * b of two [N x 4] arrays
+		ar, ai, aj, ak = a[:, 0], a[:, 1], a[:, 2], a[:, 3]
+		br, bi, bj, bk = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+		return numpy.stack([
+			ar * br - ai * bi - aj * bj - ak * bk,
+			ar * bi + ai * br + aj * bk - ak * bj,
+			ar * bj - ai * bk + aj * br + ak * bi,
+			ar * bk + ai * bj - aj * bi + ak * br], axis=1)
+
+	@staticmethod
+	def normalizeArray(q):
+		# Renormalizes an [N x 4] array in place and returns it
+		q /= numpy.sqrt(numpy.einsum('ij,ij->i', q, q))[:, None]
+		return q
+
+	@staticmethod
+	def slerpArray(a, b, t):
+		# Row-wise slerp between two [N x 4] arrays; t is a scalar or length N
+		t = numpy.broadcast_to(numpy.asarray(t, dtype=numpy.float64), (a.shape[0],))
+		d = numpy.einsum('ij,ij->i', a, b)
+		b = numpy.where(d[:, None] < 0, -b, b)
+		d = numpy.abs(d)
+		th = numpy.arccos(numpy.minimum(d, 1.))
+		s = numpy.sin(th)
+		near = s < 1e-6
+		s[near] = 1.
+		wa = numpy.where(near, 1 - t, numpy.sin((1 - t) * th) / s)
+		wb = numpy.where(near, t, numpy.sin(t * th) / s)
+		return Quat.normalizeArray(wa[:, None] * a + wb[:, None] * b)
+
+class Vec3Array:
+	# Batch of N Vec3s held as one contiguous [N x 3] float64 array; operators
+	# follow Vec3 semantics (* is scale or row-wise dot, ** is cross product)
+	def __init__(self, n=0):
+		if isinstance(n, int):
+			self.values = numpy.zeros((n, 3))
+		else:
+			self.values = numpy.ascontiguousarray(n, dtype=numpy.float64).reshape(-1, 3)
+
+	@staticmethod
+	def fromVecs(vecs):
+		return Vec3Array([[v[0], v[1], v[2]] for v in vecs])
+
+	def toVecs(self):
+		return [Vec3(row) for row in self.values.tolist()]
+
+	def __len__(self):
+		return self.values.shape[0]
+
+	def __str__(self):
+		return str(self.values)
+
+	def __getitem__(self, index):
+		return Vec3(self.values[index].tolist())
+
+	def __setitem__(self, index, value):
+		self.values[index] = [value[0], value[1], value[2]]
+
+	def _rhs(self, rhs):
+		# Promotes rhs to something that broadcasts against [N x 3]
+		if isinstance(rhs, Vec3Array):
+			return rhs.values
+		elif isinstance(rhs, Vec3):
+			return numpy.array([rhs[0], rhs[1], rhs[2]])
+		return rhs
+
+	def __add__(self, rhs):
+		return Vec3Array(self.values + self._rhs(rhs))
+
+	def __radd__(self, lhs):
+		return self + lhs
+
+	def __sub__(self, rhs):
+		return Vec3Array(self.values - self._rhs(rhs))
+
+	def __rsub__(self, lhs):
+		return Vec3Array(self._rhs(lhs) - self.values)
+
+	def __mul__(self, rhs):
+		# Row-wise dot product against vectors, otherwise scale (a scalar or
+		# a length-N array of per-row scalars)
+		if isinstance(rhs, (Vec3Array, Vec3)):
+			return numpy.einsum('ij,ij->i', self.values, numpy.broadcast_to(self._rhs(rhs), self.values.shape))
+		rhs = numpy.asarray(rhs, dtype=numpy.float64)
+		if rhs.ndim == 1:
+			rhs = rhs[:, None]
+		return Vec3Array(self.values * rhs)
+
+	def __rmul__(self, lhs):
+		if isinstance(lhs, Mat3):
+			# The same matrix applied to every row
+			m = numpy.array([[lhs[i][j] for j in range(3)] for i in range(3)])
+			return Vec3Array(numpy.matmul(self.values, m.T))
+		return self * lhs
+
+	def __pow__(self, rhs):
+		# Row-wise cross product
+		return Vec3Array(numpy.cross(self.values, self._rhs(rhs)))
+
+	def __truediv__(self, rhs):
+		rhs = numpy.asarray(rhs, dtype=numpy.float64)
+		if rhs.ndim == 1:
+			rhs = rhs[:, None]
+		return Vec3Array(self.values / rhs)
+
+	def norm(self):
+		return numpy.sqrt(numpy.einsum('ij,ij->i', self.values, self.values))
+
+	def normalize(self):
+		# Zero-length rows are left as zero rather than becoming NaN
+		n = self.norm()
+		n[n == 0.] = 1.
+		return Vec3Array(self.values / n[:, None])
+
+	def dot(self, rhs):
+		return self * rhs
+
+	def cross(self, rhs):
+		return self ** rhs
+
+# Batch of N Mat3s, [N x 3 x 3] indexed [n][row][col] like Mat3
+class Mat3Array:
+	def __init__(self, n=0):
+		if isinstance(n, int):
+			self.values = numpy.zeros((n, 3, 3))
+			self.values[:] = numpy.eye(3)
+		else:
+			self.values = numpy.ascontiguousarray(n, dtype=numpy.float64).reshape(-1, 3, 3)
+
+	@staticmethod
+	def fromMats(mats):
+		# Row value lists are read directly; indexing element by element costs
+		# nine calls per Mat3
+		return Mat3Array([[r.values for r in m.values] for m in mats])
+
+	def toMats(self):
+		return [Mat3(rows) for rows in self.values.tolist()]
+
+	@staticmethod
+	def fromQuats(q):
+		# Batch equivalent of Mat3.fromQuat for an [N x 4] array of (r, i, j, k)
+		q = numpy.asarray(q, dtype=numpy.float64).reshape(-1, 4)
+		qr, qi, qj, qk = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+		m = numpy.empty((q.shape[0], 3, 3))
+		m[:, 0, 0] = 1 - 2 * qj**2 - 2 * qk**2
+		m[:, 0, 1] = 2 * (qi * qj - qk * qr)
+		m[:, 0, 2] = 2 * (qi * qk + qj * qr)
+		m[:, 1, 0] = 2 * (qi * qj + qk * qr)
+		m[:, 1, 1] = 1 - 2 * qi**2 - 2 * qk**2
+		m[:, 1, 2] = 2 * (qj * qk - qi * qr)
+		m[:, 2, 0] = 2 * (qi * qk - qj * qr)
+		m[:, 2, 1] = 2 * (qj * qk + qi * qr)
+		m[:, 2, 2] = 1 - 2 * qi**2 - 2 * qj**2
+		return Mat3Array(m)
+
+	def toQuats(self):
+		# Inverse of fromQuats for rotation matrices, returned as an [N x 4]
+		# array of unit (r, i, j, k); each row uses the largest of the four
+		# components as pivot to stay well-conditioned
+		m = self.values
+		n = m.shape[0]
+		t = numpy.trace(m, axis1=1, axis2=2)
+		d = numpy.stack([t, m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]], axis=1)
+		pivot = numpy.argmax(d, axis=1)
+		q = numpy.empty((n, 4))
+		i = pivot == 0
+		s = 2 * numpy.sqrt(1 + t[i])
+		q[i] = numpy.stack([0.25 * s, (m[i, 2, 1] - m[i, 1, 2]) / s, (m[i, 0, 2] - m[i, 2, 0]) / s, (m[i, 1, 0] - m[i, 0, 1]) / s], axis=1)
+		i = pivot == 1
+		s = 2 * numpy.sqrt(1 + m[i, 0, 0] - m[i, 1, 1] - m[i, 2, 2])
+		q[i] = numpy.stack([(m[i, 2, 1] - m[i, 1, 2]) / s, 0.25 * s, (m[i, 0, 1] + m[i, 1, 0]) / s, (m[i, 0, 2] + m[i, 2, 0]) / s], axis=1)
+		i = pivot == 2
+		s = 2 * numpy.sqrt(1 - m[i, 0, 0] + m[i, 1, 1] - m[i, 2, 2])
+		q[i] = numpy.stack([(m[i, 0, 2] - m[i, 2, 0]) / s, (m[i, 0, 1] + m[i, 1, 0]) / s, 0.25 * s, (m[i, 1, 2] + m[i, 2, 1]) / s], axis=1)
+		i = pivot == 3
+		s = 2 * numpy.sqrt(1 - m[i, 0, 0] - m[i, 1, 1] + m[i, 2, 2])
+		q[i] = numpy.stack([(m[i, 1, 0] - m[i, 0, 1]) / s, (m[i, 0, 2] + m[i, 2, 0]) / s, (m[i, 1, 2] + m[i, 2, 1]) / s, 0.25 * s], axis=1)
+		return q
+
+	def __len__(self):
+		return self.values.shape[0]
+
+	def __str__(self):
+		return str(self.values)
+
+	def __getitem__(self, index):
+		return Mat3(self.values[index].tolist())
+
+	def __setitem__(self, index, mat):
+		self.values[index] = [[mat[i][j] for j in range(3)] for i in range(3)]
+
+	def _rhs(self, rhs):
+		if isinstance(rhs, Mat3Array):
+			return rhs.values
+		elif isinstance(rhs, Mat3):
+			return numpy.array([[rhs[i][j] for j in range(3)] for i in range(3)])
+		return rhs
+
+	def __add__(self, rhs):
+		return Mat3Array(self.values + self._rhs(rhs))
+
+	def __sub__(self, rhs):
+		return Mat3Array(self.values - self._rhs(rhs))
+
+	def __mul__(self, rhs):
+		if isinstance(rhs, (Mat3Array, Mat3)):
+			# Matrix products, broadcasting a single Mat3 across the batch
+			return Mat3Array(numpy.matmul(self.values, self._rhs(rhs)))
+		elif isinstance(rhs, Vec3Array):
+			return Vec3Array(numpy.einsum('nij,nj->ni', self.values, rhs.values))
+		elif isinstance(rhs, Vec3):
+			return Vec3Array(numpy.einsum('nij,j->ni', self.values, numpy.array([rhs[0], rhs[1], rhs[2]])))
+		rhs = numpy.asarray(rhs, dtype=numpy.float64)
+		if rhs.ndim == 1:
+			rhs = rhs[:, None, None]
+		return Mat3Array(self.values * rhs)
+
+	def __rmul__(self, lhs):
+		if isinstance(lhs, Mat3):
+			return Mat3Array(numpy.matmul(self._rhs(lhs), self.values))
+		elif isinstance(lhs, (Vec3, Vec3Array)):
+			raise Exception("[3x1] cannot be multiplied by [3x3]; inner dimensions must match")
+		return self * lhs
+
+	def trans(self):
+		return Mat3Array(self.values.transpose(0, 2, 1))
+
+	def det(self):
+		return numpy.linalg.det(self.values)
+
+	def inv(self):
+		return Mat3Array(numpy.linalg.inv(self.values))
+
+	def trace(self):
+		return numpy.trace(self.values, axis1=1, axis2=2)
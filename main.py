@@ -5,7 +5,8 @@ from math import pi, sin, cos, sqrt
 from random import random
 from pyglet import gl, window, image, resource, clock, text, event, app
 from os import path
-from hypyr import particles, linal, shader, scene, data, solids
+from hypyr import particles, linal, shader, scene, data, solids, dynamics, render, spatial, textures
+from hypyr.profiler import profiler
 
 class HypyrApp(window.Window):
 	def __init__(self):
@@ -16,6 +17,13 @@ class HypyrApp(window.Window):
 			super(HypyrApp, self).__init__(resizable=True)
 		self.scene = scene.Thing()
 		self.camera = scene.Camera()
+		self.integrator = None
+		self.simulation = None
+		self.renderQueue = None
+		self.cullStats = scene.CullStats()
+		self.spatialIndex = None
+		self.picked = None
+		self.overlay = text.Label("", font_size=10, x=8, y=8, width=480, multiline=True, anchor_y='bottom', color=(255, 255, 0, 255))
 		clock.schedule(self.update)
 		self.setupOpenGL()
 		
@@ -39,14 +47,99 @@ class HypyrApp(window.Window):
 		gl.glMatrixMode(gl.GL_MODELVIEW)
 		return event.EVENT_HANDLED
 
+	def useBatchIntegrator(self):
+		# Switches scene updates to one vectorized step over the whole tree;
+		# call again after adding or removing Things
+		if self.simulation is not None:
+			self.simulation.useBatchIntegrator()
+		else:
+			self.integrator = dynamics.BatchIntegrator(self.scene)
+
+	def useFixedStep(self, dt_s=1. / 120, maxSteps=8):
+		# Steps the scene in fixed increments of dt_s, however long frames
+		# take, and draws poses interpolated between the last two steps; call
+		# again after adding or removing Things
+		isBatched = self.integrator is not None
+		self.integrator = None
+		self.simulation = dynamics.Simulation(self.scene, dt_s, maxSteps)
+		if isBatched:
+			self.simulation.useBatchIntegrator()
+
+	def useRenderQueue(self):
+		# Draws through a state-sorted render queue instead of Thing.chain
+		self.renderQueue = render.RenderQueue()
+
+	def useSpatialIndex(self):
+		# Keeps a spatial index of the scene for proximity queries and mouse
+		# picking; call again after adding or removing Things
+		self.spatialIndex = spatial.SceneIndex(self.scene)
+
+	def useProfiler(self, isEnabled=True):
+		# Times update and draw stages and counts per-frame work, shown as an
+		# overlay; toggled with P, and T writes a Chrome trace
+		profiler.enable(isEnabled)
+
 	def update(self, dt):
-		self.scene.update(dt)
+		# A profiler frame spans one update and the draw that follows it
+		profiler.endFrame()
+		profiler.beginFrame()
+		with profiler.scope('HypyrApp.update'):
+			textures.loader.poll()
+			if self.simulation is not None:
+				with profiler.scope('Simulation.advance'):
+					self.simulation.advance(dt)
+			elif self.integrator is None:
+				with profiler.scope('Thing.update'):
+					self.scene.update(dt)
+			else:
+				self.integrator.update(dt)
+			if self.spatialIndex is not None:
+				self.spatialIndex.update()
+
+	def on_mouse_press(self, x, y, button, modifiers):
+		if self.spatialIndex is not None:
+			self.picked = self.spatialIndex.pick(self.camera, x, y, self.width, self.height)
 
 	def on_draw(self):
 		gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
 		gl.glLoadIdentity()
 		self.camera.apply()
-		self.scene.chain()
+		self.cullStats.reset()
+		if self.simulation is not None:
+			self.simulation.blend()
+		if self.renderQueue is None:
+			with profiler.scope('Thing.chain'):
+				self.scene.chainVisible(self.camera, self.cullStats)
+		else:
+			with profiler.scope('RenderQueue.collect'):
+				self.renderQueue.collect(self.scene, self.camera.getFrustum(), self.cullStats)
+			with profiler.scope('RenderQueue.draw'):
+				self.renderQueue.draw()
+		if self.simulation is not None:
+			self.simulation.restore()
+		if profiler.enabled:
+			profiler.count('nodes visited', self.cullStats.nVisited)
+			profiler.count('nodes culled', self.cullStats.nCulled)
+			self.drawOverlay()
+
+	def drawOverlay(self):
+		# Profiler summary of the previous frames in window coordinates
+		self.overlay.text = "\n".join(profiler.getSummary())
+		gl.glMatrixMode(gl.GL_PROJECTION)
+		gl.glPushMatrix()
+		gl.glLoadIdentity()
+		gl.glOrtho(0, self.width, 0, self.height, -1, 1)
+		gl.glMatrixMode(gl.GL_MODELVIEW)
+		gl.glPushMatrix()
+		gl.glLoadIdentity()
+		gl.glDisable(gl.GL_DEPTH_TEST)
+		gl.glDisable(gl.GL_LIGHTING)
+		self.overlay.draw()
+		gl.glEnable(gl.GL_DEPTH_TEST)
+		gl.glPopMatrix()
+		gl.glMatrixMode(gl.GL_PROJECTION)
+		gl.glPopMatrix()
+		gl.glMatrixMode(gl.GL_MODELVIEW)
 
 	def on_key_press(self, symbol, modifiers):
 		k = window.key
@@ -68,14 +161,21 @@ class HypyrApp(window.Window):
 			self.camera.zoom(0.9)
 		elif symbol == k.MINUS:
 			self.camera.zoom(1.1)
+		elif symbol == k.P:
+			self.useProfiler(not profiler.enabled)
+		elif symbol == k.T:
+			profiler.exportTrace('hypyr_trace.json')
 
 if __name__ == "__main__":
 	a = HypyrApp()
 	a.camera.eye = linal.Vec3(3., -1., 1.)
+	sprites = particles.SpriteBatch()
 	for i in range(16):
 		s = particles.Sprite()
 		s.position = linal.Vec3((i/8.-1.),random()-0.5,random()-0.5)
 		s.material.ambient_rgb = linal.Vec3(random(),random(),random())
 		s.size = 0.1 * random()
-		a.scene.children.append(s)
+		sprites.add(s)
+	a.scene.children.append(sprites)
+	a.useFixedStep()
 	app.run()
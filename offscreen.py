@@ -0,0 +1,307 @@
+"""Offscreen rendering of camera paths to image sequences, with asynchronous readback
+Run "python -m hypyr.offscreen --help" to render a scene snapshot headless
+(EGL); as a library, set pyglet.options['headless'] before pyglet.gl is
+first imported to render without a display.
+"""
+
+import pyglet
+if __name__ == "__main__":
+	# Must precede the first import of pyglet.gl
+	pyglet.options['shadow_window'] = False
+	pyglet.options['headless'] = True
+import argparse
+import collections
+import ctypes
+import os
+import queue
+import threading
+import numpy
+from math import sin, cos, pi
+from pyglet import gl, image, window
+from hypyr import linal, scene, solids, snapshot, textures
+from hypyr.profiler import profiler
+
+class Framebuffer(object):
+	# Framebuffer object with RGBA8 color and 24-bit depth renderbuffers. With
+	# samples > 0, drawing goes to a multisampled pair that resolve() blits
+	# into the single-sampled one that is read back.
+	def __init__(self, width, height, samples=0):
+		self.width = width
+		self.height = height
+		self.fbo, self.renderbuffers = self.create(0)
+		self.msaa = self.create(samples) if samples else None
+
+	def create(self, samples):
+		fbo = gl.GLuint(0)
+		gl.glGenFramebuffers(1, ctypes.byref(fbo))
+		gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, fbo)
+		renderbuffers = (gl.GLuint * 2)()
+		gl.glGenRenderbuffers(2, renderbuffers)
+		for rb, internalFormat, attachment in ((renderbuffers[0], gl.GL_RGBA8, gl.GL_COLOR_ATTACHMENT0), (renderbuffers[1], gl.GL_DEPTH_COMPONENT24, gl.GL_DEPTH_ATTACHMENT)):
+			gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, rb)
+			gl.glRenderbufferStorageMultisample(gl.GL_RENDERBUFFER, samples, internalFormat, self.width, self.height)
+			gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, attachment, gl.GL_RENDERBUFFER, rb)
+		gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, 0)
+		status = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+		gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+		if status != gl.GL_FRAMEBUFFER_COMPLETE:
+			raise RuntimeError("Incomplete framebuffer (status 0x%x, %u samples)" % (status, samples))
+		return fbo.value, renderbuffers
+
+	def bind(self):
+		# Directs drawing here and sets the viewport to cover the framebuffer
+		gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.msaa[0] if self.msaa else self.fbo)
+		gl.glViewport(0, 0, self.width, self.height)
+
+	def resolve(self):
+		# Leaves the finished image bound for reading
+		if self.msaa:
+			gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.msaa[0])
+			gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, self.fbo)
+			gl.glBlitFramebuffer(0, 0, self.width, self.height, 0, 0, self.width, self.height, gl.GL_COLOR_BUFFER_BIT, gl.GL_NEAREST)
+		gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.fbo)
+
+	def unbind(self):
+		gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+	def delete(self):
+		for fbo, renderbuffers in [(self.fbo, self.renderbuffers)] + ([self.msaa] if self.msaa else []):
+			gl.glDeleteRenderbuffers(2, renderbuffers)
+			gl.glDeleteFramebuffers(1, (gl.GLuint * 1)(fbo))
+
+class PixelReader(object):
+	# Ring of pixel pack buffers. read() starts a copy of the current read
+	# framebuffer into the next buffer and returns at once; a buffer is only
+	# mapped once the ring wraps around to it, nBuffers - 1 frames later, by
+	# which time the GPU has normally finished the copy, so readback overlaps
+	# the drawing of the frames in between instead of stalling on each one.
+	def __init__(self, width, height, nBuffers=3):
+		self.width = width
+		self.height = height
+		self.nBytes = 4 * width * height
+		ids = (gl.GLuint * nBuffers)()
+		gl.glGenBuffers(nBuffers, ids)
+		for id in ids:
+			gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, id)
+			gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, self.nBytes, None, gl.GL_STREAM_READ)
+		gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+		self.ids = list(ids)
+		self.free = collections.deque(self.ids)
+		self.pending = collections.deque()
+
+	def read(self, tag):
+		# Queues a read of the whole framebuffer under tag; returns the frames
+		# that finished to make room, as (tag, [H x W x 4] uint8) with rows
+		# bottom-up
+		done = []
+		if not self.free:
+			done.append(self.finishOldest())
+		id = self.free.popleft()
+		gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, id)
+		gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+		gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
+		gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+		self.pending.append((tag, id))
+		return done
+
+	def finishOldest(self):
+		tag, id = self.pending.popleft()
+		gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, id)
+		ptr = gl.glMapBufferRange(gl.GL_PIXEL_PACK_BUFFER, 0, self.nBytes, gl.GL_MAP_READ_BIT)
+		pixels = numpy.frombuffer(ctypes.string_at(ptr, self.nBytes), dtype=numpy.uint8).reshape(self.height, self.width, 4)
+		gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+		gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+		self.free.append(id)
+		return tag, pixels
+
+	def flush(self):
+		# Every frame still in flight, oldest first
+		return [self.finishOldest() for _ in range(len(self.pending))]
+
+	def delete(self):
+		gl.glDeleteBuffers(len(self.ids), (gl.GLuint * len(self.ids))(*self.ids))
+
+class FrameWriter(object):
+	# Writes frames from background threads, as PNG (through pyglet's image
+	# encoders) or as raw RGBA8 bytes with rows top-down. At most maxQueued
+	# frames wait; write() blocks beyond that, so a slow disk or encoder
+	# throttles rendering instead of filling memory. An error on a writer
+	# thread is raised by the next write() or close().
+	def __init__(self, directory, pattern='frame%05u', format='png', nThreads=1, maxQueued=8):
+		if format not in ('png', 'raw'):
+			raise ValueError("Unknown frame format %s" % format)
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.directory = directory
+		self.pattern = pattern
+		self.format = format
+		self.queue = queue.Queue(maxQueued)
+		self.error = None
+		self.nWritten = 0
+		self.lock = threading.Lock()
+		self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(nThreads)]
+		for t in self.threads:
+			t.start()
+
+	def getPath(self, index):
+		return os.path.join(self.directory, (self.pattern % index) + '.' + self.format)
+
+	def write(self, index, pixels):
+		# pixels is [H x W x 4] uint8 RGBA with rows bottom-up, as read back
+		if self.error is not None:
+			raise self.error
+		self.queue.put((index, pixels))
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			try:
+				if self.error is None:
+					self.encode(*item)
+					with self.lock:
+						self.nWritten += 1
+			except Exception as e:
+				self.error = e
+
+	def encode(self, index, pixels):
+		path = self.getPath(index)
+		if self.format == 'raw':
+			with open(path, 'wb') as f:
+				f.write(numpy.ascontiguousarray(pixels[::-1]).tobytes())
+		else:
+			h, w = pixels.shape[:2]
+			image.ImageData(w, h, 'RGBA', pixels.tobytes()).save(path)
+
+	def close(self):
+		# Waits for every queued frame to be written
+		for _ in self.threads:
+			self.queue.put(None)
+		for t in self.threads:
+			t.join()
+		if self.error is not None:
+			raise self.error
+
+class OffscreenRenderer(object):
+	# Draws a scene graph through a camera into a Framebuffer and reads the
+	# frames back through a PixelReader, much as HypyrApp.on_draw does on
+	# screen. Needs a current GL context, e.g. a hidden (or headless) window.
+	def __init__(self, root, camera, width, height, samples=0, nBuffers=3):
+		self.root = root
+		self.camera = camera
+		self.width = width
+		self.height = height
+		self.simulation = None
+		self.cullStats = scene.CullStats()
+		camera.yFov_rad = camera.xFov_rad * height / width
+		self.framebuffer = Framebuffer(width, height, samples)
+		self.reader = PixelReader(width, height, nBuffers)
+
+	def setupOpenGL(self):
+		gl.glClearColor(0., 0., 0., 1.)
+		gl.glEnable(gl.GL_DEPTH_TEST)
+		gl.glEnable(gl.GL_BLEND)
+		gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+	def drawFrame(self):
+		self.framebuffer.bind()
+		gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+		self.camera.apply()
+		self.cullStats.reset()
+		if self.simulation is not None:
+			self.simulation.blend()
+		with profiler.scope('Thing.chain'):
+			self.root.chainVisible(self.camera, self.cullStats)
+		if self.simulation is not None:
+			self.simulation.restore()
+		self.framebuffer.resolve()
+
+	def render(self, poses, writer, dt_s=0.):
+		# Draws one frame per (eye, tgt) camera pose, advancing the scene by
+		# dt_s before each (through self.simulation if set), and hands frames
+		# to writer.write(index, pixels) as their readback completes. Textures
+		# are loaded fully first, so no frame shows a placeholder. Returns the
+		# number of frames.
+		self.setupOpenGL()
+		textures.loader.finish()
+		nFrames = 0
+		for index, (eye, tgt) in enumerate(poses):
+			profiler.endFrame()
+			profiler.beginFrame()
+			self.camera.eye = linal.Vec3(eye)
+			self.camera.tgt = linal.Vec3(tgt)
+			if dt_s > 0.:
+				if self.simulation is not None:
+					self.simulation.advance(dt_s)
+				else:
+					self.root.update(dt_s)
+			self.drawFrame()
+			with profiler.scope('PixelReader.read'):
+				done = self.reader.read(index)
+			for tag, pixels in done:
+				writer.write(tag, pixels)
+			nFrames += 1
+		for tag, pixels in self.reader.flush():
+			writer.write(tag, pixels)
+		profiler.endFrame()
+		self.framebuffer.unbind()
+		return nFrames
+
+	def delete(self):
+		self.framebuffer.delete()
+		self.reader.delete()
+
+def orbit(tgt, radius, height, nFrames, nTurns=1.):
+	# (eye, tgt) poses circling tgt in the xy plane at height above it
+	for i in range(nFrames):
+		a_rad = 2. * pi * nTurns * i / nFrames
+		yield linal.Vec3(tgt[0] + radius * cos(a_rad), tgt[1] + radius * sin(a_rad), tgt[2] + height), linal.Vec3(tgt)
+
+def demoScene():
+	root = scene.Thing()
+	light = scene.Light()
+	light.position = linal.Vec3(4., -4., 4.)
+	root.children.append(light)
+	for i in range(8):
+		s = solids.Sphere(0.3)
+		a_rad = 2. * pi * i / 8
+		s.position = linal.Vec3(1.5 * cos(a_rad), 1.5 * sin(a_rad), 0.)
+		s.material.diffuse_rgb = linal.Vec3(0.5 + 0.5 * cos(a_rad), 0.5 + 0.5 * sin(a_rad), 0.5)
+		root.children.append(s)
+	return root
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="python -m hypyr.offscreen", description="Renders an orbit around a scene to an image sequence")
+	parser.add_argument('directory', help="output directory")
+	parser.add_argument('--scene', help="scene snapshot (see hypyr.snapshot); a demo scene otherwise")
+	parser.add_argument('--frames', type=int, default=120)
+	parser.add_argument('--size', default='640x480', help="WIDTHxHEIGHT")
+	parser.add_argument('--samples', type=int, default=4, help="multisampling (0 for none)")
+	parser.add_argument('--radius', type=float, default=4.)
+	parser.add_argument('--height', type=float, default=1.)
+	parser.add_argument('--dt', type=float, default=0., help="seconds the scene advances per frame")
+	parser.add_argument('--format', choices=('png', 'raw'), default='png')
+	parser.add_argument('--threads', type=int, default=2, help="writer threads")
+	parser.add_argument('--buffers', type=int, default=3, help="pixel buffers in the readback ring")
+	args = parser.parse_args(argv)
+	width, height = [int(v) for v in args.size.lower().split('x')]
+	# The window only provides the context; it is never shown
+	context = window.Window(width=width, height=height, visible=False)
+	root = snapshot.load(args.scene) if args.scene else demoScene()
+	camera = scene.Camera()
+	camera.zFar = 100.
+	renderer = OffscreenRenderer(root, camera, width, height, args.samples, args.buffers)
+	writer = FrameWriter(args.directory, format=args.format, nThreads=args.threads)
+	try:
+		nFrames = renderer.render(orbit((0., 0., 0.), args.radius, args.height, args.frames), writer, args.dt)
+	finally:
+		writer.close()
+		renderer.delete()
+		context.close()
+	print("%u frames (%ux%u %s) in %s" % (nFrames, width, height, args.format, args.directory))
+	return 0
+
+if __name__ == "__main__":
+	import sys
+	sys.exit(main())
@@ -1,18 +1,29 @@
 """Basic objects for managing and rendering different sprite-based particles
 """
 
+import ctypes
+import numpy
 from pyglet import gl
-from hypyr import scene, data
+from hypyr import scene, data, linal
+from hypyr.profiler import profiler
 
 class Sprite(scene.Thing):
 	isFirstPassRender = True
+	renderPass = 2
+	renderCaps = (gl.GL_DEPTH_TEST,)
 	def __init__(self):
 		super(Sprite,self).__init__()
 		self.material.addTexture(data.get_path('textures/dot.png'))
 		self.material.addShader(data.get_path('shaders/sprite.v.glsl'), data.get_path('shaders/sprite.f.glsl'))
 		self.size = 0.1
 
+	def getBoundRadius(self):
+		# Corners are +/-size along two axes
+		return 1.4142135623730951 * self.size
+
 	def render(self):
+		if profiler.enabled:
+			profiler.count('draw calls')
 		s = self.size
 		gl.glDisable(gl.GL_DEPTH_TEST)
 		gl.glDisable(gl.GL_LIGHTING)
@@ -34,11 +45,258 @@ class Sprite(scene.Thing):
 		gl.glEnable(gl.GL_LIGHTING)
 		gl.glEnable(gl.GL_DEPTH_TEST)
 	
+class SpriteBatch(scene.Thing):
+	# Draws every added Sprite with one instanced call from a single interleaved
+	# per-instance buffer (position, size, rgba, uv transform), sharing one
+	# texture and one program. Sprite positions are relative to the batch;
+	# their rotations are ignored since sprites always face the camera. Each
+	# sprite's Material.uvTransform selects its part of the batch texture, so
+	# with useAtlasPage() sprites showing different atlas images still share
+	# the one draw.
+	corners = (gl.GLfloat * 8)(-1., -1., 1., -1., -1., 1., 1., 1.)
+	renderPass = 2
+	renderCaps = (gl.GL_DEPTH_TEST,)
+	instanceStride = 12
+	
+	def __init__(self):
+		super(SpriteBatch, self).__init__()
+		self.material.addTexture(data.get_path('textures/dot.png'))
+		self.material.addShader(data.get_path('shaders/sprite_instanced.v.glsl'), data.get_path('shaders/sprite_instanced.f.glsl'))
+		self.sprites = []
+		self.instances = numpy.zeros((0, SpriteBatch.instanceStride), dtype=numpy.float32)
+		self.buffers = None
+		self.bufferCapacity = 0
+		
+	def add(self, sprite):
+		self.sprites.append(sprite)
+		return sprite
+		
+	def remove(self, sprite):
+		self.sprites.remove(sprite)
+		
+	def getBoundRadius(self):
+		r = 0.
+		for s in self.sprites:
+			r = max(r, s.position.norm() + 1.4142135623730951 * s.size)
+		return r
+		
+	def reserve(self, n):
+		# Grows the host-side instance array to hold at least n instances
+		if self.instances.shape[0] < n:
+			self.instances = numpy.zeros((max(n, 2 * self.instances.shape[0]), SpriteBatch.instanceStride), dtype=numpy.float32)
+		return self.instances
+		
+	def getInstances(self):
+		# Fills self.instances and returns how many rows are live
+		n = len(self.sprites)
+		if n == 0:
+			return 0
+		inst = self.reserve(n)
+		inst[:n, 0:3] = [s.position.values for s in self.sprites]
+		inst[:n, 3] = [s.size for s in self.sprites]
+		inst[:n, 4:7] = [s.material.ambient_rgb.values for s in self.sprites]
+		inst[:n, 7] = 1.
+		inst[:n, 8:12] = [s.material.uvTransform for s in self.sprites]
+		return n
+		
+	def useAtlasPage(self, page):
+		# Draws with an atlas page; added sprites should use regions of it
+		# (see Material.useAtlasRegion)
+		self.material.setTexture(page)
+		
+	def createBuffers(self):
+		self.buffers = (gl.GLuint * 2)()
+		gl.glGenBuffers(2, self.buffers)
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers[0])
+		gl.glBufferData(gl.GL_ARRAY_BUFFER, ctypes.sizeof(SpriteBatch.corners), SpriteBatch.corners, gl.GL_STATIC_DRAW)
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+		program = self.material.shaders[0].handle
+		self.locations = [gl.glGetAttribLocation(program, name) for name in (b'corner', b'instPosition', b'instSize', b'instColor', b'instUv')]
+		
+	def delete(self):
+		if self.buffers is not None:
+			gl.glDeleteBuffers(2, self.buffers)
+			self.buffers = None
+			self.bufferCapacity = 0
+		self.material.delete()
+		
+	def drawInstances(self, n):
+		# Uploads the first n rows of self.instances and draws them in one call
+		if self.buffers is None:
+			self.createBuffers()
+		inst = self.instances
+		nBytes = n * inst.strides[0]
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers[1])
+		if n > self.bufferCapacity:
+			# Orphan and regrow; smaller frames reuse the storage
+			self.bufferCapacity = inst.shape[0]
+			gl.glBufferData(gl.GL_ARRAY_BUFFER, self.bufferCapacity * inst.strides[0], inst.ctypes.data, gl.GL_STREAM_DRAW)
+		else:
+			gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, nBytes, inst.ctypes.data)
+		corner, position, size, color, uv = self.locations
+		stride = inst.strides[0]
+		for loc, count, offset in ((position, 3, 0), (size, 1, 12), (color, 4, 16), (uv, 4, 32)):
+			if loc >= 0:
+				gl.glEnableVertexAttribArray(loc)
+				gl.glVertexAttribPointer(loc, count, gl.GL_FLOAT, gl.GL_FALSE, stride, offset)
+				gl.glVertexAttribDivisor(loc, 1)
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers[0])
+		if corner >= 0:
+			gl.glEnableVertexAttribArray(corner)
+			gl.glVertexAttribPointer(corner, 2, gl.GL_FLOAT, gl.GL_FALSE, 0, 0)
+		gl.glDisable(gl.GL_DEPTH_TEST)
+		gl.glDisable(gl.GL_LIGHTING)
+		gl.glDrawArraysInstanced(gl.GL_TRIANGLE_STRIP, 0, 4, n)
+		if profiler.enabled:
+			profiler.count('draw calls')
+		gl.glEnable(gl.GL_LIGHTING)
+		gl.glEnable(gl.GL_DEPTH_TEST)
+		for loc in self.locations:
+			if loc >= 0:
+				gl.glVertexAttribDivisor(loc, 0)
+				gl.glDisableVertexAttribArray(loc)
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+		
+	def render(self):
+		n = self.getInstances()
+		if n > 0:
+			self.drawInstances(n)
+	
 class BgSprite(Sprite):
 	pass
 	
-class Particle(Sprite):
-	pass
+class Particle(object):
+	# View of one live row of an Emitter's pool; only valid until the next
+	# Emitter.update, since compaction moves rows around
+	__slots__ = ('emitter', 'index')
 	
-class Emitter(scene.Thing):
-	pass
+	def __init__(self, emitter, index):
+		self.emitter = emitter
+		self.index = index
+		
+	@property
+	def position(self):
+		return linal.Vec3(self.emitter.pos[self.index].tolist())
+		
+	@property
+	def velocity(self):
+		return linal.Vec3(self.emitter.vel[self.index].tolist())
+		
+	@property
+	def age_s(self):
+		return float(self.emitter.age_s[self.index])
+		
+	@property
+	def size(self):
+		return float(self.emitter.size[self.index])
+		
+	@property
+	def color(self):
+		return self.emitter.color[self.index].tolist()
+	
+class Emitter(SpriteBatch):
+	# Fixed-capacity particle pool. State lives in preallocated arrays whose
+	# first "count" rows are the live particles; expired particles are removed
+	# by moving the last live rows into their slots, so nothing is allocated
+	# per particle. Particles are spawned at the emitter origin and live in its
+	# local frame.
+	def __init__(self, capacity=100000):
+		super(Emitter, self).__init__()
+		self.capacity = capacity
+		self.count = 0
+		self.pos = numpy.zeros((capacity, 3))
+		self.vel = numpy.zeros((capacity, 3))
+		self.age_s = numpy.zeros(capacity)
+		self.lifetime_s = numpy.zeros(capacity)
+		self.size = numpy.zeros(capacity, dtype=numpy.float32)
+		self.color = numpy.zeros((capacity, 4), dtype=numpy.float32)
+		# Spawn parameters; spreads are standard deviations about the mean
+		self.rate_hz = 100.
+		self.particleLifetime_s = 2.
+		self.lifetimeSpread_s = 0.
+		self.particleVelocity = linal.Vec3(0., 0., 1.)
+		self.velocitySpread = 0.2
+		self.particleSize = 0.02
+		self.particleColor = linal.Vec3.ones()
+		self.acceleration = linal.Vec3()
+		self.spawnDebt = 0.
+		self.random = numpy.random.default_rng()
+		self.particleUv = scene.Material.identityUv
+		self.reserve(capacity)
+		
+	def particle(self, index):
+		if not 0 <= index < self.count:
+			raise IndexError("Particle index out of range")
+		return Particle(self, index)
+		
+	def spawn(self, n):
+		# Initializes up to n new particles; returns how many fit in the pool
+		n = min(n, self.capacity - self.count)
+		if n <= 0:
+			return 0
+		i, j = self.count, self.count + n
+		rng = self.random
+		self.pos[i:j] = 0.
+		self.vel[i:j] = self.particleVelocity.values
+		self.vel[i:j] += rng.normal(0., self.velocitySpread, (n, 3))
+		self.age_s[i:j] = 0.
+		self.lifetime_s[i:j] = self.particleLifetime_s
+		if self.lifetimeSpread_s > 0:
+			self.lifetime_s[i:j] += rng.normal(0., self.lifetimeSpread_s, n)
+			numpy.maximum(self.lifetime_s[i:j], 1e-3, out=self.lifetime_s[i:j])
+		self.size[i:j] = self.particleSize
+		self.color[i:j, 0:3] = self.particleColor.values
+		self.color[i:j, 3] = 1.
+		self.count = j
+		return n
+		
+	def kill(self, dead):
+		# Swap-removes the live rows flagged in the boolean array dead
+		n = self.count
+		nAlive = n - int(numpy.count_nonzero(dead))
+		holes = numpy.flatnonzero(dead[:nAlive])
+		donors = nAlive + numpy.flatnonzero(~dead[nAlive:n])
+		for a in (self.pos, self.vel, self.age_s, self.lifetime_s, self.size, self.color):
+			a[holes] = a[donors]
+		self.count = nAlive
+		
+	def update(self, dt_s):
+		super(Emitter, self).update(dt_s)
+		n = self.count
+		if n > 0:
+			self.age_s[:n] += dt_s
+			dead = self.age_s[:n] >= self.lifetime_s[:n]
+			if dead.any():
+				self.kill(dead)
+				n = self.count
+			a = self.acceleration.values
+			if a[0] or a[1] or a[2]:
+				self.vel[:n] += dt_s * numpy.array(a)
+			self.pos[:n] += dt_s * self.vel[:n]
+		self.spawnDebt += self.rate_hz * dt_s
+		nSpawn = int(self.spawnDebt)
+		self.spawnDebt -= nSpawn
+		self.spawn(nSpawn)
+		
+	def getBoundRadius(self):
+		n = self.count
+		if n == 0:
+			return 0.
+		p = self.pos[:n]
+		return float(numpy.sqrt(numpy.einsum('ij,ij->i', p, p)).max() + 1.4142135623730951 * self.size[:n].max())
+		
+	def getInstances(self):
+		n = self.count
+		inst = self.instances
+		inst[:n, 0:3] = self.pos[:n]
+		inst[:n, 3] = self.size[:n]
+		inst[:n, 4:8] = self.color[:n]
+		# Fade out over each particle's life
+		inst[:n, 7] *= 1. - self.age_s[:n] / self.lifetime_s[:n]
+		inst[:n, 8:12] = self.particleUv
+		return n
+		
+	def useAtlasRegion(self, region):
+		# Draws every particle with one atlas image
+		self.material.setTexture(region.page)
+		self.particleUv = region.uvTransform
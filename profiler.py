@@ -0,0 +1,183 @@
+"""Frame profiler with scoped timers, per-frame counters and Chrome trace export
+"""
+
+import collections
+import ctypes
+import json
+import os
+import time
+import numpy
+from pyglet import gl
+
+class NullScope(object):
+	# Returned by Profiler.scope while disabled, so that "with" costs one call
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+nullScope = NullScope()
+
+class Scope(object):
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		self.t0 = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.profiler.addSpan(self.name, self.t0, time.perf_counter())
+		return False
+
+class GpuTimer(object):
+	# GL_TIME_ELAPSED queries around each frame, kept in a small ring so that
+	# results are read a few frames late instead of stalling the pipeline
+	def __init__(self, nQueries=4):
+		ids = (gl.GLuint * nQueries)()
+		gl.glGenQueries(nQueries, ids)
+		self.ids = list(ids)
+		self.pending = collections.deque()
+		self.free = collections.deque(self.ids)
+
+	def begin(self):
+		if not self.free:
+			return False
+		id = self.free.popleft()
+		gl.glBeginQuery(gl.GL_TIME_ELAPSED, id)
+		self.pending.append(id)
+		return True
+
+	def end(self):
+		gl.glEndQuery(gl.GL_TIME_ELAPSED)
+
+	def poll(self):
+		# Elapsed ms of the oldest finished query, or None if none is ready
+		if not self.pending:
+			return None
+		id = self.pending[0]
+		available = gl.GLint(0)
+		gl.glGetQueryObjectiv(id, gl.GL_QUERY_RESULT_AVAILABLE, ctypes.byref(available))
+		if not available.value:
+			return None
+		elapsed_ns = gl.GLuint64(0)
+		gl.glGetQueryObjectui64v(id, gl.GL_QUERY_RESULT, ctypes.byref(elapsed_ns))
+		self.free.append(self.pending.popleft())
+		return 1e-6 * elapsed_ns.value
+
+	def delete(self):
+		ids = (gl.GLuint * len(self.ids))(*self.ids)
+		gl.glDeleteQueries(len(self.ids), ids)
+
+class Profiler(object):
+	# Collects named timings (ms) and counts per frame between beginFrame()
+	# and endFrame(), keeping the last historyLength frames for statistics
+	# and a bounded list of trace events for export. Everything is a no-op
+	# while disabled; hot paths should still test "enabled" before doing any
+	# work of their own to feed it.
+	def __init__(self, historyLength=240, maxTraceEvents=200000):
+		self.enabled = False
+		self.history = collections.deque(maxlen=historyLength)
+		self.trace = collections.deque(maxlen=maxTraceEvents)
+		self.gpuTimer = None
+		self.origin_s = time.perf_counter()
+		self.frame = None
+		self.nFrames = 0
+
+	def enable(self, isEnabled=True):
+		self.enabled = isEnabled
+		if not isEnabled:
+			self.frame = None
+
+	def useGpuTimer(self, nQueries=4):
+		# Needs a current GL context with timer query support
+		self.gpuTimer = GpuTimer(nQueries)
+
+	def scope(self, name):
+		# Times a "with" block as a span of its own in the frame and trace
+		if not self.enabled:
+			return nullScope
+		return Scope(self, name)
+
+	def addSpan(self, name, t0_s, t1_s):
+		self.addTime(name, t1_s - t0_s)
+		self.trace.append({'name': name, 'ph': 'X', 'ts': 1e6 * (t0_s - self.origin_s), 'dur': 1e6 * (t1_s - t0_s), 'pid': os.getpid(), 'tid': 0})
+
+	def addTime(self, name, dt_s):
+		# Accumulates time without a trace event, for many short calls
+		if self.frame is not None:
+			times = self.frame['times']
+			times[name] = times.get(name, 0.) + 1e3 * dt_s
+
+	def count(self, name, n=1):
+		if self.frame is not None:
+			counts = self.frame['counts']
+			counts[name] = counts.get(name, 0) + n
+
+	def beginFrame(self):
+		if not self.enabled:
+			return
+		self.frame = {'t0_s': time.perf_counter(), 'times': {}, 'counts': {}}
+		if self.gpuTimer is not None:
+			self.frame['gpuQuery'] = self.gpuTimer.begin()
+
+	def endFrame(self):
+		frame = self.frame
+		if frame is None:
+			return
+		t1_s = time.perf_counter()
+		if self.gpuTimer is not None:
+			if frame.pop('gpuQuery'):
+				self.gpuTimer.end()
+			gpu_ms = self.gpuTimer.poll()
+			if gpu_ms is not None:
+				frame['times']['gpu'] = gpu_ms
+		self.addSpan('frame', frame['t0_s'], t1_s)
+		ts = 1e6 * (t1_s - self.origin_s)
+		for name, n in frame['counts'].items():
+			self.trace.append({'name': name, 'ph': 'C', 'ts': ts, 'pid': os.getpid(), 'args': {name: n}})
+		self.history.append(frame)
+		self.nFrames += 1
+		self.frame = None
+
+	def getSeries(self, name):
+		# Per-frame values of a timing (or, failing that, a count) over history
+		return numpy.array([f['times'].get(name, f['counts'].get(name, 0)) for f in self.history], dtype=float)
+
+	def getHistogram(self, name='frame', nBins=16):
+		# (counts, bin edges) of a timing over the rolling history
+		return numpy.histogram(self.getSeries(name), bins=nBins)
+
+	def getSummary(self):
+		# Text lines: mean/p95/max per timing, mean per count, and a histogram
+		# of frame times as a row of characters
+		if not self.history:
+			return ["profiler: no frames"]
+		last = self.history[-1]
+		lines = ["%u frames" % len(self.history)]
+		for name in sorted(last['times'].keys()):
+			s = self.getSeries(name)
+			lines.append("%-20s %7.2f ms  p95 %7.2f  max %7.2f" % (name, s.mean(), numpy.percentile(s, 95), s.max()))
+		for name in sorted(last['counts'].keys()):
+			lines.append("%-20s %9.0f" % (name, self.getSeries(name).mean()))
+		counts, edges = self.getHistogram('frame')
+		levels = " .:-=+*#%@"
+		scaled = numpy.ceil((len(levels) - 1) * counts / max(counts.max(), 1)).astype(int)
+		lines.append("frame %5.1f [%s] %5.1f ms" % (edges[0], "".join(levels[i] for i in scaled), edges[-1]))
+		return lines
+
+	def exportTrace(self, path):
+		# Writes the recorded spans and counters in Chrome's trace event format
+		# (chrome://tracing, Perfetto)
+		with open(path, 'w') as f:
+			json.dump({'traceEvents': list(self.trace), 'displayTimeUnit': 'ms'}, f)
+
+	def reset(self):
+		self.history.clear()
+		self.trace.clear()
+		self.frame = None
+		self.nFrames = 0
+
+profiler = Profiler()
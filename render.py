@@ -0,0 +1,167 @@
+"""Render queue that sorts draws by GL state and skips redundant state changes
+"""
+
+import collections
+from pyglet import gl
+from hypyr.linal import raw
+from hypyr.scene import Material
+from hypyr.profiler import profiler
+
+class StateTracker(object):
+	# Shadows the GL state that materials set (program, per-unit textures,
+	# capabilities, material colors) and forwards only real changes to GL.
+	# Counters of issued and avoided changes are kept per category and frame.
+	def __init__(self):
+		self.issued = collections.Counter()
+		self.avoided = collections.Counter()
+		self.invalidate()
+
+	def invalidate(self):
+		# Forgets all shadowed state, e.g. after GL was touched directly
+		self.program = None
+		self.activeUnit = None
+		self.textures = {}
+		self.caps = {}
+		self.material = None
+		self.uvTransform = None
+
+	def newFrame(self):
+		# Resets the counters; state is forgotten too, as anything may have
+		# touched GL between frames
+		self.issued.clear()
+		self.avoided.clear()
+		self.invalidate()
+
+	def useProgram(self, handle):
+		if self.program == handle:
+			self.avoided['program'] += 1
+			return
+		gl.glUseProgram(handle)
+		self.program = handle
+		self.issued['program'] += 1
+
+	def setCap(self, cap, isEnabled):
+		if self.caps.get(cap) == isEnabled:
+			self.avoided['cap'] += 1
+			return
+		if isEnabled:
+			gl.glEnable(cap)
+		else:
+			gl.glDisable(cap)
+		self.caps[cap] = isEnabled
+		self.issued['cap'] += 1
+
+	def enable(self, cap):
+		self.setCap(cap, True)
+
+	def disable(self, cap):
+		self.setCap(cap, False)
+
+	def selectUnit(self, unit):
+		if self.activeUnit != unit:
+			gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+			self.activeUnit = unit
+
+	def setTextures(self, ids):
+		# Binds and enables texture ids on units 0..n-1 and disables any other
+		# unit left enabled by a previous material
+		for unit, id in enumerate(ids):
+			if self.textures.get(unit) == id:
+				self.avoided['texture'] += 1
+				continue
+			self.selectUnit(unit)
+			gl.glEnable(gl.GL_TEXTURE_2D)
+			gl.glBindTexture(gl.GL_TEXTURE_2D, id)
+			self.textures[unit] = id
+			self.issued['texture'] += 1
+		for unit in sorted(self.textures.keys()):
+			if unit >= len(ids) and self.textures[unit] != 0:
+				self.selectUnit(unit)
+				gl.glDisable(gl.GL_TEXTURE_2D)
+				self.textures[unit] = 0
+				self.issued['texture'] += 1
+
+	def setUvTransform(self, uvTransform):
+		# Texture matrix of unit 0
+		if self.uvTransform == uvTransform:
+			self.avoided['uv'] += 1
+			return
+		self.selectUnit(0)
+		Material.loadUvTransform(uvTransform)
+		self.uvTransform = uvTransform
+		self.issued['uv'] += 1
+
+	def setMaterial(self, ambient, diffuse, specular, shininess):
+		key = (tuple(ambient), tuple(diffuse), tuple(specular), shininess)
+		if self.material == key:
+			self.avoided['material'] += 1
+			return
+		a, d, s = key[0], key[1], key[2]
+		gl.glMaterialfv(gl.GL_FRONT_AND_BACK, gl.GL_AMBIENT, raw(a[0], a[1], a[2], 1.))
+		gl.glMaterialfv(gl.GL_FRONT_AND_BACK, gl.GL_DIFFUSE, raw(d[0], d[1], d[2], 1.))
+		gl.glMaterialfv(gl.GL_FRONT_AND_BACK, gl.GL_SPECULAR, raw(s[0], s[1], s[2], 1.))
+		gl.glMaterialf(gl.GL_FRONT_AND_BACK, gl.GL_SHININESS, shininess)
+		self.material = key
+		self.issued['material'] += 1
+
+	def forget(self, caps):
+		# Marks capabilities a render() call may have changed behind our back;
+		# GL_TEXTURE_2D refers to the enable on the active texture unit
+		for cap in caps:
+			if cap == gl.GL_TEXTURE_2D:
+				if self.activeUnit is not None:
+					self.textures.pop(self.activeUnit, None)
+				else:
+					self.textures = {}
+			else:
+				self.caps.pop(cap, None)
+
+	def restore(self):
+		# Returns to the state Material.unapply leaves: no program, no textures
+		self.useProgram(0)
+		self.setUvTransform(Material.identityUv)
+		self.setTextures([])
+
+class RenderQueue(object):
+	# Collects the visible Things of a scene graph with their cached world
+	# transforms, sorts them by (pass, program, textures, material) and draws
+	# them through a StateTracker; an alternative to Thing.chain
+	def __init__(self):
+		self.items = []
+		self.state = StateTracker()
+
+	def collect(self, root, frustum=None, stats=None):
+		# With a frustum (see Camera.getFrustum), only Things inside it are queued
+		root.updateTransforms()
+		if frustum is None:
+			things = []
+			stack = [root]
+			while stack:
+				t = stack.pop()
+				things.append(t)
+				stack.extend(t.children)
+		else:
+			root.updateBounds()
+			things = root.cull(frustum, [], stats)
+		self.items = [(t.renderPass, t.material.getKey(), i, t) for i, t in enumerate(things)]
+		self.items.sort()
+
+	def draw(self):
+		# Expects the camera (view) matrix to be current on the modelview stack
+		state = self.state
+		state.newFrame()
+		for _, _, _, t in self.items:
+			gl.glPushMatrix()
+			gl.glMultMatrixf(t.worldRaw)
+			t.material.apply(state)
+			t.render()
+			state.forget(t.renderCaps)
+			gl.glPopMatrix()
+		state.restore()
+		if profiler.enabled:
+			profiler.count('state changes', sum(state.issued.values()))
+			profiler.count('shader binds', state.issued['program'])
+
+	def stats(self):
+		# Issued and avoided state changes during the last drawn frame
+		return {'issued': dict(self.state.issued), 'avoided': dict(self.state.avoided)}
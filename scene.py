@@ -1,11 +1,14 @@
 """Fundamental elements for scene management
 """
 
-from linal import Vec3, Mat3, Rot, raw
-from shader import Shader
-from pyglet import resource, gl
-from os import path
-from math import sin, cos, atan2, sqrt, pi
+from hypyr.linal import Vec3, Mat3, Quat, Rot, raw
+from hypyr.shader import registry
+from hypyr.profiler import profiler
+from hypyr.textures import loader, Texture
+import numpy
+import time
+from pyglet import gl
+from math import sin, cos, tan, atan2, sqrt, pi
 
 class Camera(object):
 	def __init__(self):
@@ -26,57 +29,165 @@ class Camera(object):
 		gl.gluLookAt(self.eye[0], self.eye[1], self.eye[2], self.tgt[0], self.tgt[1], self.tgt[2], self.up[0], self.up[1], self.up[2])
 		
 	def sphericalRotation(self, dTht_rad, dPhi_rad):
+		# Works on scalar components and writes self.eye in place
 		polarMargin_rad = 0.01
-		drXyz = self.tgt - self.eye
-		dr = drXyz.norm()
-		tht_rad = atan2(drXyz[1], drXyz[0])
-		phi_rad = atan2(drXyz[2], sqrt(drXyz[0]**2 + drXyz[1]**2))
+		t = self.tgt
+		dx, dy, dz = t[0] - self.eye[0], t[1] - self.eye[1], t[2] - self.eye[2]
+		dr = sqrt(dx**2 + dy**2 + dz**2)
+		tht_rad = atan2(dy, dx)
+		phi_rad = atan2(dz, sqrt(dx**2 + dy**2))
 		tht_rad = (tht_rad + dTht_rad) % (2 * pi)
 		phi_rad = phi_rad + dPhi_rad
 		if phi_rad > 0.5 * pi - polarMargin_rad:
 			phi_rad = 0.5 * pi - polarMargin_rad
 		if phi_rad < -0.5 * pi + polarMargin_rad:
 			phi_rad = -0.5 * pi + polarMargin_rad
-		drXyz = dr * Vec3(cos(tht_rad) * cos(phi_rad), sin(tht_rad) * cos(phi_rad), sin(phi_rad))
-		self.eye = self.tgt - drXyz
+		self.eye.assign(t[0] - dr * cos(tht_rad) * cos(phi_rad), t[1] - dr * sin(tht_rad) * cos(phi_rad), t[2] - dr * sin(phi_rad))
 		
 	def zoom(self, pct):
 		min = 0.1
-		drXyz = self.tgt - self.eye
-		dr = max(pct * drXyz.norm(), min)
-		drXyz = dr * drXyz.normalize()
-		self.eye = self.tgt - drXyz
+		t = self.tgt
+		dx, dy, dz = t[0] - self.eye[0], t[1] - self.eye[1], t[2] - self.eye[2]
+		r = sqrt(dx**2 + dy**2 + dz**2)
+		k = max(pct * r, min) / r
+		self.eye.assign(t[0] - k * dx, t[1] - k * dy, t[2] - k * dz)
 		
-class Material(object):
+	def getFrustum(self):
+		# World-space frustum matching apply(); gluPerspective is given
+		# xFov/yFov as its aspect ratio, so the horizontal extent follows that
+		e = self.eye
+		f = (self.tgt - e).normalize()
+		r = (f ** self.up).normalize()
+		u = r ** f
+		tanY = tan(0.5 * self.yFov_rad)
+		tanX = tanY * self.xFov_rad / self.yFov_rad
+		# Near and far planes, then the side planes, which pass through the eye
+		planes = [(f, -(f * e) - self.zNear), (-f, f * e + self.zFar)]
+		for tanHalf, axis in ((tanX, r), (tanY, u)):
+			c = 1. / sqrt(1. + tanHalf**2)
+			for n in (f * (tanHalf * c) - axis * c, f * (tanHalf * c) + axis * c):
+				planes.append((n, -(n * e)))
+		return Frustum([(n[0], n[1], n[2], d) for n, d in planes])
+		
+	def getPickRay(self, x, y, width, height):
+		# World-space ray (origin, unit direction) through window pixel (x, y),
+		# with pyglet's bottom-left origin
+		f = (self.tgt - self.eye).normalize()
+		r = (f ** self.up).normalize()
+		u = r ** f
+		tanY = tan(0.5 * self.yFov_rad)
+		tanX = tanY * self.xFov_rad / self.yFov_rad
+		ndcX = 2. * (x + 0.5) / width - 1.
+		ndcY = 2. * (y + 0.5) / height - 1.
+		return Vec3(self.eye), (f + r * (ndcX * tanX) + u * (ndcY * tanY)).normalize()
+		
+class Frustum(object):
+	# Convex volume bounded by planes (nx, ny, nz, d) with inward unit
+	# normals, so that n.p + d >= 0 inside
+	def __init__(self, planes):
+		self.planes = planes
+		
+	def intersectsSphere(self, center, radius):
+		# False only if the sphere lies entirely outside some plane
+		x, y, z = center
+		for nx, ny, nz, d in self.planes:
+			if nx * x + ny * y + nz * z + d < -radius:
+				return False
+		return True
+		
+class CullStats(object):
+	# Per-frame counts from a culled traversal
 	def __init__(self):
-		self.ambient_rgb = 0.1 * Vec3.ones()
-		self.diffuse_rgb = 0.6 * Vec3.ones()
-		self.specular_rgb = 0.3 * Vec3.ones()
-		self.shininess = 1.
+		self.reset()
+		
+	def reset(self):
+		self.nVisited = 0
+		self.nDrawn = 0
+		self.nCulled = 0
+		
+class Material(object):
+	identityUv = (1., 1., 0., 0.)
+	
+	def __init__(self, ambient_rgb=None, diffuse_rgb=None, specular_rgb=None, shininess=1., uvTransform=None):
+		# Colors given are kept as they are, not copied
+		self.ambient_rgb = Vec3(0.1, 0.1, 0.1) if ambient_rgb is None else ambient_rgb
+		self.diffuse_rgb = Vec3(0.6, 0.6, 0.6) if diffuse_rgb is None else diffuse_rgb
+		self.specular_rgb = Vec3(0.3, 0.3, 0.3) if specular_rgb is None else specular_rgb
+		self.shininess = shininess
 		self.textures = []
 		self.shaders = []
+		# (vertexPath, fragmentPath) per entry of shaders, for snapshots
+		self.shaderPaths = []
 		self.parameters = {}
+		# (scaleU, scaleV, offsetU, offsetV) applied to texture coordinates on
+		# unit 0, e.g. to address an atlas.AtlasRegion
+		self.uvTransform = Material.identityUv if uvTransform is None else uvTransform
 		
 	def addShader(self, vertexPath, fragmentPath):
-		with open(vertexPath, 'r') as h:
-			v = h.read()
-		with open(fragmentPath, 'r') as h:	
-			f = h.read()
-		self.shaders.append(Shader([v], [f]))
+		# Programs are shared through the registry; identical sources are only
+		# compiled once per process
+		self.shaders.append(registry.acquireFiles(vertexPath, fragmentPath))
+		self.shaderPaths.append((vertexPath, fragmentPath))
+		
+	def delete(self):
+		self.releaseShaders()
+		self.releaseTextures()
+		
+	def releaseShaders(self):
+		for s in self.shaders:
+			registry.release(s)
+		self.shaders = []
+		self.shaderPaths = []
+		
+	def releaseTextures(self):
+		# Textures from the loader are reference counted; others (atlas pages)
+		# belong to whoever created them
+		for t in self.textures:
+			if isinstance(t, Texture):
+				loader.release(t)
+		self.textures = []
 		
 	def addTexture(self, imgPath):
-		dir, file = path.split(imgPath)
-		if dir not in resource.path:
-			resource.path.append(dir)
-			resource.reindex()
-		texture = resource.texture(file)
+		# Returns at once: the texture is loaded in the background and shows
+		# a placeholder until textures.loader.poll() uploads it
+		texture = loader.acquire(imgPath)
+		self.parameters['tex[%u]' % len(self.textures)] = len(self.textures)
 		self.textures.append(texture)
-		gl.glBindTexture(texture.target, texture.id)
-		gl.glGenerateMipmap(gl.GL_TEXTURE_2D)
-		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
-		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST_MIPMAP_LINEAR)
 	
-	def apply(self):
+	def setTexture(self, texture, uvTransform=None):
+		# Replaces all textures with one on unit 0, seen through uvTransform
+		self.releaseTextures()
+		self.textures.append(texture)
+		self.parameters['tex[0]'] = 0
+		self.uvTransform = uvTransform or Material.identityUv
+		self.parameters['uvTransform'] = self.uvTransform
+		
+	def useAtlasRegion(self, region):
+		# Textures with region's atlas page, restricted to its sub-rectangle;
+		# Materials on one page then share a texture binding
+		self.setTexture(region.page, region.uvTransform)
+	
+	def getKey(self):
+		# Sort key grouping materials that need the same GL state
+		a, d, s = self.ambient_rgb, self.diffuse_rgb, self.specular_rgb
+		return (tuple(sh.handle for sh in self.shaders), tuple(t.id for t in self.textures), (a[0], a[1], a[2]), (d[0], d[1], d[2]), (s[0], s[1], s[2]), self.shininess)
+		
+	def apply(self, state=None):
+		# With a render.StateTracker, only state that differs from what is
+		# already current is sent to GL, and unapply() is not needed between
+		# draws
+		if profiler.enabled:
+			t0_s = time.perf_counter()
+			self.applyUntimed(state)
+			profiler.addTime('Material.apply', time.perf_counter() - t0_s)
+			profiler.count('material applies')
+		else:
+			self.applyUntimed(state)
+			
+	def applyUntimed(self, state=None):
+		if state is not None:
+			self.applyTracked(state)
+			return
 		gl.glEnable(gl.GL_LIGHTING)
 		for s in self.shaders:
 			s.bind()
@@ -84,14 +195,11 @@ class Material(object):
 			gl.glActiveTexture(gl.GL_TEXTURE0+i)
 			gl.glEnable(gl.GL_TEXTURE_2D)
 			gl.glBindTexture(gl.GL_TEXTURE_2D, t.id)
-			self.parameters['tex[%u]' % i] = i
-		for k in self.parameters.keys():
-			if type(self.parameters[k]) == type(0):
-				for s in self.shaders:
-					s.uniformi(k, self.parameters[k])
-			if type(self.parameters[k]) == type(0.):
-				for s in self.shaders:
-					s.uniformf(k, self.parameters[k])
+		if self.uvTransform != Material.identityUv:
+			gl.glActiveTexture(gl.GL_TEXTURE0)
+			Material.loadUvTransform(self.uvTransform)
+		for s in self.shaders:
+			s.set_uniforms(self.parameters)
 		a = self.ambient_rgb
 		d = self.diffuse_rgb
 		s = self.specular_rgb
@@ -100,7 +208,31 @@ class Material(object):
 		gl.glMaterialfv(gl.GL_FRONT_AND_BACK, gl.GL_SPECULAR, raw(s[0], s[1], s[2], 1.))
 		gl.glMaterialf(gl.GL_FRONT_AND_BACK, gl.GL_SHININESS, self.shininess)
 	
+	def applyTracked(self, state):
+		state.enable(gl.GL_LIGHTING)
+		if len(self.shaders) == 0:
+			state.useProgram(0)
+		for s in self.shaders:
+			state.useProgram(s.handle)
+			s.set_uniforms(self.parameters)
+		state.setTextures([t.id for t in self.textures])
+		state.setUvTransform(self.uvTransform)
+		state.setMaterial(self.ambient_rgb, self.diffuse_rgb, self.specular_rgb, self.shininess)
+	
+	@staticmethod
+	def loadUvTransform(uvTransform):
+		# Sets the texture matrix of the active unit
+		su, sv, ou, ov = uvTransform
+		gl.glMatrixMode(gl.GL_TEXTURE)
+		gl.glLoadIdentity()
+		gl.glTranslatef(ou, ov, 0.)
+		gl.glScalef(su, sv, 1.)
+		gl.glMatrixMode(gl.GL_MODELVIEW)
+		
 	def unapply(self):
+		if self.uvTransform != Material.identityUv:
+			gl.glActiveTexture(gl.GL_TEXTURE0)
+			Material.loadUvTransform(Material.identityUv)
 		for i in range(len(self.textures)):
 			gl.glActiveTexture(gl.GL_TEXTURE0+i)
 			gl.glDisable(gl.GL_TEXTURE_2D)
@@ -108,26 +240,221 @@ class Material(object):
 			s.unbind()
 	
 class Thing(object):
+	dRot = Mat3()
+	dQuat = Quat()
+	# Render queue ordering (lower first), and the GL capabilities render()
+	# may leave changed
+	renderPass = 1
+	renderCaps = (gl.GL_TEXTURE_2D, gl.GL_LIGHTING)
+	# Radius about the local origin that encloses what render() draws
+	boundRadius = 1.
+	
 	def __init__(self):
-		self.material = Material()
-		self.position = Vec3()
-		self.rotation = Mat3()
-		self.linVel = Vec3()
-		self.angVel = Vec3()
+		self.initState(Material(), Vec3(), Mat3(), None, Vec3(), Vec3())
+
+	@classmethod
+	def fromState(cls, material, position, rotation, quat, linVel, angVel, transforms=None):
+		# Builds a cls around the given objects (kept, not copied) without
+		# running its constructor, so only for classes that add nothing to
+		# Thing's; see snapshot.Snapshot.hydrate
+		t = cls.__new__(cls)
+		t.initState(material, position, rotation, quat, linVel, angVel, transforms)
+		return t
+
+	@staticmethod
+	def allocateTransforms(n):
+		# (localRaw, worldRaw, localT, worldT) for each of n Things, carved
+		# from one block, for building many Things at once (see fromState)
+		block = numpy.zeros((2 * n, 4, 4), dtype=numpy.float32)
+		raws = ((gl.GLfloat * 16) * (2 * n)).from_buffer(block)
+		return zip(raws[0::2], raws[1::2], block[0::2], block[1::2])
+
+	def initState(self, material, position, rotation, quat, linVel, angVel, transforms=None):
+		self.material = material
+		self._position = position
+		self._rotation = rotation
+		self._quat = quat
+		self.linVel = linVel
+		self.angVel = angVel
 		self.children = []
+		# Cached 4x4 transforms, stored column-major as glMultMatrixf expects;
+		# the numpy views are indexed [col][row] over the same memory
+		if transforms is None:
+			self.localRaw = (gl.GLfloat * 16)()
+			self.worldRaw = (gl.GLfloat * 16)()
+			self._localT = numpy.frombuffer(self.localRaw, dtype=numpy.float32).reshape(4, 4)
+			self._worldT = numpy.frombuffer(self.worldRaw, dtype=numpy.float32).reshape(4, 4)
+		else:
+			self.localRaw, self.worldRaw, self._localT, self._worldT = transforms
+		self._isLocalDirty = True
+		self._worldVersion = 0
+		self._parentKey = None
+		# World-space bounding spheres (see updateBounds)
+		self.boundCenter = (0., 0., 0.)
+		self.ownRadius = self.boundRadius
+		self.subtreeRadius = self.boundRadius
+		self.subtreeSize = 1
+	
+	@property
+	def position(self):
+		return self._position
+		
+	@position.setter
+	def position(self, p):
+		self._position = p
+		self._isLocalDirty = True
+		
+	@property
+	def rotation(self):
+		# With a quaternion orientation (see useQuat) the Mat3 is derived from
+		# it on demand; writes to that Mat3 are not carried back
+		if self._quat is None:
+			return self._rotation
+		return self._quat.toMat3()
+		
+	@rotation.setter
+	def rotation(self, m):
+		if self._quat is None:
+			self._rotation = m
+		else:
+			self._quat = Quat.fromMat3(m)
+		self._isLocalDirty = True
+		
+	@property
+	def quat(self):
+		return self._quat
+		
+	@quat.setter
+	def quat(self, q):
+		self._quat = q
+		self._isLocalDirty = True
+		
+	def useQuat(self, enable=True):
+		# Switches orientation storage between Quat and Mat3, keeping its value
+		if enable and self._quat is None:
+			self.quat = Quat.fromMat3(self._rotation)
+		elif not enable and self._quat is not None:
+			self._rotation = Mat3(self._quat.toMat3())
+			self.quat = None
+			
+	def markDirty(self):
+		# Needed only after modifying position/rotation/quat values in place
+		# from outside of update()
+		self._isLocalDirty = True
 	
 	def update(self, dt_s):
-		self.position = self.position + dt_s * self.linVel
-		ang_rad = self.angVel.norm() * dt_s
+		# Position and orientation are advanced in place; dRot and dQuat are
+		# scratch storage shared by all Things, so nothing is allocated per step
+		v = self.linVel.values
+		if v[0] or v[1] or v[2]:
+			self._position.iadd(self.linVel, dt_s)
+			self._isLocalDirty = True
+		w = self.angVel
+		angVel_rad_s = w.norm()
+		ang_rad = angVel_rad_s * dt_s
 		if ang_rad > 0:
-			axis = self.angVel.normalize()
-			q = Rot.q(ang_rad, axis)
-			self.rotation = Mat3.fromQuat(q) * self.rotation
+			s = sin(0.5 * ang_rad) / angVel_rad_s
+			if self._quat is None:
+				Mat3.fromQuat((cos(0.5 * ang_rad), s * w[0], s * w[1], s * w[2]), Thing.dRot)
+				Thing.dRot.matmul_into(self._rotation, self._rotation)
+			else:
+				# Renormalizing every step keeps long runs free of drift
+				Thing.dQuat.assign(cos(0.5 * ang_rad), s * w[0], s * w[1], s * w[2])
+				Thing.dQuat.mul_into(self._quat, self._quat).normalize_inplace()
+			self._isLocalDirty = True
 		for c in self.children:
 			c.update(dt_s)
+			
+	@property
+	def localMatrix(self):
+		# Row-major [4 x 4] view (no copy) of the cached local transform
+		self.refreshTransforms()
+		return self._localT.T
+		
+	@property
+	def worldMatrix(self):
+		# Row-major [4 x 4] view (no copy) of the cached world transform, as of
+		# the last chain()/updateTransforms() that reached this Thing
+		return self._worldT.T
+		
+	def refreshTransforms(self, parent=None):
+		# Recomputes the local matrix if this Thing moved, and the world matrix
+		# if either it or its parent's world matrix changed; returns whether
+		# the world matrix changed
+		isWorldDirty = False
+		if self._isLocalDirty:
+			p = self._position
+			r0, r1, r2 = self.rotation.values
+			m = self.localRaw
+			m[0], m[1], m[2], m[3] = r0[0], r1[0], r2[0], 0.
+			m[4], m[5], m[6], m[7] = r0[1], r1[1], r2[1], 0.
+			m[8], m[9], m[10], m[11] = r0[2], r1[2], r2[2], 0.
+			m[12], m[13], m[14], m[15] = p[0], p[1], p[2], 1.
+			self._isLocalDirty = False
+			isWorldDirty = True
+		parentKey = None if parent is None else (id(parent), parent._worldVersion)
+		if isWorldDirty or parentKey != self._parentKey:
+			if parent is None:
+				self._worldT[:] = self._localT
+			else:
+				numpy.matmul(self._localT, parent._worldT, out=self._worldT)
+			self._parentKey = parentKey
+			self._worldVersion = self._worldVersion + 1
+			isWorldDirty = True
+		return isWorldDirty
+		
+	def updateTransforms(self, parent=None):
+		# CPU-only traversal that brings every cached world matrix up to date
+		self.refreshTransforms(parent)
+		for c in self.children:
+			c.updateTransforms(self)
+			
+	def getBoundRadius(self):
+		# Overridden where the extent of render() depends on state
+		return self.boundRadius
+		
+	def updateBounds(self):
+		# Bottom-up bounding spheres centered on each world origin: ownRadius
+		# for this Thing's geometry, subtreeRadius for it and all descendants;
+		# world matrices must be current (see updateTransforms)
+		w = self._worldT[3]
+		cx, cy, cz = float(w[0]), float(w[1]), float(w[2])
+		r = self.ownRadius = self.getBoundRadius()
+		n = 1
+		for c in self.children:
+			c.updateBounds()
+			x, y, z = c.boundCenter
+			r = max(r, sqrt((x - cx)**2 + (y - cy)**2 + (z - cz)**2) + c.subtreeRadius)
+			n += c.subtreeSize
+		self.boundCenter = (cx, cy, cz)
+		self.subtreeRadius = r
+		self.subtreeSize = n
+		
+	def cull(self, frustum, visible=None, stats=None):
+		# CPU-only: appends the Things whose bounds meet frustum to visible,
+		# skipping whole subtrees outside it; bounds must be current
+		if visible is None:
+			visible = []
+		if stats is not None:
+			stats.nVisited += 1
+		if not frustum.intersectsSphere(self.boundCenter, self.subtreeRadius):
+			if stats is not None:
+				stats.nCulled += self.subtreeSize
+			return visible
+		if frustum.intersectsSphere(self.boundCenter, self.ownRadius):
+			visible.append(self)
+			if stats is not None:
+				stats.nDrawn += 1
+		elif stats is not None:
+			stats.nCulled += 1
+		for c in self.children:
+			c.cull(frustum, visible, stats)
+		return visible
 		
 	def render(self):
 		# By default, a frame renders its axis as unit RGB line segments
+		if profiler.enabled:
+			profiler.count('draw calls')
 		gl.glDisable(gl.GL_TEXTURE_2D)
 		gl.glDisable(gl.GL_LIGHTING)
 		gl.glBegin(gl.GL_LINES)
@@ -142,20 +469,43 @@ class Thing(object):
 		gl.glVertex3f(0.,0.,1.)
 		gl.glEnd()
 		
-	def chain(self):
+	def chain(self, parent=None, frustum=None, stats=None):
+		# With a frustum, Things outside it are skipped (whole subtrees where
+		# possible) using the bounds from the last updateBounds()
+		self.refreshTransforms(parent)
+		if frustum is not None:
+			if stats is not None:
+				stats.nVisited += 1
+			if not frustum.intersectsSphere(self.boundCenter, self.subtreeRadius):
+				if stats is not None:
+					stats.nCulled += self.subtreeSize
+				return
 		gl.glPushMatrix()
-		p = self.position
-		r = self.rotation
-		gl.glMultMatrixf(raw(r[0][0], r[1][0], r[2][0], 0., r[0][1], r[1][1], r[2][1], 0., r[0][2], r[1][2], r[2][2], 0., p[0], p[1], p[2], 1.))
-		self.material.apply()
-		self.render()
-		self.material.unapply()
+		gl.glMultMatrixf(self.localRaw)
+		if frustum is None or frustum.intersectsSphere(self.boundCenter, self.ownRadius):
+			self.material.apply()
+			self.render()
+			self.material.unapply()
+			if stats is not None:
+				stats.nDrawn += 1
+		elif stats is not None:
+			stats.nCulled += 1
 		for c in self.children:
-			c.chain()
+			c.chain(self, frustum, stats)
 		gl.glPopMatrix()
+		
+	def chainVisible(self, camera, stats=None):
+		# Draws this tree culled against camera's frustum
+		self.updateTransforms()
+		self.updateBounds()
+		self.chain(None, camera.getFrustum(), stats)
 
 class Light(Thing):
 	nLights = 0
+	renderPass = 0
+	renderCaps = (gl.GL_LIGHTING,)
+	# Lights affect everything, so they are never culled
+	boundRadius = float('inf')
 	
 	def __init__(self):
 		super(Light, self).__init__()
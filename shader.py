@@ -9,18 +9,84 @@
 from pyglet.gl import *
 from ctypes import *
 import sys
+import os
+import struct
+import hashlib
+from hypyr.profiler import profiler
 
 if sys.version_info.major == 3:
 	basestring = str
 
+uniformfFunctions = { 1 : glUniform1f, 2 : glUniform2f, 3 : glUniform3f, 4 : glUniform4f }
+uniformiFunctions = { 1 : glUniform1i, 2 : glUniform2i, 3 : glUniform3i, 4 : glUniform4i }
+
+# GLSL uniform type -> (array upload function, components, is matrix, element type)
+uniformTypes = {
+	GL_FLOAT : (glUniform1fv, 1, False, c_float),
+	GL_FLOAT_VEC2 : (glUniform2fv, 2, False, c_float),
+	GL_FLOAT_VEC3 : (glUniform3fv, 3, False, c_float),
+	GL_FLOAT_VEC4 : (glUniform4fv, 4, False, c_float),
+	GL_INT : (glUniform1iv, 1, False, c_int),
+	GL_INT_VEC2 : (glUniform2iv, 2, False, c_int),
+	GL_INT_VEC3 : (glUniform3iv, 3, False, c_int),
+	GL_INT_VEC4 : (glUniform4iv, 4, False, c_int),
+	GL_BOOL : (glUniform1iv, 1, False, c_int),
+	GL_BOOL_VEC2 : (glUniform2iv, 2, False, c_int),
+	GL_BOOL_VEC3 : (glUniform3iv, 3, False, c_int),
+	GL_BOOL_VEC4 : (glUniform4iv, 4, False, c_int),
+	GL_FLOAT_MAT2 : (glUniformMatrix2fv, 4, True, c_float),
+	GL_FLOAT_MAT3 : (glUniformMatrix3fv, 9, True, c_float),
+	GL_FLOAT_MAT4 : (glUniformMatrix4fv, 16, True, c_float),
+}
+for t in (GL_SAMPLER_1D, GL_SAMPLER_2D, GL_SAMPLER_3D, GL_SAMPLER_CUBE, GL_SAMPLER_1D_SHADOW, GL_SAMPLER_2D_SHADOW):
+	uniformTypes[t] = (glUniform1iv, 1, False, c_int)
+
+# flatten a uniform value (number, linal type, nested list or numpy array)
+# into a tuple of scalars, row-major
+def flatten(value):
+	if isinstance(value, (int, float)):
+		return (value,)
+	if hasattr(value, 'tolist'):
+		value = value.tolist()
+		if not isinstance(value, list):
+			return (value,)
+	elif hasattr(value, 'values'):
+		value = value.values
+	flat = []
+	for v in value:
+		flat.extend(flatten(v))
+	return tuple(flat)
+
 class Shader:
 	# vert, frag and geom take arrays of source strings
 	# the arrays will be concattenated into one string by OpenGL
-	def __init__(self, vert = [], frag = [], geom = []):
+	# binary optionally gives a (format, bytes) program binary from
+	# getBinary(); the sources are compiled only if the driver rejects it.
+	# isRetrievable asks the driver to keep the linked binary for getBinary();
+	# that needs GL 4.1 or ARB_get_program_binary, so it is off by default
+	def __init__(self, vert = [], frag = [], geom = [], binary = None, isRetrievable = False):
 		# create the program handle
 		self.handle = glCreateProgram()
 		# we are not linked yet
 		self.linked = False
+		# shader objects attached to the program, released by delete()
+		self.shaders = []
+		# active uniforms (see introspect) and the last values uploaded to them
+		self.uniforms = {}
+		self.uploaded = {}
+		# set_uniforms() counters, for profiling
+		self.nUploads = 0
+		self.nSkipped = 0
+		# whether the program was restored from binary rather than linked
+		self.isFromBinary = False
+
+		if binary is not None and self.loadBinary(*binary):
+			self.isFromBinary = True
+			return
+
+		# ask for a retrievable binary when the caller wants to cache it
+		if isRetrievable:
+			glProgramParameteri(self.handle, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
 
 		# create the vertex shader
 		self.createShader(vert, GL_VERTEX_SHADER)
@@ -67,6 +133,7 @@ class Shader:
 		else:
 			# all is well, so attach the shader to the program
 			glAttachShader(self.handle, shader);
+			self.shaders.append(shader)
 
 	def link(self):
 		# link the program
@@ -89,10 +156,48 @@ class Shader:
 		else:
 			# all is well, so we are linked
 			self.linked = True
+			self.introspect()
+
+	# try to restore a linked program from a driver-specific binary
+	def loadBinary(self, format, data):
+		try:
+			glProgramBinary(self.handle, format, data, len(data))
+		except GLException:
+			# a format this driver no longer knows
+			return False
+		temp = c_int(0)
+		glGetProgramiv(self.handle, GL_LINK_STATUS, byref(temp))
+		self.linked = bool(temp)
+		if self.linked:
+			self.introspect()
+		return self.linked
+
+	# retrieve the linked program as (format, bytes), or None if unsupported
+	def getBinary(self):
+		temp = c_int(0)
+		glGetProgramiv(self.handle, GL_PROGRAM_BINARY_LENGTH, byref(temp))
+		if not self.linked or temp.value < 1:
+			return None
+		buffer = create_string_buffer(temp.value)
+		format = c_uint(0)
+		glGetProgramBinary(self.handle, temp, None, byref(format), buffer)
+		return format.value, buffer.raw
+
+	# delete the program and its shader objects
+	def delete(self):
+		for shader in self.shaders:
+			glDetachShader(self.handle, shader)
+			glDeleteShader(shader)
+		self.shaders = []
+		glDeleteProgram(self.handle)
+		self.handle = 0
+		self.linked = False
 
 	def bind(self):
 		# bind the program
 		glUseProgram(self.handle)
+		if profiler.enabled:
+			profiler.count('shader binds')
 
 	def unbind(self):
 		# unbind whatever program is currently bound - not necessarily this program,
@@ -104,32 +209,186 @@ class Shader:
 	def uniformf(self, name, *vals):
 		# check there are 1-4 values
 		if len(vals) in range(1, 5):
-			# select the correct function
-			{ 1 : glUniform1f,
-				2 : glUniform2f,
-				3 : glUniform3f,
-				4 : glUniform4f
-				# retrieve the uniform location, and set
-			}[len(vals)](glGetUniformLocation(self.handle, name.encode('ascii')), *vals)
+			# select the correct function, and set at the cached location
+			uniformfFunctions[len(vals)](self.getLocation(name), *vals)
+			self.forget(name)
 
 	# upload an integer uniform
 	# this program must be currently bound
 	def uniformi(self, name, *vals):
 		# check there are 1-4 values
 		if len(vals) in range(1, 5):
-			# select the correct function
-			{ 1 : glUniform1i,
-				2 : glUniform2i,
-				3 : glUniform3i,
-				4 : glUniform4i
-				# retrieve the uniform location, and set
-			}[len(vals)](glGetUniformLocation(self.handle, name.encode('ascii')), *vals)
+			# select the correct function, and set at the cached location
+			uniformiFunctions[len(vals)](self.getLocation(name), *vals)
+			self.forget(name)
 
 	# upload a uniform matrix
 	# works with matrices stored as lists,
 	# as well as euclid matrices
 	def uniform_matrixf(self, name, mat):
-		# obtian the uniform location
-		loc = glGetUniformLocation(self.Handle, name)
-		# uplaod the 4x4 floating point matrix
-		glUniformMatrix4fv(loc, 1, False, (c_float * 16)(*mat))
\ No newline at end of file
+		# obtain the uniform location
+		loc = self.getLocation(name)
+		# upload the 4x4 floating point matrix
+		glUniformMatrix4fv(loc, 1, False, (c_float * 16)(*mat))
+		self.forget(name)
+
+	# drop the last-upload records that a direct upload to name may have made
+	# stale: the name itself and, for arrays, the whole array and its elements
+	def forget(self, name):
+		base = name.split('[')[0]
+		for key in [k for k in self.uploaded if k == base or k.startswith(base + '[')]:
+			del self.uploaded[key]
+
+	# build the name -> (location, type, size) table of active uniforms; arrays
+	# are entered under "name", "name[0]" and each "name[i]"
+	def introspect(self):
+		self.uniforms = {}
+		self.uploaded = {}
+		count = c_int(0)
+		glGetProgramiv(self.handle, GL_ACTIVE_UNIFORMS, byref(count))
+		maxLength = c_int(0)
+		glGetProgramiv(self.handle, GL_ACTIVE_UNIFORM_MAX_LENGTH, byref(maxLength))
+		buffer = create_string_buffer(max(maxLength.value, 1))
+		size = c_int(0)
+		type = c_uint(0)
+		for i in range(count.value):
+			glGetActiveUniform(self.handle, i, len(buffer), None, byref(size), byref(type), buffer)
+			name = buffer.value.decode('ascii')
+			if name.startswith('gl_'):
+				# built-in state, not settable
+				continue
+			location = glGetUniformLocation(self.handle, buffer.value)
+			entry = (location, type.value, size.value)
+			self.uniforms[name] = entry
+			if name.endswith('[0]'):
+				base = name[:-3]
+				self.uniforms[base] = entry
+				for j in range(1, size.value):
+					element = '%s[%u]' % (base, j)
+					location = glGetUniformLocation(self.handle, element.encode('ascii'))
+					self.uniforms[element] = (location, type.value, size.value - j)
+
+	# location of a uniform, from the introspected table where possible
+	def getLocation(self, name):
+		entry = self.uniforms.get(name)
+		if entry is not None:
+			return entry[0]
+		return glGetUniformLocation(self.handle, name.encode('ascii'))
+
+	# upload several uniforms at once from a name -> value dict; the upload
+	# function follows the GLSL type, so ints, floats, Vec3/Mat3/Quat, lists
+	# and numpy arrays all work, and arrays may be set whole by base name.
+	# Matrices are taken row-major (as Mat3 and numpy store them). Values
+	# equal to the last upload are skipped, as are inactive names. This
+	# program must be currently bound.
+	def set_uniforms(self, values):
+		uniforms = self.uniforms
+		uploaded = self.uploaded
+		nUploads = self.nUploads
+		for name, value in values.items():
+			entry = uniforms.get(name)
+			if entry is None:
+				continue
+			flat = flatten(value)
+			if uploaded.get(name) == flat:
+				self.nSkipped += 1
+				continue
+			location, type, size = entry
+			info = uniformTypes.get(type)
+			if info is None:
+				raise ValueError("Uniform %s has a GLSL type (0x%x) that set_uniforms does not support" % (name, type))
+			function, n, isMatrix, ctype = info
+			uploaded[name] = flat
+			count = min(max(len(flat) // n, 1), size)
+			data = (ctype * (count * n))(*flat[:count * n])
+			if isMatrix:
+				function(location, count, GL_TRUE, data)
+			else:
+				function(location, count, data)
+			self.nUploads += 1
+		if profiler.enabled:
+			profiler.count('uniform uploads', self.nUploads - nUploads)
+
+class ShaderRegistry:
+	# Process-wide cache of linked programs keyed by a hash of their source
+	# text, so that identical programs are compiled and linked once. Programs
+	# are reference counted and deleted when their last user releases them.
+	# With binaryDir set, linked binaries are also kept on disk (keyed by the
+	# sources and the GL renderer/version) to skip compilation on later runs.
+	def __init__(self, binaryDir = None):
+		self.programs = {}
+		self.binaryDir = binaryDir
+
+	@staticmethod
+	def getKey(vert = [], frag = [], geom = []):
+		h = hashlib.sha1()
+		for stage in (vert, frag, geom):
+			for s in stage:
+				h.update(s.encode('utf-8'))
+				h.update(b'\0')
+			h.update(b'\1')
+		return h.hexdigest()
+
+	def getBinaryPath(self, key):
+		h = hashlib.sha1(key.encode('ascii'))
+		for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+			h.update(cast(glGetString(name), c_char_p).value or b'')
+		return os.path.join(self.binaryDir, h.hexdigest() + '.bin')
+
+	def readBinary(self, key):
+		try:
+			with open(self.getBinaryPath(key), 'rb') as f:
+				data = f.read()
+		except (OSError, IOError):
+			return None
+		if len(data) < 4:
+			# truncated file; treated as a cache miss
+			return None
+		format, = struct.unpack('<I', data[:4])
+		return format, data[4:]
+
+	def writeBinary(self, key, shader):
+		binary = shader.getBinary()
+		if binary is None:
+			return
+		if not os.path.isdir(self.binaryDir):
+			os.makedirs(self.binaryDir)
+		with open(self.getBinaryPath(key), 'wb') as f:
+			f.write(struct.pack('<I', binary[0]))
+			f.write(binary[1])
+
+	# return the shared program for these sources, building it if needed;
+	# each call must be paired with a release()
+	def acquire(self, vert = [], frag = [], geom = []):
+		key = self.getKey(vert, frag, geom)
+		entry = self.programs.get(key)
+		if entry is None:
+			isCaching = self.binaryDir is not None
+			binary = self.readBinary(key) if isCaching else None
+			shader = Shader(vert, frag, geom, binary, isCaching)
+			# also rewrites binaries the driver rejected, e.g. after an update
+			if isCaching and not shader.isFromBinary:
+				self.writeBinary(key, shader)
+			shader.key = key
+			entry = [shader, 0]
+			self.programs[key] = entry
+		entry[1] += 1
+		return entry[0]
+
+	def acquireFiles(self, vertexPath, fragmentPath):
+		with open(vertexPath, 'r') as h:
+			v = h.read()
+		with open(fragmentPath, 'r') as h:
+			f = h.read()
+		return self.acquire([v], [f])
+
+	def release(self, shader):
+		entry = self.programs.get(getattr(shader, 'key', None))
+		if entry is None or entry[0] is not shader:
+			return
+		entry[1] -= 1
+		if entry[1] < 1:
+			del self.programs[shader.key]
+			shader.delete()
+
+registry = ShaderRegistry()
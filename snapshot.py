@@ -0,0 +1,347 @@
+"""Binary scene snapshots: a Thing tree in contiguous typed blocks, memory-mapped on load
+"""
+
+import collections
+import gc
+import importlib
+import itertools
+import json
+import os
+import struct
+import numpy
+from hypyr import dynamics, linal, scene, solids, particles
+from hypyr.shader import flatten
+from hypyr.textures import Texture
+
+# File layout: a header, a table of block entries, then the blocks, each
+# starting on a blockAlignment boundary. Blocks are found by name, so later
+# versions can add blocks that older readers ignore.
+magic = b'HYPS'
+formatVersion = 1
+headerFormat = '<4sIQII'
+entryFormat = '<16s8sQQQ'
+blockAlignment = 64
+
+# Per-node blocks (name, dtype, columns) in depth-first order, as from
+# dynamics.flatten, so that each subtree is a contiguous range of rows.
+# textures and shaders are (start, count) ranges into textureRefs and
+# shaderRefs, which index the strings block (a JSON list of type names and
+# paths). parameters indexes the strings block too, for Material.parameters
+# as JSON with each value flattened as set_uniforms uploads it (-1 for
+# none). detail is a second constructor argument (0 for the default);
+# detail and parameters may be missing from files written before they were
+# added.
+nodeBlocks = [
+	('parent', '<i8', 0),
+	('subtreeSize', '<i8', 0),
+	('type', '<i4', 0),
+	('flags', 'u1', 0),
+	('position', '<f8', 3),
+	('quat', '<f8', 4),
+	('linVel', '<f8', 3),
+	('angVel', '<f8', 3),
+	('size', '<f8', 0),
+	('detail', '<i8', 0),
+	('ambient', '<f8', 3),
+	('diffuse', '<f8', 3),
+	('specular', '<f8', 3),
+	('shininess', '<f8', 0),
+	('uvTransform', '<f8', 4),
+	('textures', '<i4', 2),
+	('shaders', '<i4', 2),
+	('parameters', '<i4', 0),
+]
+
+# flags bits
+useQuatFlag = 1
+
+def getTypeName(t):
+	return type(t).__module__ + '.' + type(t).__name__
+
+def getSize(t):
+	# The per-type shape parameter kept: Sphere radius or Sprite size
+	if isinstance(t, solids.Sphere):
+		return t.r
+	if isinstance(t, particles.Sprite):
+		return t.size
+	return 0.
+
+def getDetail(t):
+	# Sphere slices or Emitter capacity
+	if isinstance(t, solids.Sphere):
+		return t.slices
+	if isinstance(t, particles.Emitter):
+		return t.capacity
+	return 0
+
+def getRows(a):
+	# a.tolist(), except that when every row is the same (as with default
+	# colors) the rows share the first one's values, which is cheaper both
+	# to build and to free
+	if len(a) == 0 or not (a == a[0]).all():
+		return a.tolist()
+	first = a[0].tolist()
+	if a.ndim == 1:
+		return [first] * len(a)
+	return list(map(list.copy, itertools.repeat(first, len(a))))
+
+def getSubtreeSizes(parents):
+	sizes = [1] * len(parents)
+	for ndx in range(len(parents) - 1, 0, -1):
+		sizes[parents[ndx]] += sizes[ndx]
+	return sizes
+
+def save(root, path):
+	# Writes the tree under root to path; the file is replaced atomically.
+	# Kept per node: type, local pose, velocities, material colors, UV
+	# transform and parameters, the paths of loader textures and file
+	# shaders, and the shape parameters (Sphere radius and slices, Sprite
+	# size, Emitter capacity). Other state (batch membership, live particles,
+	# atlas pages) is not.
+	things, parents = dynamics.flatten(root)
+	n = len(things)
+	strings = []
+	stringIds = {}
+	def intern(s):
+		if s not in stringIds:
+			stringIds[s] = len(strings)
+			strings.append(s)
+		return stringIds[s]
+	blocks = collections.OrderedDict()
+	blocks['parent'] = parents
+	blocks['subtreeSize'] = getSubtreeSizes(parents.tolist())
+	blocks['type'] = [intern(getTypeName(t)) for t in things]
+	blocks['flags'] = [useQuatFlag if t.quat is not None else 0 for t in things]
+	position = numpy.empty((n, 3))
+	quat = numpy.empty((n, 4))
+	dynamics.gatherPoses(things, position, quat)
+	blocks['position'] = position
+	blocks['quat'] = quat
+	blocks['linVel'] = [t.linVel.values for t in things]
+	blocks['angVel'] = [t.angVel.values for t in things]
+	blocks['size'] = [getSize(t) for t in things]
+	blocks['detail'] = [getDetail(t) for t in things]
+	materials = [t.material for t in things]
+	blocks['ambient'] = [m.ambient_rgb.values for m in materials]
+	blocks['diffuse'] = [m.diffuse_rgb.values for m in materials]
+	blocks['specular'] = [m.specular_rgb.values for m in materials]
+	blocks['shininess'] = [m.shininess for m in materials]
+	blocks['uvTransform'] = [m.uvTransform for m in materials]
+	textures, textureRefs = [], []
+	shaders, shaderRefs = [], []
+	for m in materials:
+		paths = [tex.path for tex in m.textures if isinstance(tex, Texture)]
+		textures.append((len(textureRefs), len(paths)))
+		textureRefs.extend(intern(p) for p in paths)
+		shaders.append((len(shaderRefs), len(m.shaderPaths)))
+		shaderRefs.extend((intern(v), intern(f)) for v, f in m.shaderPaths)
+	blocks['textures'] = textures
+	blocks['shaders'] = shaders
+	blocks['parameters'] = [intern(json.dumps(dict((k, flatten(v)) for k, v in m.parameters.items()), sort_keys=True)) if m.parameters else -1 for m in materials]
+	arrays = [(name, numpy.asarray(blocks[name], dtype=dtype).reshape((n, cols) if cols else (n,))) for name, dtype, cols in nodeBlocks]
+	arrays.append(('textureRefs', numpy.array(textureRefs, dtype='<i4')))
+	arrays.append(('shaderRefs', numpy.array(shaderRefs, dtype='<i4').reshape(-1, 2)))
+	arrays.append(('strings', numpy.frombuffer(json.dumps(strings).encode('utf-8'), dtype='u1')))
+	writeBlocks(path, n, arrays)
+
+def writeBlocks(path, n, arrays):
+	align = lambda offset: (offset + blockAlignment - 1) // blockAlignment * blockAlignment
+	offset = align(struct.calcsize(headerFormat) + len(arrays) * struct.calcsize(entryFormat))
+	entries = []
+	for name, a in arrays:
+		cols = a.shape[1] if a.ndim > 1 else 0
+		entries.append(struct.pack(entryFormat, name.encode('ascii'), a.dtype.str.encode('ascii'), cols, offset, a.nbytes))
+		offset = align(offset + a.nbytes)
+	tmpPath = path + '.tmp'
+	with open(tmpPath, 'wb') as f:
+		f.write(struct.pack(headerFormat, magic, formatVersion, n, len(arrays), 0))
+		f.write(b''.join(entries))
+		for name, a in arrays:
+			f.write(b'\0' * (align(f.tell()) - f.tell()))
+			f.write(numpy.ascontiguousarray(a).tobytes())
+	os.replace(tmpPath, path)
+
+class Snapshot(object):
+	# A saved tree, memory-mapped: blocks are read-only array views into the
+	# file, so opening costs the header and nothing is read until used.
+	# getState() hands the pose arrays straight to array-based code (see
+	# dynamics.integrate); getThing() builds Things only for the subtree
+	# asked for, caching them.
+	def __init__(self, path):
+		self.path = path
+		self.map = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+		tag, version, self.nNodes, nBlocks, _ = struct.unpack_from(headerFormat, self.map)
+		if tag != magic:
+			raise ValueError("%s is not a scene snapshot" % path)
+		if version > formatVersion:
+			raise ValueError("%s has snapshot version %u; this reader supports up to %u" % (path, version, formatVersion))
+		self.blocks = {}
+		entryOffset = struct.calcsize(headerFormat)
+		for i in range(nBlocks):
+			name, dtype, cols, offset, nBytes = struct.unpack_from(entryFormat, self.map, entryOffset + i * struct.calcsize(entryFormat))
+			dtype = numpy.dtype(dtype.rstrip(b'\0').decode('ascii'))
+			a = numpy.frombuffer(self.map, dtype=dtype, count=nBytes // dtype.itemsize, offset=offset)
+			self.blocks[name.rstrip(b'\0').decode('ascii')] = a.reshape(-1, cols) if cols else a
+		self.strings = json.loads(self.blocks['strings'].tobytes().decode('utf-8'))
+		if 'detail' not in self.blocks:
+			self.blocks['detail'] = numpy.zeros(self.nNodes, dtype=numpy.int64)
+		self.classes = {}
+		self.things = {}
+
+	def __len__(self):
+		return self.nNodes
+
+	def getBlock(self, name):
+		return self.blocks[name]
+
+	def getState(self):
+		# Read-only views of parents and the [N x 3]/[N x 4] pose columns;
+		# copy before integrating in place
+		return dict((name, self.blocks[name]) for name in ('parent', 'position', 'quat', 'linVel', 'angVel'))
+
+	def getChildren(self, ndx):
+		# Node indices of ndx's direct children, without building Things
+		end = ndx + int(self.blocks['subtreeSize'][ndx])
+		parents = self.blocks['parent'][ndx + 1:end]
+		return (ndx + 1 + numpy.flatnonzero(parents == ndx)).tolist()
+
+	def getClass(self, typeId):
+		cls = self.classes.get(typeId)
+		if cls is None:
+			typeName = self.strings[typeId]
+			moduleName, _, name = typeName.rpartition('.')
+			cls = getattr(importlib.import_module(moduleName), name, None)
+			if not isinstance(cls, type) or not issubclass(cls, scene.Thing):
+				raise ValueError("%s names %s, which is not a scene.Thing type" % (self.path, typeName))
+			self.classes[typeId] = cls
+		return cls
+
+	def getThing(self, ndx=0):
+		# The Thing at node ndx with its whole subtree; building textured or
+		# shaded nodes needs a GL context, as constructing them would
+		thing = self.things.get(ndx)
+		if thing is None:
+			# Each Thing allocates a few container objects, which would set off
+			# the cyclic collector many times over a large tree; none of them
+			# are garbage yet, so it is held off until the tree is built
+			isGcEnabled = gc.isenabled()
+			gc.disable()
+			try:
+				self.hydrate(ndx, ndx + int(self.blocks['subtreeSize'][ndx]))
+			finally:
+				if isGcEnabled:
+					gc.enable()
+			thing = self.things[ndx]
+		return thing
+
+	def hydrate(self, start, end):
+		# Builds nodes start..end-1 (a whole subtree) and links their children;
+		# nodes already built by an earlier getThing() are kept. A built node's
+		# subtree is built too, so only children of new nodes need linking.
+		b = self.blocks
+		things = self.things
+		nodes = [things.get(ndx) for ndx in range(start, end)] if things else [None] * (end - start)
+		isNew = numpy.array([t is None for t in nodes], dtype=bool)
+		typeIds = b['type'][start:end]
+		rotations = linal.Mat3Array.fromQuats(b['quat'][start:end]).values
+		hasResources = (b['textures'][start:end, 1] > 0) | (b['shaders'][start:end, 1] > 0)
+		if 'parameters' in b:
+			hasResources |= b['parameters'][start:end] >= 0
+		for typeId in numpy.unique(typeIds[isNew]).tolist():
+			cls = self.getClass(typeId)
+			ndxs = numpy.flatnonzero(isNew & (typeIds == typeId))
+			if cls.__init__ is scene.Thing.__init__:
+				built = self.buildPlain(cls, start + ndxs, rotations[ndxs])
+			else:
+				built = [self.buildConstructed(cls, start + i, rotations[i]) for i in ndxs.tolist()]
+				# Their constructors may have set up textures/shaders to replace
+				hasResources[ndxs] = True
+			for i, t in zip(ndxs.tolist(), built):
+				nodes[i] = t
+		for i in numpy.flatnonzero(isNew & hasResources).tolist():
+			self.setResources(nodes[i].material, start + i)
+		isNew = isNew.tolist()
+		for t, parent in zip(nodes[1:], (b['parent'][start + 1:end] - start).tolist()):
+			if isNew[parent]:
+				nodes[parent].children.append(t)
+		things.update(zip(range(start, end), nodes))
+
+	def buildPlain(self, cls, ndxs, rotations):
+		# Things of a class with no constructor of its own, made column by
+		# column from the rows at ndxs
+		b = self.blocks
+		vecs = lambda name: linal.Vec3.fromLists(getRows(b[name][ndxs]))
+		materials = map(scene.Material, vecs('ambient'), vecs('diffuse'), vecs('specular'), getRows(b['shininess'][ndxs]), map(tuple, getRows(b['uvTransform'][ndxs])))
+		# The Mat3 is kept for quaternion nodes too, as their useQuat(False)
+		# value; rows is passed three times so each call takes the next three
+		rows = iter(linal.Vec3.fromLists(getRows(rotations.reshape(-1, 3))))
+		mats = map(linal.Mat3.fromRows, rows, rows, rows)
+		useQuat = (b['flags'][ndxs] & useQuatFlag) != 0
+		if useQuat.any():
+			quats = [linal.Quat(*q) if u else None for q, u in zip(b['quat'][ndxs].tolist(), useQuat.tolist())]
+		else:
+			quats = [None] * len(ndxs)
+		return list(map(cls.fromState, materials, vecs('position'), mats, quats, vecs('linVel'), vecs('angVel'), cls.allocateTransforms(len(ndxs))))
+
+	def buildConstructed(self, cls, ndx, rotation):
+		# A Thing whose class has its own constructor, which is run (with the
+		# saved shape parameters) before the saved state is written over it
+		b = self.blocks
+		size = float(b['size'][ndx])
+		detail = int(b['detail'][ndx])
+		if issubclass(cls, solids.Sphere):
+			t = cls(size, detail) if detail else cls(size)
+		elif issubclass(cls, particles.Emitter):
+			t = cls(detail) if detail else cls()
+		else:
+			t = cls()
+		if isinstance(t, particles.Sprite):
+			t.size = size
+		t.position.values[:] = b['position'][ndx].tolist()
+		if b['flags'][ndx] & useQuatFlag:
+			t.quat = linal.Quat(*b['quat'][ndx].tolist())
+		else:
+			for row, values in zip(t.rotation.values, rotation.tolist()):
+				row.values[:] = values
+		t.markDirty()
+		t.linVel.values[:] = b['linVel'][ndx].tolist()
+		t.angVel.values[:] = b['angVel'][ndx].tolist()
+		m = t.material
+		m.ambient_rgb.values[:] = b['ambient'][ndx].tolist()
+		m.diffuse_rgb.values[:] = b['diffuse'][ndx].tolist()
+		m.specular_rgb.values[:] = b['specular'][ndx].tolist()
+		m.shininess = float(b['shininess'][ndx])
+		m.uvTransform = tuple(b['uvTransform'][ndx].tolist())
+		return t
+
+	def setResources(self, m, ndx):
+		# Loads the saved textures/shaders into m unless it already has them,
+		# then sets its parameters (including those addTexture() set) as saved;
+		# files without parameters leave those from the constructor
+		b = self.blocks
+		strings = self.strings
+		start, count = b['textures'][ndx].tolist()
+		paths = [os.path.realpath(strings[i]) for i in b['textureRefs'][start:start + count].tolist()]
+		if paths != [x.path for x in m.textures if isinstance(x, Texture)]:
+			m.releaseTextures()
+			for path in paths:
+				m.addTexture(path)
+		start, count = b['shaders'][ndx].tolist()
+		shaderPaths = [(strings[i], strings[j]) for i, j in b['shaderRefs'][start:start + count].tolist()]
+		if shaderPaths != m.shaderPaths:
+			m.releaseShaders()
+			for vertexPath, fragmentPath in shaderPaths:
+				m.addShader(vertexPath, fragmentPath)
+		if 'parameters' in b:
+			stringId = int(b['parameters'][ndx])
+			m.parameters = dict((k, tuple(v)) for k, v in json.loads(strings[stringId]).items()) if stringId >= 0 else {}
+
+	def close(self):
+		# Drops this Snapshot's views; the file stays mapped until views
+		# handed out by getState()/getBlock() are gone too
+		self.blocks = {}
+		self.map = None
+
+def load(path):
+	# The whole tree, built at once
+	return Snapshot(path).getThing(0)
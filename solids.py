@@ -2,54 +2,83 @@
 """
 
 from pyglet import gl, graphics
-from math import pi, sin, cos, sqrt
-from hypyr import scene, linal
+import numpy
+from math import pi
+from hypyr import scene
+from hypyr.profiler import profiler
+
+class SphereGeometry(object):
+	# Indexed vertex list for a sphere of radius r with slices x slices
+	# vertices on a longitude/latitude grid; shared through GeometryCache
+	def __init__(self, r, slices):
+		self.key = (r, slices)
+		self.nUsers = 0
+		vertices, normals, textureuvw, tangents, indices = SphereGeometry.tessellate(r, slices)
+		self.batch = graphics.Batch()
+		self.vertex_list = self.batch.add_indexed(len(vertices), gl.GL_TRIANGLES, None, indices.tolist(), ('v3f/static', vertices.ravel().tolist()), ('n3f/static', normals.ravel().tolist()), ('t3f/static', textureuvw.ravel().tolist()), ('c3B/static', tangents.ravel().tolist()))
+		
+	@staticmethod
+	def tessellate(r, slices):
+		# Returns [N x 3] vertices, normals, uvw and tangent colors and the
+		# triangle indices, with N = slices**2 ordered longitude-major
+		tht_rad, phi_rad = numpy.meshgrid(numpy.linspace(0., 2 * pi, slices), numpy.linspace(-0.5 * pi, 0.5 * pi, slices), indexing='ij')
+		tht_rad, phi_rad = tht_rad.ravel(), phi_rad.ravel()
+		cosPhi = numpy.cos(phi_rad)
+		normals = numpy.column_stack((numpy.cos(tht_rad) * cosPhi, numpy.sin(tht_rad) * cosPhi, numpy.sin(phi_rad)))
+		vertices = r * normals
+		textureuvw = numpy.column_stack((tht_rad / (2 * pi), (phi_rad + pi / 2) / pi, numpy.zeros(len(tht_rad))))
+		tangents = numpy.column_stack((0.5 - 0.5 * normals[:, 2], numpy.full(len(tht_rad), 0.5), 0.5 + 0.5 * normals[:, 0]))
+		tangents = numpy.round(255 * tangents).astype(numpy.uint8)
+		# Two triangles per grid cell
+		i, j = numpy.meshgrid(numpy.arange(slices - 1), numpy.arange(slices - 1), indexing='ij')
+		p = (i * slices + j).ravel()
+		indices = numpy.column_stack((p, p + slices, p + slices + 1, p, p + slices + 1, p + 1)).ravel()
+		return vertices, normals, textureuvw, tangents, indices
+		
+	def delete(self):
+		self.vertex_list.delete()
+		
+class GeometryCache(object):
+	# Shares one SphereGeometry between all Spheres with the same (r, slices);
+	# geometries are reference counted and deleted with their last user
+	def __init__(self):
+		self.geometries = {}
+		
+	def acquire(self, r, slices):
+		key = (float(r), int(slices))
+		g = self.geometries.get(key)
+		if g is None:
+			g = SphereGeometry(*key)
+			self.geometries[key] = g
+		g.nUsers += 1
+		return g
+		
+	def release(self, g):
+		g.nUsers -= 1
+		if g.nUsers <= 0:
+			del self.geometries[g.key]
+			g.delete()
+			
+geometry = GeometryCache()
 
-def frange(xMin, dx, xMax):
-	vals = [xMin]
-	while xMin <= xMax:
-		xMin += dx
-		vals.append(min(xMin,xMax))
-	return vals
-	
 class Sphere(scene.Thing):
+	renderCaps = ()
+	
 	def __init__(self, r=1., slices=32):
 		super(Sphere, self).__init__()
-		self.batch = graphics.Batch()
-		vertices = []
-		normals = []
-		textureuvw = []
-		tangents = []
-		indices = []
-		tht_rad = frange(0., 2 * pi / (slices - 1.), 2 * pi)
-		phi_rad = frange(-0.5 * pi, pi / (slices - 1.), 0.5 * pi)
-		for t in tht_rad:
-			for p in phi_rad:
-				vertices.extend([
-					r * cos(t) * cos(p),
-					r * sin(t) * cos(p),
-					r * sin(p)])
-				normals.extend([
-					cos(t) * cos(p),
-					sin(t) * cos(p),
-					sin(p)])
-				textureuvw.extend([
-					t / (2 * pi),
-					(p + pi / 2) / pi,
-					0.])
-				tangents.extend([
-					int(round(255 * (0.5 - 0.5 * sin(p)))),
-					int(round(255 * (0.5 - 0.5 * 0))),
-					int(round(255 * (0.5 - 0.5 * -cos(t) * cos(p))))])
-		for i in range(slices - 1):
-			for j in range(slices - 1):
-				p = i * slices + j
-				indices.extend([p, p + slices, p + slices + 1])
-				indices.extend([p, p + slices + 1, p + 1])
-		self.vertex_list = self.batch.add_indexed(len(vertices)//3, gl.GL_TRIANGLES, None, indices, ('v3f/static', vertices), ('n3f/static', normals), ('t3f/static', textureuvw), ('c3B/static', tangents))
+		self.r = r
+		self.slices = slices
+		self.geometry = geometry.acquire(r, slices)
 
+	def getBoundRadius(self):
+		return self.r
+		
 	def delete(self):
-		self.vertex_list.delete()
+		if self.geometry is not None:
+			geometry.release(self.geometry)
+			self.geometry = None
 
 	def render(self):
-		self.batch.draw()
+		if profiler.enabled:
+			profiler.count('draw calls')
+		self.geometry.batch.draw()
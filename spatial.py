@@ -0,0 +1,248 @@
+"""Spatial index over bounding spheres for proximity queries, collisions and picking
+"""
+
+import numpy
+from hypyr import dynamics
+
+# Cell coordinates are packed into one int64 key with 21 bits per axis
+keyBits = 21
+keyBias = 1 << (keyBits - 1)
+
+def packKeys(cells):
+	# [N x 3] integer cell coordinates to [N] int64 keys; cells beyond the
+	# packable range are clamped, which only costs extra distance tests
+	c = numpy.clip(cells, -keyBias, keyBias - 1) + keyBias
+	return (c[..., 0] << (2 * keyBits)) | (c[..., 1] << keyBits) | c[..., 2]
+
+def expandRanges(starts, counts):
+	# Concatenation of arange(s, s + c) for each (s, c), without a Python loop
+	total = int(counts.sum())
+	offsets = numpy.cumsum(counts) - counts
+	return numpy.repeat(starts - offsets, counts) + numpy.arange(total)
+
+# Half of the 26 neighbouring cell offsets, so each pair of cells is seen once
+halfOffsets = numpy.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1) if (i, j, k) > (0, 0, 0)])
+allOffsets = numpy.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
+class HashGrid(object):
+	# Uniform grid over N spheres (positions [N x 3], radii [N]). Each sphere
+	# is filed under the cell holding its center, and item indices are kept
+	# sorted by cell key, so building is one O(N log N) sort and a cell is a
+	# binary search. Cells are at least twice the largest radius, so spheres
+	# can only overlap spheres filed in neighbouring cells.
+	def __init__(self, positions, radii, cellSize=None):
+		self.cellSize = cellSize
+		self.order = None
+		self.keys = None
+		self.update(positions, radii)
+
+	def update(self, positions, radii=None):
+		# Refiles moved spheres; the sort is skipped when no sphere changed
+		# cell and otherwise starts from the previous (nearly sorted) order
+		self.positions = numpy.asarray(positions, dtype=float).reshape(-1, 3)
+		n = len(self.positions)
+		if radii is not None:
+			self.radii = numpy.broadcast_to(numpy.asarray(radii, dtype=float), (n,))
+			self.maxRadius = float(self.radii.max()) if n else 0.
+			if self.cellSize is None or self.cellSize < 2 * self.maxRadius:
+				self.cellSize = self.getCellSize()
+				self.keys = None
+		keys = packKeys(numpy.floor(self.positions / self.cellSize).astype(numpy.int64))
+		if self.keys is not None and len(keys) == len(self.keys) and numpy.array_equal(keys, self.keys):
+			return
+		if self.order is not None and len(self.order) == n:
+			order = self.order[numpy.argsort(keys[self.order], kind='stable')]
+		else:
+			order = numpy.argsort(keys, kind='stable')
+		self.keys = keys
+		self.order = order
+		self.cellKeys, self.cellStart = numpy.unique(keys[order], return_index=True)
+		self.cellEnd = numpy.append(self.cellStart[1:], n)
+
+	def getCellSize(self):
+		# About one sphere per cell for uniformly spread positions, but never
+		# smaller than the largest diameter
+		n = len(self.positions)
+		extent = float(numpy.ptp(self.positions, axis=0).max()) if n else 0.
+		return max(2 * self.maxRadius, extent / max(n, 1)**(1. / 3), 1e-9)
+
+	def getCells(self, keys):
+		# (start, count) into self.order for each key; count is 0 where empty
+		ndx = numpy.searchsorted(self.cellKeys, keys)
+		ndx = numpy.minimum(ndx, len(self.cellKeys) - 1)
+		found = self.cellKeys[ndx] == keys
+		return self.cellStart[ndx], numpy.where(found, self.cellEnd[ndx] - self.cellStart[ndx], 0)
+
+	def getCandidates(self, lo, hi):
+		# Indices of spheres filed in cells lo..hi (inclusive) per axis
+		n = len(self.positions)
+		lo = numpy.floor(numpy.asarray(lo) / self.cellSize).astype(numpy.int64)
+		hi = numpy.floor(numpy.asarray(hi) / self.cellSize).astype(numpy.int64)
+		if n == 0 or numpy.prod(hi - lo + 1) > n:
+			# Wider than the population; scanning everything is cheaper
+			return numpy.arange(n)
+		axes = [numpy.arange(l, h + 1) for l, h in zip(lo, hi)]
+		cells = numpy.stack(numpy.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+		starts, counts = self.getCells(packKeys(cells))
+		return self.order[expandRanges(starts, counts)]
+
+	def queryRange(self, center, radius):
+		# Indices of spheres that overlap the sphere (center, radius)
+		center = numpy.asarray(center, dtype=float)
+		reach = radius + self.maxRadius
+		ndx = self.getCandidates(center - reach, center + reach)
+		d = self.positions[ndx] - center
+		return ndx[numpy.einsum('ij,ij->i', d, d) <= (radius + self.radii[ndx])**2]
+
+	def nearest(self, point, k=1):
+		# Indices of the k sphere centers closest to point, nearest first; the
+		# search box doubles until it holds k centers within its inner radius
+		point = numpy.asarray(point, dtype=float)
+		k = min(k, len(self.positions))
+		reach = self.cellSize
+		while True:
+			ndx = self.getCandidates(point - reach, point + reach)
+			d = self.positions[ndx] - point
+			d2 = numpy.einsum('ij,ij->i', d, d)
+			inside = d2 <= reach**2
+			if inside.sum() >= k or len(ndx) == len(self.positions):
+				break
+			reach *= 2
+		nearest = numpy.argsort(d2, kind='stable')[:k]
+		return ndx[nearest]
+
+	def pairs(self):
+		# [M x 2] indices (i < j) of overlapping spheres: the broad phase
+		n = len(self.positions)
+		if n < 2:
+			return numpy.zeros((0, 2), dtype=numpy.int64)
+		order = self.order
+		cells = numpy.floor(self.positions[order] / self.cellSize).astype(numpy.int64)
+		sortedNdx = numpy.arange(n)
+		found = []
+		# Same cell: each sorted slot pairs with the later slots of its cell
+		starts, counts = self.getCells(self.keys[order])
+		ends = starts + counts
+		found.append((numpy.repeat(sortedNdx, ends - sortedNdx - 1), expandRanges(sortedNdx + 1, ends - sortedNdx - 1)))
+		for offset in halfOffsets:
+			starts, counts = self.getCells(packKeys(cells + offset))
+			found.append((numpy.repeat(sortedNdx, counts), expandRanges(starts, counts)))
+		a = order[numpy.concatenate([f[0] for f in found])]
+		b = order[numpy.concatenate([f[1] for f in found])]
+		d = self.positions[a] - self.positions[b]
+		hit = numpy.einsum('ij,ij->i', d, d) <= (self.radii[a] + self.radii[b])**2
+		return numpy.sort(numpy.column_stack((a[hit], b[hit])), axis=1)
+
+	def raycast(self, origin, direction, maxDist=float('inf')):
+		# Returns (index, distance) for the first sphere hit by the ray, or
+		# None. Cells are walked front to back (3D DDA); each visited cell tests
+		# the spheres filed around it, and the walk stops once the next cell
+		# starts beyond the best hit.
+		n = len(self.positions)
+		if n == 0:
+			return None
+		o = numpy.asarray(origin, dtype=float)
+		d = numpy.asarray(direction, dtype=float)
+		d = d / numpy.sqrt(d.dot(d))
+		cs = self.cellSize
+		# Clip the ray to the occupied cells, padded by one cell
+		lo = (numpy.floor(self.positions.min(axis=0) / cs) - 1) * cs
+		hi = (numpy.floor(self.positions.max(axis=0) / cs) + 2) * cs
+		inside = (o >= lo) & (o <= hi)
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			ta, tb = (lo - o) / d, (hi - o) / d
+		tNear = numpy.where(d != 0, numpy.minimum(ta, tb), numpy.where(inside, -numpy.inf, numpy.inf))
+		tFar = numpy.where(d != 0, numpy.maximum(ta, tb), numpy.where(inside, numpy.inf, -numpy.inf))
+		tEnter = max(float(tNear.max()), 0.)
+		tExit = min(float(tFar.min()), maxDist)
+		if tEnter > tExit:
+			return None
+		p = o + tEnter * d
+		cell = numpy.floor(p / cs).astype(numpy.int64)
+		cell = numpy.clip(cell, numpy.floor(lo / cs).astype(numpy.int64), numpy.floor(hi / cs).astype(numpy.int64) - 1)
+		step = numpy.where(d > 0, 1, -1)
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			boundary = (cell + (step > 0)) * cs
+			tMax = numpy.where(d != 0, (boundary - o) / d, numpy.inf)
+			tDelta = numpy.where(d != 0, cs / numpy.abs(d), numpy.inf)
+		best = None
+		bestT = maxDist
+		tested = numpy.zeros(n, dtype=bool)
+		t = tEnter
+		while t <= min(tExit, bestT):
+			starts, counts = self.getCells(packKeys(cell + allOffsets))
+			ndx = self.order[expandRanges(starts, counts)]
+			ndx = ndx[~tested[ndx]]
+			tested[ndx] = True
+			if len(ndx):
+				oc = self.positions[ndx] - o
+				tc = oc.dot(d)
+				h2 = self.radii[ndx]**2 - (numpy.einsum('ij,ij->i', oc, oc) - tc**2)
+				h = numpy.sqrt(numpy.maximum(h2, 0.))
+				tHit = numpy.where(tc - h >= 0, tc - h, tc + h)
+				ok = (h2 >= 0) & (tHit >= 0) & (tHit <= bestT)
+				if ok.any():
+					i = numpy.flatnonzero(ok)[numpy.argmin(tHit[ok])]
+					best, bestT = int(ndx[i]), float(tHit[i])
+			axis = int(numpy.argmin(tMax))
+			t = float(tMax[axis])
+			cell[axis] += step[axis]
+			tMax[axis] += tDelta[axis]
+		if best is None:
+			return None
+		return best, bestT
+
+class SceneIndex(object):
+	# HashGrid over the Things of a scene graph, keyed by their world
+	# positions and bounding radii (see Thing.getBoundRadius); Things with
+	# unbounded extent such as Lights are left out. Call update() after the
+	# scene moves and rebuild() after changing the tree itself.
+	def __init__(self, root, cellSize=None):
+		self.root = root
+		self.cellSize = cellSize
+		self.rebuild()
+
+	def rebuild(self):
+		things, _ = dynamics.flatten(self.root)
+		self.things = [t for t in things if numpy.isfinite(t.getBoundRadius())]
+		self.root.updateTransforms()
+		self.grid = HashGrid(self.getPositions(), self.getRadii(), self.cellSize)
+
+	def getPositions(self):
+		positions = numpy.empty((len(self.things), 3))
+		for ndx, t in enumerate(self.things):
+			positions[ndx] = t._worldT[3, :3]
+		return positions
+
+	def getRadii(self):
+		return numpy.array([t.getBoundRadius() for t in self.things], dtype=float)
+
+	def update(self):
+		# Radii are refreshed too, as those of SpriteBatches and Emitters
+		# follow their contents
+		self.root.updateTransforms()
+		self.grid.update(self.getPositions(), self.getRadii())
+
+	def queryRange(self, center, radius):
+		return [self.things[i] for i in self.grid.queryRange(center, radius).tolist()]
+
+	def nearest(self, point, k=1):
+		return [self.things[i] for i in self.grid.nearest(point, k).tolist()]
+
+	def pairs(self):
+		return [(self.things[i], self.things[j]) for i, j in self.grid.pairs().tolist()]
+
+	def raycast(self, origin, direction, maxDist=float('inf')):
+		# Returns (Thing, distance) for the first Thing hit, or None
+		hit = self.grid.raycast(origin, direction, maxDist)
+		if hit is None:
+			return None
+		return self.things[hit[0]], hit[1]
+
+	def pick(self, camera, x, y, width, height):
+		# Thing under window pixel (x, y), or None
+		origin, direction = camera.getPickRay(x, y, width, height)
+		hit = self.raycast(origin.values, direction.values, camera.zFar)
+		if hit is None:
+			return None
+		return hit[0]
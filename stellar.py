@@ -2,10 +2,22 @@
 """
 
 import enum
-import csv
+import collections
+import ctypes
+import hashlib
+import itertools
+import os
+import numpy
 from pyglet import gl
-from math import sin, cos
+from math import tan, atan, sqrt, log10, pi
 import colorsys
+from hypyr import data, linal
+from hypyr.shader import registry
+from hypyr.profiler import profiler
+
+# Indexed by HarvardSpectralClass value
+spectralHues = [0.,266/360.,226/360.,224/360.,240/360.,33/360.,31/360.,29/360.]
+spectralSaturations = [0.,38/100.,35/100.,24/100.,6/100.,9/100.,28/100.,51/100.]
 
 class HarvardSpectralClass(enum.Enum):
 	unknown = 0
@@ -22,9 +34,7 @@ class HarvardSpectralClass(enum.Enum):
 		return cls.__members__[key]
 		
 	def getHueSat(self):
-		hues = [0.,266/360.,226/360.,224/360.,240/360.,33/360.,31/360.,29/360.]
-		saturations = [0.,38/100.,35/100.,24/100.,6/100.,9/100.,28/100.,51/100.]
-		return (hues[self.value],saturations[self.value])
+		return (spectralHues[self.value],spectralSaturations[self.value])
 		
 class Star(object):
 	def __init__(self):
@@ -48,27 +58,449 @@ class Star(object):
 	
 	@staticmethod
 	def getCatalog(name):
-		cat = []
-		with open(name) as f:
-			reader = csv.DictReader(f)
-			for row in reader:
-				star = Star()
-				star.sao = int(row['sao'])
-				star.ra_rad = float(row['ra_rad'])
-				star.dec_rad = float(row['dec_rad'])
-				star.apparent_vm = float(row['apparent_vm'])
-				star.spec = HarvardSpectralClass.getFromKey(row['spec'])
-				cat.append(star)
-		return cat
+		# Star objects for compatibility; Catalog.load is the columnar form
+		return Catalog.load(name).toStars()
 		
 	@staticmethod
-	def renderCatalog(cat, far):
+	def renderCatalog(cat, far, coordinates=None, epoch_jyr=None):
+		# One glBegin per star; positions come from one array operation over
+		# the list, or from a SkyCoordinates over it at epoch_jyr
+		if profiler.enabled:
+			profiler.count('draw calls', len(cat))
+		if coordinates is None:
+			u = SkyIndex.getUnitVectors(numpy.array([s.ra_rad for s in cat]), numpy.array([s.dec_rad for s in cat]))
+		else:
+			u = coordinates.getUnitVectors(epoch_jyr)
 		gl.glDisable(gl.GL_LIGHTING)
-		for s in cat:
+		for s, p in zip(cat, (far * u).tolist()):
 			c = s.getRgb()
 			gl.glPointSize(s.getSize())
 			gl.glBegin(gl.GL_POINTS)
 			gl.glColor3f(c[0], c[1], c[2])
-			gl.glVertex3f(far * cos(s.ra_rad) * cos(s.dec_rad), far * sin(s.ra_rad) * cos(s.dec_rad), far * sin(s.dec_rad))
+			gl.glVertex3f(p[0], p[1], p[2])
 			gl.glEnd()
 		gl.glEnable(gl.GL_LIGHTING)
+
+class Catalog(object):
+	# Columnar star catalog: one structured array with a field per column,
+	# exposed as attributes (cat.ra_rad etc.), so no per-star objects exist
+	dtype = numpy.dtype([('sao', numpy.int32), ('ra_rad', numpy.float64), ('dec_rad', numpy.float64), ('apparent_vm', numpy.float64), ('spec', numpy.uint8)])
+	columns = ('sao', 'ra_rad', 'dec_rad', 'apparent_vm', 'spec')
+	
+	def __init__(self, rows=None):
+		self.rows = numpy.zeros(0, dtype=Catalog.dtype) if rows is None else rows
+		
+	def __len__(self):
+		return self.rows.shape[0]
+		
+	def __getattr__(self, name):
+		if name in Catalog.columns:
+			return self.rows[name]
+		raise AttributeError(name)
+		
+	@staticmethod
+	def fromStars(stars):
+		rows = numpy.zeros(len(stars), dtype=Catalog.dtype)
+		rows['sao'] = [s.sao for s in stars]
+		rows['ra_rad'] = [s.ra_rad for s in stars]
+		rows['dec_rad'] = [s.dec_rad for s in stars]
+		rows['apparent_vm'] = [s.apparent_vm for s in stars]
+		rows['spec'] = [s.spec.value for s in stars]
+		return Catalog(rows)
+		
+	def toStars(self):
+		classes = sorted(HarvardSpectralClass, key=lambda c: c.value)
+		stars = []
+		for sao, ra_rad, dec_rad, vm, spec in self.rows.tolist():
+			star = Star()
+			star.sao = sao
+			star.ra_rad = ra_rad
+			star.dec_rad = dec_rad
+			star.apparent_vm = vm
+			star.spec = classes[spec]
+			stars.append(star)
+		return stars
+		
+	@staticmethod
+	def iterChunks(name, chunkRows=65536):
+		# Yields the CSV as Catalogs of at most chunkRows rows, so catalogs of
+		# any size are parsed without holding all of their text at once
+		with open(name) as f:
+			header = [h.strip() for h in f.readline().split(',')]
+			usecols = [header.index(c) for c in Catalog.columns]
+			raw = numpy.dtype([(c, Catalog.dtype[c] if c != 'spec' else 'U8') for c in Catalog.columns])
+			# File line number of each chunk's first row (the header is line 1)
+			firstLine = 2
+			while True:
+				lines = list(itertools.islice(f, chunkRows))
+				if len(lines) == 0:
+					return
+				table = numpy.loadtxt(lines, delimiter=',', dtype=raw, usecols=usecols, ndmin=1)
+				rows = numpy.zeros(table.shape[0], dtype=Catalog.dtype)
+				for c in Catalog.columns[:-1]:
+					rows[c] = table[c]
+				isMapped = numpy.zeros(table.shape[0], dtype=bool)
+				for key, member in HarvardSpectralClass.__members__.items():
+					isKey = table['spec'] == key
+					rows['spec'][isKey] = member.value
+					isMapped |= isKey
+				if not isMapped.all():
+					# As getFromKey would; a bad row must not reach the cache
+					ndx = int(numpy.flatnonzero(~isMapped)[0])
+					raise ValueError("%s line %u: %r is not a HarvardSpectralClass" % (name, firstLine + ndx, str(table['spec'][ndx])))
+				firstLine += len(lines)
+				yield Catalog(rows)
+				
+	@staticmethod
+	def parse(name, chunkRows=65536):
+		# Whole CSV into one Catalog, growing the array geometrically
+		rows = numpy.zeros(chunkRows, dtype=Catalog.dtype)
+		n = 0
+		for chunk in Catalog.iterChunks(name, chunkRows):
+			m = len(chunk)
+			if n + m > rows.shape[0]:
+				rows = numpy.resize(rows, max(2 * rows.shape[0], n + m))
+			rows[n:n + m] = chunk.rows
+			n += m
+		return Catalog(rows[:n].copy())
+		
+	@staticmethod
+	def getSourceKey(name, withHash):
+		st = os.stat(name)
+		key = [str(st.st_mtime_ns), str(st.st_size)]
+		if withHash:
+			h = hashlib.sha1()
+			with open(name, 'rb') as f:
+				for block in iter(lambda: f.read(1 << 20), b''):
+					h.update(block)
+			key.append(h.hexdigest())
+		return key
+		
+	@staticmethod
+	def load(name, useCache=True):
+		# Parses name, or memory-maps the binary sidecar (name + '.npy') left
+		# by an earlier load. The sidecar is trusted while the source's mtime
+		# and size are unchanged; otherwise it is reused only if the source's
+		# SHA-1 still matches. A sidecar that cannot be written is skipped.
+		if not useCache:
+			return Catalog.parse(name)
+		cachePath, keyPath = name + '.npy', name + '.key'
+		try:
+			with open(keyPath) as f:
+				cachedKey = f.read().split()
+		except (OSError, IOError):
+			cachedKey = None
+		if cachedKey is not None and os.path.exists(cachePath):
+			if Catalog.getSourceKey(name, False) == cachedKey[:2]:
+				return Catalog(numpy.load(cachePath, mmap_mode='r'))
+			key = Catalog.getSourceKey(name, True)
+			if key[2:] == cachedKey[2:]:
+				Catalog.writeKey(keyPath, key)
+				return Catalog(numpy.load(cachePath, mmap_mode='r'))
+		cat = Catalog.parse(name)
+		try:
+			numpy.save(cachePath, cat.rows)
+			Catalog.writeKey(keyPath, Catalog.getSourceKey(name, True))
+		except (OSError, IOError):
+			pass
+		return cat
+		
+	@staticmethod
+	def writeKey(keyPath, key):
+		with open(keyPath, 'w') as f:
+			f.write(' '.join(key))
+		
+def hsvToRgb(h, s, v):
+	# Vectorized colorsys.hsv_to_rgb over equal-length arrays; returns [N x 3]
+	i = numpy.floor(h * 6.)
+	f = h * 6. - i
+	p = v * (1. - s)
+	q = v * (1. - s * f)
+	t = v * (1. - s * (1. - f))
+	i = i.astype(int) % 6
+	r = numpy.choose(i, [v, q, p, p, t, v])
+	g = numpy.choose(i, [t, v, v, q, p, p])
+	b = numpy.choose(i, [p, p, t, v, v, q])
+	return numpy.stack([r, g, b], axis=1)
+
+arcsec_rad = pi / (180. * 3600.)
+
+def precessionMatrix(fromEpoch_jyr, toEpoch_jyr):
+	# linal.Mat3 taking unit vectors on the mean equator and equinox of one
+	# epoch (Julian years, e.g. 2000. for J2000) to another, from the IAU 1976
+	# precession angles (Lieske 1977) composed with linal.Rot
+	T = (fromEpoch_jyr - 2000.) / 100.
+	t = (toEpoch_jyr - fromEpoch_jyr) / 100.
+	k = 2306.2181 + 1.39656 * T - 0.000139 * T**2
+	zeta_rad = arcsec_rad * (k * t + (0.30188 - 0.000344 * T) * t**2 + 0.017998 * t**3)
+	z_rad = arcsec_rad * (k * t + (1.09468 + 0.000066 * T) * t**2 + 0.018203 * t**3)
+	theta_rad = arcsec_rad * ((2004.3109 - 0.85330 * T - 0.000217 * T**2) * t - (0.42665 + 0.000217 * T) * t**2 - 0.041833 * t**3)
+	return linal.Rot.z(z_rad) * linal.Rot.y(-theta_rad) * linal.Rot.z(zeta_rad)
+
+class SkyCoordinates(object):
+	# Unit vectors of a whole catalog at any epoch. Catalog positions (at
+	# epoch_jyr, on its mean equator) are turned into unit vectors once, along
+	# with their proper motions as tangent velocities; a target epoch then
+	# costs one linear step and one 3x3 precession product over the array.
+	# Results are kept for the maxCached most recently used epochs, so
+	# stepping back and forth through a time lapse recomputes nothing.
+	def __init__(self, ra_rad, dec_rad, epoch_jyr=2000., pmRa_rad_yr=None, pmDec_rad_yr=None, maxCached=16):
+		# pmRa_rad_yr is the rate along the equator (mu_alpha * cos(dec))
+		self.epoch_jyr = epoch_jyr
+		self.unit = SkyIndex.getUnitVectors(ra_rad, dec_rad)
+		self.velocity = None
+		if pmRa_rad_yr is not None or pmDec_rad_yr is not None:
+			pmRa = numpy.zeros(len(ra_rad)) if pmRa_rad_yr is None else numpy.asarray(pmRa_rad_yr)
+			pmDec = numpy.zeros(len(ra_rad)) if pmDec_rad_yr is None else numpy.asarray(pmDec_rad_yr)
+			sinRa, cosRa = numpy.sin(ra_rad), numpy.cos(ra_rad)
+			sinDec, cosDec = numpy.sin(dec_rad), numpy.cos(dec_rad)
+			self.velocity = numpy.stack([-pmRa * sinRa - pmDec * sinDec * cosRa, pmRa * cosRa - pmDec * sinDec * sinRa, pmDec * cosDec], axis=1)
+		self.maxCached = maxCached
+		self.cache = collections.OrderedDict()
+		self.nComputed = 0
+
+	@staticmethod
+	def fromCatalog(cat, epoch_jyr=2000., maxCached=16):
+		return SkyCoordinates(cat.ra_rad, cat.dec_rad, epoch_jyr, maxCached=maxCached)
+
+	def getMatrix(self, epoch_jyr):
+		# [3 x 3] array of precessionMatrix from the catalog epoch
+		return linal.Mat3Array.fromMats([precessionMatrix(self.epoch_jyr, epoch_jyr)]).values[0]
+
+	def getUnitVectors(self, epoch_jyr=None):
+		# Read-only [N x 3] unit vectors at epoch_jyr (the catalog's if None)
+		if epoch_jyr is None:
+			epoch_jyr = self.epoch_jyr
+		u = self.cache.get(epoch_jyr)
+		if u is not None:
+			self.cache.move_to_end(epoch_jyr)
+			return u
+		u = self.unit
+		if self.velocity is not None:
+			u = u + (epoch_jyr - self.epoch_jyr) * self.velocity
+			u /= numpy.linalg.norm(u, axis=1)[:, None]
+		if epoch_jyr != self.epoch_jyr:
+			u = u.dot(self.getMatrix(epoch_jyr).T)
+		elif u is self.unit:
+			u = u.copy()
+		u.flags.writeable = False
+		self.cache[epoch_jyr] = u
+		self.nComputed += 1
+		if len(self.cache) > self.maxCached:
+			self.cache.popitem(last=False)
+		return u
+
+	def getRaDec(self, epoch_jyr=None):
+		# (ra_rad in [0, 2 pi), dec_rad) arrays at epoch_jyr
+		u = self.getUnitVectors(epoch_jyr)
+		return numpy.arctan2(u[:, 1], u[:, 0]) % (2. * pi), numpy.arcsin(numpy.clip(u[:, 2], -1., 1.))
+
+class SkyIndex(object):
+	# Cube-map tiling of the sky: each of the six faces is split into
+	# resolution x resolution tiles, and the catalog is reordered so that each
+	# tile is one contiguous run of stars sorted brightest (lowest apparent_vm)
+	# first. A view then needs only the tiles near its direction, and only the
+	# leading stars of each down to a magnitude limit.
+	def __init__(self, cat, resolution=16):
+		self.resolution = resolution
+		nTiles = 6 * resolution * resolution
+		tile = SkyIndex.getTiles(SkyIndex.getUnitVectors(cat.ra_rad, cat.dec_rad), resolution)
+		order = numpy.lexsort((cat.apparent_vm, tile))
+		self.order = order
+		self.catalog = Catalog(cat.rows[order])
+		tile = tile[order]
+		self.tileStart = numpy.searchsorted(tile, numpy.arange(nTiles), side='left').astype(numpy.int32)
+		self.tileEnd = numpy.searchsorted(tile, numpy.arange(nTiles), side='right').astype(numpy.int32)
+		self.tileCenters, self.tileRadii_rad = SkyIndex.getTileGeometry(resolution)
+		
+	@staticmethod
+	def getUnitVectors(ra_rad, dec_rad):
+		return numpy.stack([numpy.cos(ra_rad) * numpy.cos(dec_rad), numpy.sin(ra_rad) * numpy.cos(dec_rad), numpy.sin(dec_rad)], axis=1)
+		
+	@staticmethod
+	def getTiles(u, resolution):
+		# Face is 2 * major axis + (1 if negative); (s, t) are the two other
+		# components projected onto that face, in [-1, 1]
+		major = numpy.argmax(numpy.abs(u), axis=1)
+		n = numpy.arange(u.shape[0])
+		m = u[n, major]
+		face = 2 * major + (m < 0)
+		s = u[n, (major + 1) % 3] / numpy.abs(m)
+		t = u[n, (major + 2) % 3] / numpy.abs(m)
+		i = numpy.clip(((s + 1.) * 0.5 * resolution).astype(int), 0, resolution - 1)
+		j = numpy.clip(((t + 1.) * 0.5 * resolution).astype(int), 0, resolution - 1)
+		return (face * resolution + i) * resolution + j
+		
+	@staticmethod
+	def getFacePoints(face, s, t):
+		# Inverse of getTiles' projection for arrays of face, s and t
+		major = face // 2
+		n = numpy.arange(len(s))
+		u = numpy.zeros((len(s), 3))
+		u[n, major] = numpy.where(face % 2 == 0, 1., -1.)
+		u[n, (major + 1) % 3] = s
+		u[n, (major + 2) % 3] = t
+		return u / numpy.linalg.norm(u, axis=1)[:, None]
+		
+	@staticmethod
+	def getTileGeometry(resolution):
+		# Unit center of every tile, and the angle from it to its farthest corner
+		tiles = numpy.arange(6 * resolution * resolution)
+		face = tiles // (resolution * resolution)
+		i = (tiles // resolution) % resolution
+		j = tiles % resolution
+		edge = 2. / resolution
+		centers = SkyIndex.getFacePoints(face, -1. + (i + 0.5) * edge, -1. + (j + 0.5) * edge)
+		radii_rad = numpy.zeros(len(tiles))
+		for di in (0, 1):
+			for dj in (0, 1):
+				corner = SkyIndex.getFacePoints(face, -1. + (i + di) * edge, -1. + (j + dj) * edge)
+				cosAng = numpy.clip(numpy.einsum('ij,ij->i', centers, corner), -1., 1.)
+				radii_rad = numpy.maximum(radii_rad, numpy.arccos(cosAng))
+		return centers, radii_rad
+		
+	def getVisibleTiles(self, direction, halfAngle_rad):
+		# Tiles that may intersect the cone around (unit) direction
+		cosAng = numpy.clip(self.tileCenters.dot(direction), -1., 1.)
+		return numpy.flatnonzero(numpy.arccos(cosAng) <= halfAngle_rad + self.tileRadii_rad)
+		
+	def getRanges(self, tiles, vmLimit):
+		# (first, count) arrays of the stars in tiles no fainter than vmLimit
+		vm = self.catalog.apparent_vm
+		first = self.tileStart[tiles]
+		count = numpy.zeros(len(tiles), dtype=numpy.int32)
+		for k, (a, b) in enumerate(zip(first.tolist(), self.tileEnd[tiles].tolist())):
+			count[k] = numpy.searchsorted(vm[a:b], vmLimit, side='right')
+		keep = count > 0
+		return first[keep], count[keep]
+		
+	@staticmethod
+	def getMagnitudeLimit(fov_rad, vmLimitWide=6.5, wideFov_rad=0.5 * pi):
+		# Narrowing the field by k shows stars 5 log10(k) magnitudes fainter
+		return vmLimitWide + 5. * log10(wideFov_rad / max(fov_rad, 1e-6))
+		
+	def query(self, camera, vmLimitWide=6.5, toCatalog=None):
+		# Ranges visible through a scene.Camera whose eye sits inside the sky;
+		# toCatalog is a [3 x 3] rotation from the camera's frame to the
+		# catalog's, where the tiles were laid out
+		d = [camera.tgt[k] - camera.eye[k] for k in range(3)]
+		n = sqrt(d[0]**2 + d[1]**2 + d[2]**2)
+		direction = numpy.array(d) / n
+		if toCatalog is not None:
+			direction = toCatalog.dot(direction)
+		halfAngle_rad = atan(sqrt(tan(0.5 * camera.xFov_rad)**2 + tan(0.5 * camera.yFov_rad)**2))
+		vmLimit = SkyIndex.getMagnitudeLimit(max(camera.xFov_rad, camera.yFov_rad), vmLimitWide)
+		return self.getRanges(self.getVisibleTiles(direction, halfAngle_rad), vmLimit)
+		
+class StarField(object):
+	# Renders a whole catalog as one glDrawArrays of GL_POINTS. Positions,
+	# colors and sizes (as in Star.getRgb/getSize) are computed once into an
+	# interleaved vertex buffer, and point size is set by the vertex shader,
+	# so per-frame Python work does not depend on the number of stars.
+	stride = 7
+
+	def __init__(self, cat, far, tileResolution=0, catalogEpoch_jyr=2000., pmRa_rad_yr=None, pmDec_rad_yr=None):
+		# cat is a Catalog or a list of Stars; with a tileResolution the
+		# stars are kept in a SkyIndex and render(camera) draws only the
+		# tiles and magnitudes that camera can see. Positions are those of
+		# catalogEpoch_jyr until setEpoch(); proper motions (per star of cat,
+		# see SkyCoordinates) are optional.
+		if not isinstance(cat, Catalog):
+			cat = Catalog.fromStars(cat)
+		self.index = None
+		if tileResolution > 0:
+			self.index = SkyIndex(cat, tileResolution)
+			cat = self.index.catalog
+			if pmRa_rad_yr is not None:
+				pmRa_rad_yr = numpy.asarray(pmRa_rad_yr)[self.index.order]
+			if pmDec_rad_yr is not None:
+				pmDec_rad_yr = numpy.asarray(pmDec_rad_yr)[self.index.order]
+		self.vertices = StarField.pack(cat.ra_rad, cat.dec_rad, cat.apparent_vm, cat.spec.astype(int), far)
+		self.count = self.vertices.shape[0]
+		self.far = far
+		self.catalog = cat
+		self.catalogEpoch_jyr = catalogEpoch_jyr
+		self.properMotion = (pmRa_rad_yr, pmDec_rad_yr)
+		self.coordinates = None
+		self.epoch_jyr = catalogEpoch_jyr
+		self.toCatalog = None
+		self.buffer = None
+		self.shader = None
+
+	@staticmethod
+	def pack(ra_rad, dec_rad, vm, spec, far):
+		# [N x 7] float32 rows of (x, y, z, r, g, b, size)
+		t = (vm - 7.0) / (-1.6 - 7.0)
+		v = numpy.empty((len(vm), StarField.stride), dtype=numpy.float32)
+		v[:, 0] = far * numpy.cos(ra_rad) * numpy.cos(dec_rad)
+		v[:, 1] = far * numpy.sin(ra_rad) * numpy.cos(dec_rad)
+		v[:, 2] = far * numpy.sin(dec_rad)
+		v[:, 3:6] = hsvToRgb(numpy.take(spectralHues, spec), numpy.take(spectralSaturations, spec), 0.5 + 0.5 * t)
+		v[:, 6] = 1.0 + 3.0 * t
+		return v
+
+	def setEpoch(self, epoch_jyr):
+		# Moves every star to epoch_jyr with one array operation (cached per
+		# epoch by SkyCoordinates) and refreshes the vertex buffer. Tiles stay
+		# where the catalog put them; visibility queries are rotated back into
+		# the catalog frame instead, which ignores proper motion across tiles.
+		if epoch_jyr == self.epoch_jyr:
+			return
+		if self.coordinates is None:
+			pmRa_rad_yr, pmDec_rad_yr = self.properMotion
+			self.coordinates = SkyCoordinates(self.catalog.ra_rad, self.catalog.dec_rad, self.catalogEpoch_jyr, pmRa_rad_yr, pmDec_rad_yr)
+		self.vertices[:, 0:3] = self.far * self.coordinates.getUnitVectors(epoch_jyr)
+		self.toCatalog = self.coordinates.getMatrix(epoch_jyr).T
+		self.epoch_jyr = epoch_jyr
+		if self.buffer is not None:
+			gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer)
+			gl.glBufferSubData(gl.GL_ARRAY_BUFFER, 0, self.vertices.nbytes, self.vertices.ctypes.data)
+			gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+	def upload(self):
+		self.shader = registry.acquireFiles(data.get_path('shaders/star.v.glsl'), data.get_path('shaders/star.f.glsl'))
+		self.locations = [gl.glGetAttribLocation(self.shader.handle, name) for name in (b'starPosition', b'starColor', b'starSize')]
+		self.buffer = gl.GLuint(0)
+		gl.glGenBuffers(1, ctypes.byref(self.buffer))
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer)
+		gl.glBufferData(gl.GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices.ctypes.data, gl.GL_STATIC_DRAW)
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+	def delete(self):
+		if self.buffer is not None:
+			gl.glDeleteBuffers(1, ctypes.byref(self.buffer))
+			registry.release(self.shader)
+			self.buffer = None
+			self.shader = None
+
+	def render(self, camera=None):
+		if self.buffer is None:
+			self.upload()
+		if camera is not None and self.index is not None:
+			firsts, counts = self.index.query(camera, toCatalog=self.toCatalog)
+			if len(firsts) == 0:
+				return
+		else:
+			firsts = counts = None
+		stride = StarField.stride * 4
+		gl.glDisable(gl.GL_LIGHTING)
+		gl.glEnable(gl.GL_VERTEX_PROGRAM_POINT_SIZE)
+		self.shader.bind()
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffer)
+		for loc, count, offset in zip(self.locations, (3, 3, 1), (0, 12, 24)):
+			if loc >= 0:
+				gl.glEnableVertexAttribArray(loc)
+				gl.glVertexAttribPointer(loc, count, gl.GL_FLOAT, gl.GL_FALSE, stride, offset)
+		if firsts is None:
+			gl.glDrawArrays(gl.GL_POINTS, 0, self.count)
+		else:
+			gl.glMultiDrawArrays(gl.GL_POINTS, firsts.ctypes.data_as(ctypes.POINTER(gl.GLint)), counts.ctypes.data_as(ctypes.POINTER(gl.GLsizei)), len(firsts))
+		if profiler.enabled:
+			profiler.count('draw calls')
+		for loc in self.locations:
+			if loc >= 0:
+				gl.glDisableVertexAttribArray(loc)
+		gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+		self.shader.unbind()
+		gl.glDisable(gl.GL_VERTEX_PROGRAM_POINT_SIZE)
+		gl.glEnable(gl.GL_LIGHTING)
@@ -0,0 +1,55 @@
+"""Mixed scalar-type/batch-type operators in linal
+"""
+
+import unittest
+import numpy
+from hypyr.linal import Vec3, Mat3, Rot, Vec3Array, Mat3Array
+
+class TestMixedOperands(unittest.TestCase):
+	# A Vec3 or Mat3 on the left of a batch must hand the operation to the
+	# batch's reflected operator, not treat the batch as a scalar
+	def setUp(self):
+		self.v = Vec3(1., 2., 3.)
+		self.m = Rot.z(.5)
+		self.m3 = numpy.array([[self.m[i][j] for j in range(3)] for i in range(3)])
+		self.vs = Vec3Array([[1., 0., 0.], [0., 1., 0.], [2., 3., 4.]])
+		self.ms = Mat3Array.fromMats([Rot.x(.1), Rot.y(.2)])
+
+	def test_vec3_plus_vec3array(self):
+		r = self.v + self.vs
+		self.assertIsInstance(r, Vec3Array)
+		numpy.testing.assert_allclose(r.values, self.vs.values + [1., 2., 3.])
+
+	def test_vec3_minus_vec3array(self):
+		r = self.v - self.vs
+		self.assertIsInstance(r, Vec3Array)
+		numpy.testing.assert_allclose(r.values, [1., 2., 3.] - self.vs.values)
+
+	def test_vec3_times_vec3array(self):
+		r = self.v * self.vs
+		numpy.testing.assert_allclose(r, self.vs.values.dot([1., 2., 3.]))
+
+	def test_mat3_times_mat3array(self):
+		r = self.m * self.ms
+		self.assertIsInstance(r, Mat3Array)
+		numpy.testing.assert_allclose(r.values, numpy.matmul(self.m3, self.ms.values))
+
+	def test_mat3_times_vec3array(self):
+		r = self.m * self.vs
+		self.assertIsInstance(r, Vec3Array)
+		numpy.testing.assert_allclose(r.values, self.vs.values.dot(self.m3.T))
+
+	def test_scalars(self):
+		self.assertEqual((self.v * 2.).values, [2., 4., 6.])
+		self.assertEqual((self.v * numpy.float64(2.)).values, [2., 4., 6.])
+		self.assertEqual((1. - self.v).values, [0., -1., -2.])
+		numpy.testing.assert_allclose((self.m * 2)[0].values, [2. * x for x in self.m[0].values])
+
+	def test_unsupported(self):
+		with self.assertRaises(TypeError):
+			self.v + "x"
+		with self.assertRaises(Exception):
+			self.v * self.m
+
+if __name__ == '__main__':
+	unittest.main()
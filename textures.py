@@ -0,0 +1,188 @@
+"""Background texture loading with CPU mip chains and an on-disk mip cache
+"""
+
+import concurrent.futures
+import collections
+import os
+import warnings
+import numpy
+from pyglet import gl, image
+
+class Texture(object):
+	# Handle shared by every Material using one image file. Until its data is
+	# uploaded, id is the loader's placeholder texture, so it can be bound
+	# and drawn right away.
+	target = gl.GL_TEXTURE_2D
+
+	def __init__(self, path, placeholderId):
+		self.path = path
+		self.id = placeholderId
+		self.width = 1
+		self.height = 1
+		self.isLoaded = False
+		self.nUsers = 0
+		self.future = None
+		# The exception from a failed load; the placeholder stays bound
+		self.error = None
+
+class TextureLoader(object):
+	# Decodes images and builds their mip chains on a thread pool; poll() on
+	# the GL thread uploads finished textures a few at a time. With useCache,
+	# each image's mip chain is kept in a sidecar (path + '.mips.npz') that is
+	# trusted while the image's mtime and size are unchanged, so later runs
+	# skip decoding. compressCache trades load time for disk space, and
+	# compressOnUpload asks the driver for a compressed internal format.
+	def __init__(self, nWorkers=2, useCache=True, compressCache=False, compressOnUpload=False, placeholderRgba=(128, 128, 128, 255)):
+		self.nWorkers = nWorkers
+		self.useCache = useCache
+		self.compressCache = compressCache
+		self.compressOnUpload = compressOnUpload
+		self.placeholderRgba = placeholderRgba
+		self.placeholderId = None
+		self.pool = None
+		self.textures = {}
+		self.pending = collections.deque()
+
+	def getPlaceholder(self):
+		if self.placeholderId is None:
+			pixel = numpy.array([[self.placeholderRgba]], dtype=numpy.uint8)
+			self.placeholderId = TextureLoader.upload([pixel], gl.GL_RGBA)
+		return self.placeholderId
+
+	def acquire(self, imgPath):
+		# Returns the shared Texture for imgPath, starting its load if needed;
+		# each call must be paired with a release()
+		imgPath = os.path.realpath(imgPath)
+		texture = self.textures.get(imgPath)
+		if texture is None:
+			if self.pool is None:
+				self.pool = concurrent.futures.ThreadPoolExecutor(self.nWorkers)
+			texture = Texture(imgPath, self.getPlaceholder())
+			texture.future = self.pool.submit(TextureLoader.loadMips, imgPath, self.useCache, self.compressCache)
+			self.textures[imgPath] = texture
+			self.pending.append(texture)
+		texture.nUsers += 1
+		return texture
+
+	def release(self, texture):
+		texture.nUsers -= 1
+		if texture.nUsers > 0:
+			return
+		del self.textures[texture.path]
+		if texture.isLoaded:
+			gl.glDeleteTextures(1, (gl.GLuint * 1)(texture.id))
+		elif texture.future is not None:
+			texture.future.cancel()
+		texture.id = self.placeholderId
+		texture.isLoaded = False
+
+	def poll(self, maxUploads=1):
+		# Uploads up to maxUploads finished textures, in request order; call
+		# once per frame with a context current. Returns how many are pending.
+		# A texture whose image cannot be loaded keeps the placeholder, with the
+		# exception in its error, and a warning is issued rather than stopping
+		# the caller's frame.
+		nUploads = 0
+		while self.pending and nUploads < maxUploads and self.pending[0].future.done():
+			texture = self.pending.popleft()
+			future, texture.future = texture.future, None
+			if future.cancelled() or texture.nUsers <= 0:
+				continue
+			try:
+				mips = future.result()
+			except Exception as e:
+				texture.error = e
+				warnings.warn("Could not load texture %s: %s" % (texture.path, e))
+				continue
+			texture.height, texture.width = mips[0].shape[:2]
+			texture.id = TextureLoader.upload(mips, gl.GL_COMPRESSED_RGBA if self.compressOnUpload else gl.GL_RGBA)
+			texture.isLoaded = True
+			nUploads += 1
+		return len(self.pending)
+
+	def finish(self):
+		# Blocks until every requested texture is loaded and uploaded
+		concurrent.futures.wait([t.future for t in self.pending])
+		self.poll(len(self.pending))
+
+	@staticmethod
+	def upload(mips, internalFormat):
+		# New texture holding mips (rows bottom-up, [H x W x 4] uint8 each)
+		ids = (gl.GLuint * 1)()
+		gl.glGenTextures(1, ids)
+		gl.glBindTexture(gl.GL_TEXTURE_2D, ids[0])
+		gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+		for level, m in enumerate(mips):
+			m = numpy.ascontiguousarray(m)
+			gl.glTexImage2D(gl.GL_TEXTURE_2D, level, internalFormat, m.shape[1], m.shape[0], 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, m.ctypes.data)
+		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAX_LEVEL, len(mips) - 1)
+		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+		gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST_MIPMAP_LINEAR if len(mips) > 1 else gl.GL_LINEAR)
+		return ids[0]
+
+	@staticmethod
+	def decode(imgPath):
+		# [H x W x 4] uint8 RGBA, rows bottom-up as GL expects. The decoder's
+		# own layout is converted here, as pyglet's per-pixel conversion is
+		# far slower than the decode itself.
+		img = image.load(imgPath).get_image_data()
+		fmt, pitch = img.format, img.pitch
+		n = len(fmt)
+		rows = numpy.frombuffer(img.get_data(fmt, pitch), dtype=numpy.uint8).reshape(img.height, abs(pitch))
+		src = rows[:, :img.width * n].reshape(img.height, img.width, n)
+		if pitch < 0:
+			src = src[::-1]
+		rgba = numpy.full((img.height, img.width, 4), 255, dtype=numpy.uint8)
+		for i, channel in enumerate(fmt):
+			if channel == 'L':
+				rgba[..., :3] = src[..., i:i + 1]
+			elif channel == 'I':
+				rgba[...] = src[..., i:i + 1]
+			else:
+				rgba[..., 'RGBA'.index(channel)] = src[..., i]
+		return rgba
+
+	@staticmethod
+	def buildMips(rgba):
+		# Box-filtered chain from rgba down to 1x1; odd rows/columns are dropped
+		mips = [rgba]
+		a = rgba.astype(numpy.uint16)
+		while a.shape[0] > 1 or a.shape[1] > 1:
+			h, w = a.shape[0] // 2, a.shape[1] // 2
+			if h > 0:
+				a = (a[0:2 * h:2] + a[1:2 * h:2] + 1) // 2
+			if w > 0:
+				a = (a[:, 0:2 * w:2] + a[:, 1:2 * w:2] + 1) // 2
+			mips.append(a.astype(numpy.uint8))
+		return mips
+
+	@staticmethod
+	def getSourceKey(imgPath):
+		st = os.stat(imgPath)
+		return numpy.array([st.st_mtime_ns, st.st_size], dtype=numpy.int64)
+
+	@staticmethod
+	def loadMips(imgPath, useCache=True, compressCache=False):
+		# Worker side: the cached mip chain if current, else decode and build
+		# it and try to write the cache (a sidecar that cannot be written is
+		# skipped)
+		cachePath = imgPath + '.mips.npz'
+		key = TextureLoader.getSourceKey(imgPath)
+		if useCache and os.path.exists(cachePath):
+			try:
+				with numpy.load(cachePath) as cached:
+					if numpy.array_equal(cached['key'], key):
+						return [cached['level%u' % i] for i in range(int(cached['nLevels']))]
+			except (OSError, IOError, KeyError, ValueError):
+				pass
+		mips = TextureLoader.buildMips(TextureLoader.decode(imgPath))
+		if useCache:
+			levels = dict(('level%u' % i, m) for i, m in enumerate(mips))
+			save = numpy.savez_compressed if compressCache else numpy.savez
+			try:
+				save(cachePath, key=key, nLevels=len(mips), **levels)
+			except (OSError, IOError):
+				pass
+		return mips
+
+loader = TextureLoader()